@@ -1,23 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, Response, stream_with_context, g, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime
+from markupsafe import Markup
+import click
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 import os
+import queue
+import re
+import sys
+import sysconfig
+import threading
 import time
-from sqlalchemy import func
+import urllib.request
+from sqlalchemy import func, select, insert, update, inspect, literal, literal_column, text, union_all, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import Session, object_session
 import random
-import barcode
-from barcode.writer import ImageWriter
-from PIL import Image, ImageDraw, ImageFont
 import argparse
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
-from reportlab.pdfgen import canvas
 from reportlab.lib.units import cm, mm
 from reportlab.lib.pagesizes import A4
-from io import BytesIO
-import arabic_reshaper
-from bidi.algorithm import get_display
+from io import BytesIO, StringIO
+import csv
+import gzip
+import json
+import hashlib
 import os
+from collections import OrderedDict, deque, namedtuple
+from typing import TYPE_CHECKING
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# PIL, python-barcode, reportlab's canvas and the Arabic shaping libraries are
+# imported inside the label/PDF functions that use them, so workers that only
+# serve POS and report pages never load them.
+if TYPE_CHECKING:
+    from PIL import ImageDraw, ImageFont
 
 # Arabic detection (so we only reshape when needed)
 ARABIC_BLOCKS = [
@@ -39,14 +61,17 @@ def contains_arabic(s: str) -> bool:
 def ar_text(text: str) -> str:
     """Shape & reorder only when the string contains Arabic; force RTL base direction."""
     if contains_arabic(text):
+        import arabic_reshaper
+        from bidi.algorithm import get_display
         shaped = arabic_reshaper.reshape(text)
         # Use RTL base direction for proper Arabic text ordering
-        return get_display(shaped, base_dir='rtl')
+        return get_display(shaped, base_dir='R')
     return text  # leave numbers/Latin as-is
 
 def ar_text_simple(text: str) -> str:
     """Simple Arabic text processing without complex bidi algorithm"""
     if contains_arabic(text):
+        import arabic_reshaper
         # Just reshape without bidi reordering
         return arabic_reshaper.reshape(text)
     return text
@@ -63,7 +88,8 @@ FONT_CANDIDATES = [
     "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
 ]
 
-def load_font(size: int) -> ImageFont.FreeTypeFont:
+def load_font(size: int) -> "ImageFont.FreeTypeFont":
+    from PIL import ImageFont
     for p in FONT_CANDIDATES:
         if os.path.exists(p):
             try:
@@ -74,7 +100,7 @@ def load_font(size: int) -> ImageFont.FreeTypeFont:
     # Fallback to default font if no TTF fonts are available
     return ImageFont.load_default()
 
-def fit_font(draw: ImageDraw.ImageDraw, text: str, max_width_px: int, start_size: int, min_size: int = 28):
+def fit_font(draw: "ImageDraw.ImageDraw", text: str, max_width_px: int, start_size: int, min_size: int = 28):
     size = start_size
     while size >= min_size:
         f = load_font(size)
@@ -127,6 +153,36 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+def engine_options_from_env(prefix, database_uri, read_only=False):
+    """SQLAlchemy engine options read from <prefix>POOL_SIZE, <prefix>POOL_RECYCLE, ..."""
+    options = {'pool_pre_ping': True}  # Drop connections the server closed while idle
+    if not database_uri.startswith('sqlite'):
+        options['pool_size'] = int(os.environ.get(f'{prefix}POOL_SIZE', 5))
+        options['max_overflow'] = int(os.environ.get(f'{prefix}MAX_OVERFLOW', 5))
+        options['pool_timeout'] = int(os.environ.get(f'{prefix}POOL_TIMEOUT', 10))
+        options['pool_recycle'] = int(os.environ.get(f'{prefix}POOL_RECYCLE', 1800))
+
+    if database_uri.startswith('postgres'):
+        server_options = []
+        statement_timeout_ms = int(os.environ.get(f'{prefix}STATEMENT_TIMEOUT_MS', 0))
+        if statement_timeout_ms:
+            server_options.append(f'-c statement_timeout={statement_timeout_ms}')
+        if read_only:
+            server_options.append('-c default_transaction_read_only=on')
+        if server_options:
+            options['connect_args'] = {'options': ' '.join(server_options)}
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options_from_env('DB_', app.config['SQLALCHEMY_DATABASE_URI'])
+
+# Optional read-only database for the report pages (a replica or a snapshot copy).
+# It gets its own connection pool, so report bursts cannot starve POS writes.
+if os.environ.get('REPORTS_DATABASE_URL'):
+    reports_uri = os.environ.get('REPORTS_DATABASE_URL')
+    app.config['SQLALCHEMY_BINDS'] = {
+        'reports': {'url': reports_uri, **engine_options_from_env('REPORTS_DB_', reports_uri, read_only=True)}
+    }
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -141,8 +197,8 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(120), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
 
-class Phone(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class PhoneColumns:
+    """أعمدة الهاتف المشتركة بين المخزون الحالي وأرشيف الهواتف المباعة"""
     brand = db.Column(db.String(100), nullable=False)
     model = db.Column(db.String(100), nullable=False)
     condition = db.Column(db.String(20), nullable=False)  # new or used
@@ -151,6 +207,7 @@ class Phone(db.Model):
     purchase_price_with_vat = db.Column(db.Float, nullable=False)  # سعر الشراء (مع ضريبة)
     selling_price_with_vat = db.Column(db.Float, nullable=False)   # سعر البيع (مع ضريبة)
     serial_number = db.Column(db.String(100), unique=True, nullable=False)
+    serial_reversed = db.Column(db.String(100), index=True)  # serial_number backwards, for suffix search
     phone_number = db.Column(db.String(20), unique=True, nullable=False)  # New field for phone number
     barcode_path = db.Column(db.String(200))  # New field for barcode image path
     description = db.Column(db.Text)
@@ -167,11 +224,27 @@ class Phone(db.Model):
     phone_memory = db.Column(db.String(50))    # الذاكرة
     buyer_name = db.Column(db.String(100))     # اسم المشتري
     
+    # Normalized customer fields for the customer lookup (set by set_customer_keys)
+    customer_phone_key = db.Column(db.String(20), index=True)
+    customer_id_key = db.Column(db.String(50), index=True)
+    customer_name_key = db.Column(db.String(100), index=True)
+    
     # Status tracking fields
     status = db.Column(db.String(20), default="available")  # available, sold, returned, etc.
     sold_date = db.Column(db.DateTime)  # When the phone was sold
     sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'))  # Link to sale record
 
+class Phone(PhoneColumns, db.Model):
+    """نموذج الهاتف - المخزون الحالي والمباع حديثاً"""
+    __table_args__ = (db.Index('ix_phone_status', 'status'),)
+    id = db.Column(db.Integer, primary_key=True)
+
+class PhoneHistory(PhoneColumns, db.Model):
+    """أرشيف الهواتف المباعة - تنقل إليه بأمر archive-phones وتحتفظ بنفس المعرّف"""
+    __tablename__ = 'phone_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Phone.id before archiving
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class PhoneType(db.Model):
     """نموذج أنواع الهواتف - للتحكم في العلامات التجارية والموديلات"""
     id = db.Column(db.Integer, primary_key=True)
@@ -188,7 +261,7 @@ class PhoneType(db.Model):
 class Transaction(db.Model):
     """نموذج المعاملات - للاحتفاظ بسجل المعاملات"""
     id = db.Column(db.Integer, primary_key=True)
-    phone_id = db.Column(db.Integer, db.ForeignKey('phone.id'), nullable=False)
+    phone_id = db.Column(db.Integer, nullable=False)  # phone.id, or phone_history.id once archived
     transaction_type = db.Column(db.String(20), nullable=False)  # buy, sell
     serial_number = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)  # السعر قبل الضريبة
@@ -217,6 +290,8 @@ class Sale(db.Model):
     customer_phone = db.Column(db.String(20))
     customer_email = db.Column(db.String(100))
     customer_address = db.Column(db.Text)
+    customer_phone_key = db.Column(db.String(20), index=True)   # normalized for the customer lookup
+    customer_name_key = db.Column(db.String(100), index=True)
     
     # Sale Details (تفاصيل البيع)
     subtotal = db.Column(db.Float, nullable=False, default=0.0)  # المبلغ قبل الضريبة
@@ -260,10 +335,19 @@ class Accessory(db.Model):
     date_added = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text)
 
+DEFAULT_MIN_QUANTITY = 5
+
+def stock_margin():
+    """Units above the minimum quantity; zero or less means low stock"""
+    # Rendered the same in queries and in the index DDL, so the planner matches the index
+    return Accessory.quantity_in_stock - func.coalesce(Accessory.min_quantity, literal_column(str(DEFAULT_MIN_QUANTITY)))
+
+db.Index('ix_accessory_stock_margin', stock_margin())
+
 class SaleItem(db.Model):
     """نموذج عنصر البيع - كل منتج في عملية البيع"""
     id = db.Column(db.Integer, primary_key=True)
-    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False, index=True)
     
     # Product Information (معلومات المنتج)
     product_type = db.Column(db.String(50), nullable=False)  # phone, accessory, charger, etc.
@@ -280,13 +364,1015 @@ class SaleItem(db.Model):
     # Additional Fields
     notes = db.Column(db.Text)
 
+class VatReturn(db.Model):
+    """نموذج إقرار ضريبة القيمة المضافة - نتائج الفترات المغلقة (مجمدة)"""
+    id = db.Column(db.Integer, primary_key=True)
+    period_key = db.Column(db.String(10), unique=True, nullable=False)  # 2024-03 or 2024-Q1
+    period_start = db.Column(db.DateTime, nullable=False)
+    period_end = db.Column(db.DateTime, nullable=False)  # exclusive
+
+    # Output VAT (ضريبة المخرجات - المبيعات)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    sales_subtotal = db.Column(db.Float, nullable=False, default=0.0)
+    output_vat = db.Column(db.Float, nullable=False, default=0.0)
+
+    # Input VAT (ضريبة المدخلات - المشتريات)
+    purchases_count = db.Column(db.Integer, nullable=False, default=0)
+    purchases_subtotal = db.Column(db.Float, nullable=False, default=0.0)
+    input_vat = db.Column(db.Float, nullable=False, default=0.0)
+
+    net_vat = db.Column(db.Float, nullable=False, default=0.0)  # صافي الضريبة المستحقة
+    date_closed = db.Column(db.DateTime, default=datetime.utcnow)
+    closed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+class ProfitCube(db.Model):
+    """مكعب الأرباح - الإيرادات والتكلفة والكمية لكل شهر ونوع منتج وماركة/موديل أو فئة"""
+    __tablename__ = 'profit_cube'
+    __table_args__ = (db.UniqueConstraint('year', 'month', 'product_type', 'brand', 'model', 'category',
+                                          name='uq_profit_cube_cell'),)
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    product_type = db.Column(db.String(50), nullable=False)
+    brand = db.Column(db.String(100), nullable=False, default='')     # للهواتف
+    model = db.Column(db.String(100), nullable=False, default='')     # للهواتف
+    category = db.Column(db.String(100), nullable=False, default='')  # للأكسسوارات
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)  # قبل الضريبة
+    cost = db.Column(db.Float, nullable=False, default=0.0)     # قبل الضريبة
+
+class AggregateWatermark(db.Model):
+    """آخر صف مصدر أضيف إلى جدول تجميعي (مثل profit_cube)"""
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    date_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+class InventoryEvent(db.Model):
+    """حدث مخزون - تغيير في المخزون ينشر لجميع نقاط البيع عبر /events"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    kind = db.Column(db.String(30), nullable=False)  # phone_added, phone_sold, stock_changed...
+    payload = db.Column(db.Text, nullable=False)  # JSON
+
+class StockMovement(db.Model):
+    """حركة مخزون - سجل إضافة فقط لكل تغيير في كمية هاتف أو أكسسوار"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    product_type = db.Column(db.String(20), nullable=False)  # phone, accessory
+    product_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # receive, sell, adjust, return
+    quantity = db.Column(db.Integer, nullable=False)  # التغيير في الكمية (موجب أو سالب)
+    reference = db.Column(db.String(50))  # رقم الفاتورة...
+    user_id = db.Column(db.Integer)
+
+    __table_args__ = (db.Index('ix_stock_movement_product', 'product_type', 'product_id', 'created_at'),)
+
+class StockSnapshot(db.Model):
+    """لقطة مخزون - كمية كل منتج في وقت معين، نقطة بداية لحساب المخزون في أي تاريخ"""
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, index=True)
+    product_type = db.Column(db.String(20), nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+class TableVersion(db.Model):
+    """رقم إصدار الجدول - يزيد مع كل تعديل على الجدول ويستخدم لإبطال الذاكرة المؤقتة"""
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # Invoice model removed - invoices are now generated from Sale data
 
 
 
+# Login cache. Flask-Login loads the user on every authenticated request (AJAX
+# calls and barcode images included); a per-worker LRU of detached copies saves
+# that query. The copies are keyed on the version of the user table (User is one of
+# the VERSIONED_MODELS), which each worker re-reads at most every
+# USER_CACHE_CHECK_SECONDS - reading it on every request would cost the query the
+# cache saves. A role change or a deleted user therefore takes effect at once in the
+# worker that made it and within USER_CACHE_CHECK_SECONDS in the others.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 256))
+USER_CACHE_CHECK_SECONDS = float(os.environ.get('USER_CACHE_CHECK_SECONDS', 5))
+USER_CACHE_REQUESTS = Counter('user_cache_requests_total', 'Login user cache lookups', ['result'])
+
+class CachedUser(UserMixin):
+    """Detached copy of the User fields used by views and templates"""
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.is_admin = bool(user.is_admin)
+
+user_cache = OrderedDict()  # id -> (user table version, CachedUser)
+user_cache_lock = threading.Lock()
+user_version = [0, float('-inf')]  # [user table version, time.monotonic() it was read]
+
+def cached_user_version():
+    """The user table version, re-read at most every USER_CACHE_CHECK_SECONDS"""
+    now = time.monotonic()
+    with user_cache_lock:
+        if now - user_version[1] < USER_CACHE_CHECK_SECONDS and 'table_versions' not in g:
+            return user_version[0]
+    version = table_versions().get('user', 0)
+    with user_cache_lock:
+        user_version[:] = [version, now]
+    return version
+
+def forget_user_version():
+    """Make the next login lookup in this worker re-read the user table version"""
+    with user_cache_lock:
+        user_version[1] = float('-inf')
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    version = cached_user_version()
+    with user_cache_lock:
+        entry = user_cache.get(user_id)
+        if entry is not None and entry[0] == version:
+            user_cache.move_to_end(user_id)
+            USER_CACHE_REQUESTS.labels('hit').inc()
+            return entry[1]
+    USER_CACHE_REQUESTS.labels('miss').inc()
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    cached = CachedUser(user)
+    with user_cache_lock:
+        user_cache[user_id] = (version, cached)
+        user_cache.move_to_end(user_id)
+        while len(user_cache) > USER_CACHE_SIZE:
+            user_cache.popitem(last=False)
+    return cached
+
+def report_session():
+    """Session for read-only report queries (the 'reports' bind when configured)"""
+    if 'reports' not in app.config.get('SQLALCHEMY_BINDS', {}):
+        return db.session
+    if 'report_session' not in g:
+        g.report_session = Session(bind=db.engines['reports'])
+    return g.report_session
+
+@app.teardown_appcontext
+def close_report_session(exc):
+    session = g.pop('report_session', None)
+    if session is not None:
+        session.close()
+
+def pool_stats():
+    """Connection pool usage per engine ('default' is the main database)"""
+    stats = {}
+    for bind_key, engine in db.engines.items():
+        pool = engine.pool
+        pool_info = {'pool_class': type(pool).__name__, 'status': pool.status()}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if callable(getattr(pool, name, None)):
+                pool_info[name] = getattr(pool, name)()
+        stats[bind_key or 'default'] = pool_info
+    return stats
+
+# Request metrics (Prometheus). Under gunicorn set PROMETHEUS_MULTIPROC_DIR so
+# every worker writes its samples to that directory and /metrics sums them.
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request', ['endpoint', 'method'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+REQUEST_COUNT = Counter('http_requests_total', 'Requests handled', ['endpoint', 'method', 'status'])
+REQUEST_SQL_QUERIES = Histogram(
+    'http_request_sql_queries', 'SQL statements executed per request', ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 250, 1000))
+REQUEST_SQL_SECONDS = Histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per request', ['endpoint'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes', 'Response body size', ['endpoint'],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+LABEL_RENDER_SECONDS = Histogram(
+    'label_render_seconds', 'Time spent rendering barcodes, stickers and PDFs', ['kind'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Database pool connections per worker', ['bind', 'state'],
+    multiprocess_mode='livesum')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if has_app_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS and not executemany:
+        record_slow_query(conn, statement, parameters, elapsed)
+
+# Slow-query log (opt-in): statements slower than SLOW_QUERY_MS are kept with their
+# parameters, route and query plan in a per-worker ring buffer shown on /slow_queries.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))  # 0 = off
+slow_queries = deque(maxlen=int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100)))
+
+def explain_statement(conn, statement, parameters):
+    """Query plan of a SELECT, run through a raw cursor on the same connection"""
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif dialect == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '  # runs the query again - only ever for statements already logged as slow
+    else:
+        return None
+
+    cursor = conn.connection.cursor()
+    try:
+        # A failing EXPLAIN must not abort the request's Postgres transaction
+        if dialect == 'postgresql':
+            cursor.execute('SAVEPOINT explain_slow_query')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if dialect == 'postgresql':
+                cursor.execute('ROLLBACK TO SAVEPOINT explain_slow_query')
+            return f"EXPLAIN failed: {e}"
+        if dialect == 'postgresql':
+            cursor.execute('RELEASE SAVEPOINT explain_slow_query')
+            return '\n'.join(row[0] for row in rows)
+
+        # SQLite rows are (id, parent, notused, detail); indent children under their parent
+        depth = {0: -1}
+        lines = []
+        for node_id, parent_id, _, detail in rows:
+            depth[node_id] = depth.get(parent_id, -1) + 1
+            lines.append('  ' * depth[node_id] + detail)
+        return '\n'.join(lines)
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
+    finally:
+        cursor.close()
+
+def record_slow_query(conn, statement, parameters, elapsed):
+    route = (request.endpoint or request.path) if has_request_context() else 'background'
+    plan = None
+    if statement.lstrip().upper().startswith('SELECT'):
+        plan = explain_statement(conn, statement, parameters)
+    slow_queries.append({
+        'time': datetime.now(),
+        'route': route,
+        'duration_ms': elapsed * 1000,
+        'statement': statement,
+        'parameters': repr(parameters)[:1000],
+        'plan': plan,
+    })
+    print(f"Slow query ({elapsed * 1000:.1f}ms) in {route}: {' '.join(statement.split())[:200]}")
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses (CSV exports) are timed up to the first byte
+    if 'request_started' in g:
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - g.request_started)
+        REQUEST_COUNT.labels(endpoint, request.method, str(response.status_code)).inc()
+        REQUEST_SQL_QUERIES.labels(endpoint).observe(g.sql_queries)
+        REQUEST_SQL_SECONDS.labels(endpoint).observe(g.sql_seconds)
+        if response.content_length is not None:
+            RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+        update_pool_metrics()
+    return response
+
+def update_pool_metrics():
+    for bind, stats in pool_stats().items():
+        for state in ('checkedin', 'checkedout', 'overflow'):
+            if state in stats:
+                DB_POOL_CONNECTIONS.labels(bind, state).set(stats[state])
+
+# Request profiler (opt-in). An admin adds ?_profile=1 or an X-Profile header to a
+# request, or PROFILE_SAMPLE_RATE (0-1) profiles that share of all traffic. A thread
+# samples the request thread's call stack every PROFILE_INTERVAL_MS and the stacks
+# are saved to PROFILE_DIR, from where /profiles serves them as flamegraph files.
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 2))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+# Long-lived streams are never sampled - each would hold a profile for minutes and
+# crowd the short requests out of the PROFILE_KEEP saved ones
+PROFILE_UNSAMPLED_ENDPOINTS = ('inventory_events',)
+
+class StackSampler:
+    """Samples the call stack of one thread until stopped"""
+
+    def __init__(self, thread_id, interval_ms):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.frames = []  # [name, file, line]
+        self.frame_ids = {}
+        self.stacks = {}  # tuple of frame ids, outermost first -> [samples, milliseconds]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _frame_id(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        if key not in self.frame_ids:
+            self.frame_ids[key] = len(self.frames)
+            self.frames.append([code.co_name, short_source_path(code.co_filename), code.co_firstlineno])
+        return self.frame_ids[key]
+
+    def _run(self):
+        # Samples are weighted by the time since the previous one, since the sampler
+        # wakes less often than asked while the request thread holds the GIL
+        last = self.started
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_id(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                entry = self.stacks.setdefault(tuple(reversed(stack)), [0, 0.0])
+                entry[0] += 1
+                entry[1] += (now - last) * 1000
+            last = now
+
+def short_source_path(path):
+    """Source path relative to the app, site-packages or the standard library"""
+    if path.startswith(app.root_path):
+        return os.path.relpath(path, app.root_path)
+    marker = f'{os.sep}site-packages{os.sep}'
+    if marker in path:
+        return path.split(marker, 1)[1]
+    stdlib = sysconfig.get_paths()['stdlib']
+    if path.startswith(stdlib):
+        return os.path.relpath(path, stdlib)
+    return path
+
+@app.before_request
+def start_profiler():
+    if request.endpoint in ('static', 'profiles_page', 'download_profile', 'clear_profiles'):
+        return
+    if request.args.get('_profile') or request.headers.get('X-Profile'):
+        if not (current_user.is_authenticated and current_user.is_admin):
+            return
+        trigger = 'requested'
+    elif PROFILE_SAMPLE_RATE and request.endpoint not in PROFILE_UNSAMPLED_ENDPOINTS and random.random() < PROFILE_SAMPLE_RATE:
+        trigger = 'sampled'
+    else:
+        return
+    g.profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS)
+    g.profile_trigger = trigger
+    g.profiler.start()
+
+@app.after_request
+def finish_profiler(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    meta = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint or 'unmatched',
+        'status': response.status_code,
+        'sql_queries': g.get('sql_queries'),
+        'sql_ms': round(g.get('sql_seconds', 0.0) * 1000, 1),
+        'user': current_user.username if current_user.is_authenticated else None,
+        'trigger': g.profile_trigger,
+        'pid': os.getpid(),
+    }
+    # Stopped when the body has been sent, so streamed responses are profiled to the end
+    response.call_on_close(lambda: save_profile(profiler, meta))
+    return response
+
+def save_profile(profiler, meta):
+    profiler.stop()
+    profile_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.urandom(4).hex()}"
+    profile = dict(meta, id=profile_id,
+                   duration_ms=round(profiler.duration * 1000, 1),
+                   interval_ms=PROFILE_INTERVAL_MS,
+                   samples=sum(count for count, _ in profiler.stacks.values()),
+                   frames=profiler.frames,
+                   stacks=[[list(stack), count, round(ms, 3)] for stack, (count, ms) in profiler.stacks.items()])
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'), 'w') as f:
+            json.dump(profile, f)
+        for old_file in sorted(os.listdir(PROFILE_DIR))[:-PROFILE_KEEP]:
+            os.remove(os.path.join(PROFILE_DIR, old_file))
+    except OSError as e:
+        print(f"Error saving profile: {e}")
+        return
+    print(f"Profiled {meta['method']} {meta['path']}: {profile['duration_ms']}ms, {profile['samples']} samples ({profile_id})")
+
+def load_profile(profile_id):
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.json')) as f:
+        return json.load(f)
+
+def profile_to_folded(profile):
+    """Collapsed stacks ("a;b;c count" per line) for flamegraph.pl, speedscope or inferno"""
+    frames = profile['frames']
+    lines = []
+    for stack, count, _ in profile['stacks']:
+        names = (f"{frames[i][0]} ({frames[i][1]}:{frames[i][2]})".replace(';', ',') for i in stack)
+        lines.append(f"{';'.join(names)} {count}")
+    return '\n'.join(sorted(lines)) + '\n'
+
+def profile_to_speedscope(profile):
+    """Speedscope sampled profile (https://www.speedscope.app/file-format-schema.json)"""
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': f"{profile['method']} {profile['path']}",
+        'exporter': 'alsaqri request profiler',
+        'activeProfileIndex': 0,
+        'shared': {'frames': [{'name': name, 'file': path, 'line': line} for name, path, line in profile['frames']]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': f"{profile['endpoint']} ({profile['time']})",
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(ms for _, _, ms in profile['stacks']),
+            'samples': [stack for stack, _, _ in profile['stacks']],
+            'weights': [ms for _, _, ms in profile['stacks']],
+        }],
+    }
+
+# Response compression and conditional GET. Text responses of at least
+# COMPRESS_MIN_SIZE bytes are sent gzip (or brotli, when the optional brotli
+# package is installed) encoded; read-only pages and JSON endpoints get an ETag
+# so an unchanged page costs a 304 instead of the whole body.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/plain', 'text/csv', 'text/css', 'text/javascript',
+                          'application/json', 'application/javascript', 'image/svg+xml'}
+CONDITIONAL_GET_ENDPOINTS = {
+    'dashboard', 'limited_dashboard', 'list_accessories', 'sold_phones', 'search',
+    'inventory_summary', 'list_sales', 'view_sale', 'create_sale_page', 'vat_returns',
+    'get_phone_types_ajax', 'get_accessory_categories_ajax',
+}
+
+try:
+    import brotli
+except ImportError:  # optional - gzip only
+    brotli = None
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+def negotiate_encoding():
+    """Best content coding the client accepts, or None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality('br') > 0:
+        return 'br'
+    if accepted.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    if (request.method == 'GET' and request.endpoint in CONDITIONAL_GET_ENDPOINTS
+            and response.status_code == 200):
+        # Weak: the same page is sent with different content codings
+        if not response.get_etag()[0]:  # catalog_response() tags with the table version
+            response.add_etag(weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True  # always revalidate - stock changes all day
+        response.make_conditional(request)
+
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < COMPRESS_MIN_SIZE):
+        return response
+    encoding = negotiate_encoding()
+    if encoding:
+        response.set_data(compress_body(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# Fragment cache. Rendered table HTML is kept per worker and reused until the
+# version of one of its tables changes. Versions live in the table_version table,
+# so a write in any worker invalidates every worker's copy. Inserts, updates and
+# deletes of the versioned models mark their table on the session and each marked
+# table is bumped once per flush, in the same transaction as the write.
+VERSIONED_MODELS = (User, Phone, PhoneHistory, PhoneType, Accessory, AccessoryCategory, Sale)
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+
+FRAGMENT_CACHE_REQUESTS = Counter('fragment_cache_requests_total', 'Fragment cache lookups', ['fragment', 'result'])
+FRAGMENT_CACHE_SIZE = Gauge('fragment_cache_bytes', 'Rendered HTML held in the fragment cache',
+                            multiprocess_mode='livesum')
+
+def mark_table_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_tables', set()).add(mapper.local_table.name)
+
+for versioned_model in VERSIONED_MODELS:
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(versioned_model, event_name, mark_table_changed)
+
+def touch_tables(connection, table_names):
+    """Bump the version of each table (for writes that bypass the ORM events, e.g. bulk inserts)"""
+    versions = TableVersion.__table__
+    for table_name in sorted(table_names):  # fixed order - concurrent writers lock the rows alike
+        result = connection.execute(
+            update(versions).where(versions.c.table_name == table_name)
+            .values(version=versions.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(insert(versions).values(table_name=table_name, version=1))
+    if has_app_context():
+        g.pop('table_versions', None)
+    if 'user' in table_names:
+        forget_user_version()
+
+@event.listens_for(Session, 'after_flush')
+def bump_table_versions(session, flush_context):
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        touch_tables(session.connection(), changed)
+
+def table_versions():
+    """Current version of every table, read once per request"""
+    if 'table_versions' not in g:
+        g.table_versions = dict(db.session.query(TableVersion.table_name, TableVersion.version).all())
+    return g.table_versions
+
+class FragmentCache:
+    """LRU of rendered fragments, bounded by the total size of the HTML"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (versions, html, size)
+        self.lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != versions:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, versions, html):
+        size = len(html.encode('utf-8'))
+        with self.lock:
+            old = self.entries.pop(key, None)  # a stale version of the same fragment
+            if old is not None:
+                self.size -= old[2]
+            if size <= self.max_bytes:
+                self.entries[key] = (versions, html, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+            FRAGMENT_CACHE_SIZE.set(self.size)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            FRAGMENT_CACHE_SIZE.set(0)
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+def cached_fragment(name, models, render, *key_parts):
+    """HTML from render() for the current versions of the models' tables, rendered only on a miss"""
+    current = table_versions()
+    versions = tuple(current.get(model.__tablename__, 0) for model in models)
+    key = (name,) + key_parts
+    html = fragment_cache.get(key, versions)
+    if html is not None:
+        FRAGMENT_CACHE_REQUESTS.labels(name, 'hit').inc()
+        return Markup(html)
+    FRAGMENT_CACHE_REQUESTS.labels(name, 'miss').inc()
+    html = render()
+    fragment_cache.put(key, versions, html)
+    return Markup(html)
+
+# Product catalogs. Phone types and accessory categories change a few times a year
+# but every phone, accessory and sale form reads them. Each worker keeps them per
+# table version - the stamps of the fragment cache, bumped by the add/delete AJAX
+# routes - and the catalog AJAX endpoints send that version as their ETag, so a
+# browser revalidating an unchanged catalog gets a 304.
+CatalogCategory = namedtuple('CatalogCategory', 'name arabic_name')
+_catalogs = {}
+
+def cached_catalog(name, model, build):
+    """(version, value) of a catalog; build() runs only when the model's table version changed"""
+    version = table_versions().get(model.__tablename__, 0)
+    cached = _catalogs.get(name)
+    if cached is None or cached[0] != version:
+        cached = (version, build())
+        _catalogs[name] = cached
+    return cached
+
+def phone_catalog():
+    """{brand: [models]} of all phone types (shared - don't modify)"""
+    def build():
+        brands = {}
+        for brand, model in db.session.query(PhoneType.brand, PhoneType.model).order_by(PhoneType.id):
+            brands.setdefault(brand, []).append(model)
+        return brands
+    return cached_catalog('phone_types', PhoneType, build)[1]
+
+def accessory_category_catalog():
+    """All accessory categories as (name, arabic_name) tuples"""
+    return cached_catalog('accessory_categories', AccessoryCategory, lambda: [
+        CatalogCategory(name, arabic_name) for name, arabic_name in
+        db.session.query(AccessoryCategory.name, AccessoryCategory.arabic_name).order_by(AccessoryCategory.id)])[1]
+
+def catalog_response(name, model, build):
+    """JSON of build() tagged with the model's table version (see compress_response for the 304)"""
+    version, body = cached_catalog(f'{name}.json', model, lambda: json.dumps(build()))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(f'{name}-{version}', weak=True)
+    return response
+
+# Live inventory. Phone and accessory changes are queued on the session and written
+# to inventory_event in the same flush, so only committed changes are published.
+# The table doubles as the pub/sub channel between gunicorn workers: one broker
+# thread per worker polls it and fans new rows out to the worker's /events streams.
+# Rows are published once they are EVENTS_SETTLE_SECONDS old: on Postgres, ids come
+# from a sequence and a transaction can commit after one holding a higher id, so
+# reading right up to the newest id would step over it for good - which is also
+# why pages hand /events the settled id as their starting point. Each stream holds
+# a server thread, so a worker serves at most EVENTS_MAX_STREAMS of them
+# (gunicorn.conf.py sizes it from the worker's threads). A terminal beyond that is
+# told to retry in EVENTS_BUSY_RETRY_MS, and with none at all (sync workers) the
+# pages work without live updates.
+EVENTS_POLL_SECONDS = float(os.environ.get('EVENTS_POLL_SECONDS', 1))
+EVENTS_SETTLE_SECONDS = float(os.environ.get('EVENTS_SETTLE_SECONDS', 2))
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 20))
+EVENTS_BUSY_RETRY_MS = 30000
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_STREAM_SECONDS = int(os.environ.get('EVENTS_STREAM_SECONDS', 300))  # browsers reconnect and resume
+EVENTS_RETENTION = timedelta(days=1)
+
+def phone_sale_data(phone):
+    """Phone as listed on the create_sale page"""
+    return {
+        'id': phone.id,
+        'brand': phone.brand,
+        'model': phone.model,
+        'serial_number': phone.serial_number,
+        'phone_number': phone.phone_number,
+        'selling_price': phone.selling_price_with_vat,  # Use price with VAT
+        'description': phone.description or ''
+    }
+
+def accessory_sale_data(accessory):
+    """Accessory as listed on the create_sale page"""
+    return {
+        'id': accessory.id,
+        'name': accessory.name,
+        'category': accessory.category,
+        'description': accessory.description or '',
+        'barcode': accessory.barcode or '',
+        'selling_price': accessory.selling_price_with_vat,  # Use price with VAT
+        'quantity_in_stock': accessory.quantity_in_stock
+    }
+
+def queue_inventory_event(target, kind, payload):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('inventory_events', []).append((kind, payload))
+
+def previous_value(target, attribute):
+    history = inspect(target).attrs[attribute].history
+    return history.deleted[0] if history.deleted else getattr(target, attribute)
+
+@event.listens_for(Phone, 'after_insert')
+def phone_inserted(mapper, connection, phone):
+    if phone.status == 'available':
+        queue_inventory_event(phone, 'phone_added', {'phone': phone_sale_data(phone), 'phones_delta': 1})
+
+@event.listens_for(Phone, 'after_update')
+def phone_updated(mapper, connection, phone):
+    was_available = previous_value(phone, 'status') == 'available'
+    if phone.status == 'available':
+        queue_inventory_event(phone, 'phone_added', {'phone': phone_sale_data(phone), 'phones_delta': 0 if was_available else 1})
+    elif was_available:
+        kind = 'phone_sold' if phone.status == 'sold' else 'phone_removed'
+        queue_inventory_event(phone, kind, {'phone_id': phone.id, 'phones_delta': -1})
+
+@event.listens_for(Phone, 'after_delete')
+def phone_deleted(mapper, connection, phone):
+    if phone.status == 'available':
+        queue_inventory_event(phone, 'phone_removed', {'phone_id': phone.id, 'phones_delta': -1})
+
+@event.listens_for(Accessory, 'after_insert')
+def accessory_inserted(mapper, connection, accessory):
+    queue_inventory_event(accessory, 'accessory_added',
+                          {'accessory': accessory_sale_data(accessory), 'units_delta': accessory.quantity_in_stock})
+
+@event.listens_for(Accessory, 'after_update')
+def accessory_updated(mapper, connection, accessory):
+    units_delta = accessory.quantity_in_stock - previous_value(accessory, 'quantity_in_stock')
+    queue_inventory_event(accessory, 'stock_changed',
+                          {'accessory': accessory_sale_data(accessory), 'units_delta': units_delta})
+
+@event.listens_for(Accessory, 'after_delete')
+def accessory_deleted(mapper, connection, accessory):
+    queue_inventory_event(accessory, 'accessory_removed',
+                          {'accessory_id': accessory.id, 'units_delta': -accessory.quantity_in_stock})
+
+@event.listens_for(Session, 'after_flush')
+def write_inventory_events(session, flush_context):
+    events = session.info.pop('inventory_events', None)
+    if events:
+        now = datetime.utcnow()
+        session.connection().execute(insert(InventoryEvent.__table__), [
+            {'created_at': now, 'kind': kind, 'payload': json.dumps(payload)} for kind, payload in events])
+
+@event.listens_for(Session, 'after_rollback')
+def discard_inventory_events(session):
+    session.info.pop('inventory_events', None)
+
+def settled_inventory_event_id():
+    """Newest id the broker can start after without stepping over a transaction still committing"""
+    settled_before = datetime.utcnow() - timedelta(seconds=EVENTS_SETTLE_SECONDS)
+    return db.session.query(func.max(InventoryEvent.id)).filter(InventoryEvent.created_at <= settled_before).scalar() or 0
+
+def inventory_event_ids_after(last_id):
+    """Ids of the events after last_id committed so far, settled or not"""
+    return [event_id for (event_id,) in db.session.query(InventoryEvent.id).filter(InventoryEvent.id > last_id)]
+
+def inventory_events_after(last_id, limit=500):
+    """Settled events after last_id, oldest first"""
+    settled_before = datetime.utcnow() - timedelta(seconds=EVENTS_SETTLE_SECONDS)
+    rows = (db.session.query(InventoryEvent.id, InventoryEvent.kind, InventoryEvent.payload)
+            .filter(InventoryEvent.id > last_id, InventoryEvent.created_at <= settled_before)
+            .order_by(InventoryEvent.id).limit(limit).all())
+    return [{'id': row.id, 'kind': row.kind, **json.loads(row.payload)} for row in rows]
+
+class InventoryBroker:
+    """Polls inventory_event and hands new events to this worker's subscribers"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, limit):
+        """Queue of new events, or None when this worker already serves `limit` streams"""
+        subscriber = queue.Queue(maxsize=1000)
+        with self.lock:
+            if len(self.subscribers) >= limit:
+                return None
+            self.subscribers.add(subscriber)
+            if self.thread is None:  # started lazily so it runs in the worker, not the gunicorn master
+                self.thread = threading.Thread(target=self._run, name='inventory-broker', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _run(self):
+        with app.app_context():
+            last_id = settled_inventory_event_id()
+            last_prune = 0.0
+            while True:
+                time.sleep(self.interval)
+                try:
+                    events = inventory_events_after(last_id)
+                    if time.monotonic() - last_prune > 3600:
+                        # The newest row read is kept, so SQLite never hands out its id again
+                        InventoryEvent.query.filter(
+                            InventoryEvent.created_at < datetime.utcnow() - EVENTS_RETENTION,
+                            InventoryEvent.id < last_id).delete()
+                        db.session.commit()
+                        last_prune = time.monotonic()
+                except Exception as e:
+                    print(f"Error polling inventory events: {e}")
+                    db.session.rollback()
+                    continue
+                finally:
+                    db.session.remove()  # do not hold a pooled connection between polls
+                if not events:
+                    continue
+                last_id = events[-1]['id']
+                with self.lock:
+                    subscribers = list(self.subscribers)
+                for subscriber in subscribers:
+                    for inventory_event in events:
+                        try:
+                            subscriber.put_nowait(inventory_event)
+                        except queue.Full:  # stalled client - end its stream, it resumes from Last-Event-ID
+                            self.unsubscribe(subscriber)
+                            with subscriber.mutex:
+                                subscriber.queue.clear()
+                            subscriber.put_nowait(None)
+                            break
+
+inventory_broker = InventoryBroker(EVENTS_POLL_SECONDS)
+
+# Stock ledger. Every change to the stock of a phone (0 or 1) or an accessory also
+# appends a signed stock_movement row in the same flush - receive, sell, adjust or
+# return - and the rows are never updated. Routes name the reason for their changes
+# with stock_reason(); other quantity edits are adjustments. `flask --app app
+# stock-snapshot`, run daily from cron, records the balances, so the stock on a date
+# is the latest snapshot before it plus a short scan of the movements since, and
+# `flask --app app reconcile-stock` checks the ledger against the live quantities.
+# Snapshots stop STOCK_SNAPSHOT_SETTLE_SECONDS back so that movements written by
+# transactions still in flight are not left out of them.
+STOCK_SNAPSHOT_SETTLE_SECONDS = int(os.environ.get('STOCK_SNAPSHOT_SETTLE_SECONDS', 60))
+STOCK_MOVEMENT_KINDS = ('receive', 'sell', 'adjust', 'return')
+
+def stock_reason(kind, reference=None):
+    """Book the stock changes of the current transaction as `kind`, e.g. ('sell', invoice number)"""
+    if kind not in STOCK_MOVEMENT_KINDS:
+        raise ValueError(f'Unknown stock movement kind: {kind}')
+    db.session.info['stock_reason'] = (kind, reference)
+
+def queue_stock_movement(target, product_type, quantity, kind=None):
+    session = object_session(target)
+    if session is None or not quantity:
+        return
+    reason, reference = session.info.get('stock_reason', (None, None))
+    user_id = current_user.get_id() if has_request_context() and current_user.is_authenticated else None
+    session.info.setdefault('stock_movements', []).append({
+        'product_type': product_type,
+        'product_id': target.id,
+        'kind': kind or reason or 'adjust',
+        'quantity': quantity,
+        'reference': reference,
+        'user_id': int(user_id) if user_id else None,
+    })
+
+@event.listens_for(Phone, 'after_insert')
+def phone_received(mapper, connection, phone):
+    if phone.status == 'available':
+        queue_stock_movement(phone, 'phone', 1, 'receive')
+
+@event.listens_for(Phone, 'after_update')
+def phone_stock_changed(mapper, connection, phone):
+    was_available = previous_value(phone, 'status') == 'available'
+    if phone.status == 'available' and not was_available:
+        queue_stock_movement(phone, 'phone', 1, 'return')
+    elif was_available and phone.status != 'available':
+        queue_stock_movement(phone, 'phone', -1, 'sell' if phone.status == 'sold' else 'adjust')
+
+@event.listens_for(Phone, 'after_delete')
+def phone_written_off(mapper, connection, phone):
+    if phone.status == 'available':
+        queue_stock_movement(phone, 'phone', -1, 'adjust')
+
+@event.listens_for(Accessory, 'after_insert')
+def accessory_received(mapper, connection, accessory):
+    queue_stock_movement(accessory, 'accessory', accessory.quantity_in_stock, 'receive')
+
+@event.listens_for(Accessory, 'after_update')
+def accessory_stock_changed(mapper, connection, accessory):
+    queue_stock_movement(accessory, 'accessory',
+                         accessory.quantity_in_stock - previous_value(accessory, 'quantity_in_stock'))
+
+@event.listens_for(Accessory, 'after_delete')
+def accessory_written_off(mapper, connection, accessory):
+    queue_stock_movement(accessory, 'accessory', -accessory.quantity_in_stock, 'adjust')
+
+@event.listens_for(Session, 'after_flush')
+def write_stock_movements(session, flush_context):
+    movements = session.info.pop('stock_movements', None)
+    if movements:
+        now = datetime.utcnow()
+        session.connection().execute(insert(StockMovement.__table__),
+                                     [{'created_at': now, **movement} for movement in movements])
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def reset_stock_reason(session):
+    session.info.pop('stock_reason', None)
+    session.info.pop('stock_movements', None)
+
+def live_stock():
+    """Current stock per (product_type, product_id) from the phone and accessory tables"""
+    stock = {('phone', phone_id): 1
+             for (phone_id,) in db.session.query(Phone.id).filter(Phone.status == 'available')}
+    stock.update((('accessory', accessory_id), quantity) for accessory_id, quantity in
+                 db.session.query(Accessory.id, Accessory.quantity_in_stock).filter(Accessory.quantity_in_stock != 0))
+    return stock
+
+def stock_on(when, product_type=None, product_id=None):
+    """Stock per (product_type, product_id) at `when`: the latest snapshot taken by then plus the movements since"""
+    taken_at = db.session.query(func.max(StockSnapshot.taken_at)).filter(StockSnapshot.taken_at <= when).scalar()
+    snapshot = db.session.query(StockSnapshot.product_type, StockSnapshot.product_id, StockSnapshot.quantity) \
+        .filter(StockSnapshot.taken_at == taken_at)
+    movements = db.session.query(StockMovement.product_type, StockMovement.product_id, func.sum(StockMovement.quantity)) \
+        .filter(StockMovement.created_at <= when)
+    if taken_at is not None:
+        movements = movements.filter(StockMovement.created_at > taken_at)
+    if product_type:
+        snapshot = snapshot.filter(StockSnapshot.product_type == product_type)
+        movements = movements.filter(StockMovement.product_type == product_type)
+    if product_id is not None:
+        snapshot = snapshot.filter(StockSnapshot.product_id == product_id)
+        movements = movements.filter(StockMovement.product_id == product_id)
+
+    stock = {}
+    if taken_at is not None:
+        stock.update(((row_type, row_id), quantity) for row_type, row_id, quantity in snapshot)
+    for row_type, row_id, quantity in movements.group_by(StockMovement.product_type, StockMovement.product_id):
+        stock[(row_type, row_id)] = stock.get((row_type, row_id), 0) + quantity
+    return {key: quantity for key, quantity in stock.items() if quantity}
+
+def take_stock_snapshot():
+    """Record the ledger balances as of STOCK_SNAPSHOT_SETTLE_SECONDS ago; returns (taken_at, rows written).
+
+    The first snapshot records the live quantities instead, as the opening balances
+    of stock that was there before the ledger."""
+    last_taken_at = db.session.query(func.max(StockSnapshot.taken_at)).scalar()
+    if last_taken_at is None:
+        taken_at, stock = datetime.utcnow(), live_stock()
+    else:
+        taken_at = datetime.utcnow() - timedelta(seconds=STOCK_SNAPSHOT_SETTLE_SECONDS)
+        if taken_at <= last_taken_at:
+            return last_taken_at, 0
+        stock = stock_on(taken_at)
+    rows = [{'taken_at': taken_at, 'product_type': row_type, 'product_id': row_id, 'quantity': quantity}
+            for (row_type, row_id), quantity in sorted(stock.items())]
+    try:
+        if rows:
+            db.session.execute(insert(StockSnapshot.__table__), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return taken_at, len(rows)
+
+def reconcile_stock(fix=False):
+    """(product_type, product_id, ledger, actual) wherever the ledger disagrees with the live quantities.
+
+    With fix the differences are booked as 'adjust' movements, so the ledger matches again."""
+    ledger, actual = stock_on(datetime.utcnow()), live_stock()
+    differences = [(row_type, row_id, ledger.get((row_type, row_id), 0), actual.get((row_type, row_id), 0))
+                   for row_type, row_id in sorted(set(ledger) | set(actual))
+                   if ledger.get((row_type, row_id), 0) != actual.get((row_type, row_id), 0)]
+    if fix and differences:
+        now = datetime.utcnow()
+        try:
+            db.session.execute(insert(StockMovement.__table__), [
+                {'created_at': now, 'product_type': row_type, 'product_id': row_id, 'kind': 'adjust',
+                 'quantity': quantity - booked, 'reference': 'reconcile'}
+                for row_type, row_id, booked, quantity in differences])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return differences
+
+@app.cli.command('stock-snapshot')
+def stock_snapshot_command():
+    """Record the stock balances for stock-on-date lookups - run daily from cron."""
+    taken_at, rows = take_stock_snapshot()
+    print(f"Stock snapshot at {taken_at:%Y-%m-%d %H:%M:%S}: {rows} products in stock")
+
+@app.cli.command('stock-on')
+@click.argument('when', type=click.DateTime(formats=['%Y-%m-%d', '%Y-%m-%d %H:%M']))
+@click.option('--accessory-id', type=int, help='Only this accessory.')
+def stock_on_command(when, accessory_id):
+    """Print the stock at a past date (UTC) from the snapshots and the movement ledger."""
+    if accessory_id is not None:
+        quantity = stock_on(when, 'accessory', accessory_id).get(('accessory', accessory_id), 0)
+        print(f"Accessory {accessory_id} on {when:%Y-%m-%d %H:%M}: {quantity} in stock")
+        return
+    stock = stock_on(when)
+    phones = sum(quantity for (row_type, _), quantity in stock.items() if row_type == 'phone')
+    units = sum(quantity for (row_type, _), quantity in stock.items() if row_type == 'accessory')
+    print(f"Stock on {when:%Y-%m-%d %H:%M}: {phones} phones, {units} accessory units")
+
+@app.cli.command('reconcile-stock')
+@click.option('--fix', is_flag=True, help='Book the differences as adjust movements.')
+def reconcile_stock_command(fix):
+    """Compare the movement ledger with the current quantities - run daily from cron, exits 1 on differences."""
+    differences = reconcile_stock(fix)
+    print(f"Stock reconciliation {datetime.now():%Y-%m-%d}: {len(differences)} products differ from the ledger")
+    for row_type, row_id, booked, quantity in differences:
+        print(f"  {row_type} {row_id}: ledger {booked}, actual {quantity}")
+    if differences:
+        if fix:
+            print("Differences booked as adjust movements")
+        else:
+            raise SystemExit(1)
 
 # Database initialization functions
 def create_admin_user():
@@ -490,20 +1576,82 @@ def add_common_accessory_categories():
 
 
 
+# Foreign keys a model stopped declaring, dropped by name by init-db (the names
+# Postgres gave them). Any other constraint a model does not declare is left alone.
+RETIRED_FOREIGN_KEYS = {
+    'transaction': ('transaction_phone_id_fkey',),  # the phone may have moved to phone_history
+}
+
+def ensure_schema():
+    """Create missing tables, then add the columns and indexes models gained after their table was created
+    and drop the RETIRED_FOREIGN_KEYS"""
+    from sqlalchemy import inspect
+    db.create_all()
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.quote(column.name)} {column_type}"))
+                print(f"Added column {table.name}.{column.name}")
+        retired = RETIRED_FOREIGN_KEYS.get(table.name)
+        if retired and db.engine.dialect.name != 'sqlite':  # SQLite can't drop constraints (nor enforces them by default)
+            for foreign_key in inspector.get_foreign_keys(table.name):
+                if foreign_key['name'] in retired:
+                    with db.engine.begin() as conn:
+                        conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} DROP CONSTRAINT {preparer.quote(foreign_key['name'])}"))
+                    print(f"Dropped foreign key {table.name}.{foreign_key['name']}")
+        for index in table.indexes:
+            if index.info.get('dialect', db.engine.dialect.name) != db.engine.dialect.name:
+                continue  # e.g. the Postgres-only text_pattern_ops indexes
+            # IF NOT EXISTS rather than checkfirst: reflection does not report expression indexes
+            with db.engine.begin() as conn:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+INIT_LOCK_KEY = 7305501  # pg_advisory_lock key for init-db
+
+@contextmanager
+def database_init_lock():
+    """Serialize schema and seed work between processes that start at the same time"""
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': INIT_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': INIT_LOCK_KEY})
+        return
+
+    try:
+        import fcntl
+    except ImportError:  # Windows development machine - nothing else runs init-db there
+        yield
+        return
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, 'init-db.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 def initialize_database():
     """Initialize database with proper error handling"""
     try:
-        # Check if tables exist by trying to query
-        User.query.first()
-        print("Database tables already exist!")
-    except Exception:
-        print("Creating database tables...")
-        try:
-            db.create_all()
-            print("Database tables created successfully!")
-        except Exception as e:
-            print(f"Error creating tables: {e}")
-            return False
+        ensure_schema()
+        print("Database schema is up to date!")
+        filled = backfill_customer_keys()
+        if filled:
+            print(f"Filled the customer lookup keys of {filled} rows")
+        filled = backfill_serial_reversed()
+        if filled:
+            print(f"Filled serial_reversed of {filled} phones")
+    except Exception as e:
+        print(f"Error creating tables: {e}")
+        return False
     
     # Create admin user
     create_admin_user()
@@ -515,11 +1663,124 @@ def initialize_database():
     add_common_accessory_categories()
     return True
 
-# Initialize database on app startup
-with app.app_context():
-    initialize_database()
-
-# Create limited user if not exists
+# Schema creation and seeding run once per deploy (`flask --app app init-db`,
+# the release step), not in every gunicorn worker on import.
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the schema and seed default users, phone types and categories."""
+    with database_init_lock():
+        if not initialize_database():
+            raise SystemExit(1)
+
+def low_stock_accessories(limit=None):
+    """Accessories at or below their minimum quantity, shortest first (served by ix_accessory_stock_margin)"""
+    query = Accessory.query.filter(stock_margin() <= 0).order_by(stock_margin(), Accessory.name)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def low_stock_item(accessory):
+    return {
+        'id': accessory.id,
+        'name': accessory.name,
+        'category': accessory.category,
+        'barcode': accessory.barcode,
+        'quantity_in_stock': accessory.quantity_in_stock,
+        'min_quantity': accessory.min_quantity if accessory.min_quantity is not None else DEFAULT_MIN_QUANTITY,
+        'supplier': accessory.supplier,
+    }
+
+LOW_STOCK_WIDGET_ROWS = 10
+
+def render_low_stock_widget():
+    """Dashboard card listing the shortest LOW_STOCK_WIDGET_ROWS low-stock accessories"""
+    def render():
+        count = Accessory.query.filter(stock_margin() <= 0).count()
+        return render_template('partials/low_stock.html',
+                               low_stock=low_stock_accessories(limit=LOW_STOCK_WIDGET_ROWS) if count else [],
+                               low_stock_count=count)
+    return cached_fragment('low_stock', (Accessory,), render)
+
+@app.cli.command('low-stock-digest')
+@click.option('--webhook', envvar='LOW_STOCK_WEBHOOK_URL', help='POST the digest as JSON to this URL (default: $LOW_STOCK_WEBHOOK_URL).')
+def low_stock_digest_command(webhook):
+    """Print the accessories at or below their minimum quantity - run daily from cron."""
+    items = [low_stock_item(accessory) for accessory in low_stock_accessories()]
+    print(f"Low stock digest {datetime.now():%Y-%m-%d}: {len(items)} accessories at or below their minimum")
+    for item in items:
+        print(f"  {item['name']} ({item['barcode']}): {item['quantity_in_stock']} in stock, minimum {item['min_quantity']}"
+              f"{' - ' + item['supplier'] if item['supplier'] else ''}")
+    if webhook and items:
+        payload = json.dumps({'date': datetime.now().strftime('%Y-%m-%d'), 'count': len(items), 'items': items}).encode('utf-8')
+        webhook_request = urllib.request.Request(webhook, data=payload, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(webhook_request, timeout=30) as response:
+                print(f"Digest sent to webhook ({response.status})")
+        except OSError as e:
+            print(f"Error sending digest to webhook: {e}")
+            raise SystemExit(1)
+
+# Sold-phone archive. Sold phones stay in the phone table (and on the sold phones
+# page) for ARCHIVE_SOLD_AFTER_DAYS, then `flask --app app archive-phones`, run daily
+# from cron, moves them to phone_history under the same id. The phone table - which
+# the dashboards, the sale page and search scan for available stock - then only
+# holds current stock and recent sales. Lookups by phone number or serial fall
+# back to the archive, and sold_phone_rows() reads both tables.
+ARCHIVE_SOLD_AFTER_DAYS = int(os.environ.get('ARCHIVE_SOLD_AFTER_DAYS', 30))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+
+def archive_sold_phones(sold_before, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the phones sold before `sold_before` to phone_history, one transaction per batch; returns the count"""
+    phones, history = Phone.__table__, PhoneHistory.__table__
+    columns = [column.name for column in phones.columns]
+    candidates = select(phones.c.id).where(phones.c.status == 'sold', phones.c.sold_date < sold_before)
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite gives a new row max(id) + 1 - keep the newest row so archived ids are never handed out again
+        candidates = candidates.where(phones.c.id < select(func.max(phones.c.id)).scalar_subquery())
+    moved = 0
+    while True:
+        ids = db.session.execute(candidates.order_by(phones.c.id).limit(batch_size)).scalars().all()
+        if not ids:
+            return moved
+        try:
+            db.session.execute(insert(history).from_select(
+                columns + ['archived_at'],
+                select(*[phones.c[name] for name in columns], literal(datetime.utcnow(), db.DateTime))
+                .where(phones.c.id.in_(ids))))
+            db.session.execute(phones.delete().where(phones.c.id.in_(ids)))
+            touch_tables(db.session.connection(), ['phone', 'phone_history'])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(ids)
+
+@app.cli.command('archive-phones')
+@click.option('--days', type=int, default=ARCHIVE_SOLD_AFTER_DAYS, show_default=True,
+              help='Archive the phones sold more than this many days ago.')
+def archive_phones_command(days):
+    """Move phones sold more than --days ago from phone to phone_history - run daily from cron."""
+    sold_before = datetime.utcnow() - timedelta(days=days)
+    moved = archive_sold_phones(sold_before)
+    print(f"Archived {moved} phones sold before {sold_before:%Y-%m-%d}")
+
+def find_phone(phone_number):
+    """Phone in stock or in the archive with this phone number, or None"""
+    return (Phone.query.filter_by(phone_number=phone_number).first()
+            or PhoneHistory.query.filter_by(phone_number=phone_number).first())
+
+def serial_numbers_in_use(serial_numbers):
+    """The given serial numbers that are already recorded, in stock or archived"""
+    return {serial for model in (Phone, PhoneHistory)
+            for (serial,) in db.session.query(model.serial_number).filter(model.serial_number.in_(serial_numbers))}
+
+def sold_phone_rows(session=None):
+    """Recently sold phones and the archive as one list, newest sale first"""
+    columns = [column.name for column in PhoneHistory.__table__.columns if column.name != 'archived_at']
+    sold = union_all(
+        select(*[Phone.__table__.c[name] for name in columns]).where(Phone.status == 'sold'),
+        select(*[PhoneHistory.__table__.c[name] for name in columns])).subquery('sold_phone')
+    return (session or db.session).execute(select(sold).order_by(sold.c.sold_date.desc())).all()
 
 # Routes
 @app.route('/')
@@ -542,7 +1803,6 @@ def health_check():
     """Health check endpoint for online deployment"""
     try:
         # Test database connection
-        from sqlalchemy import text
         db.session.execute(text('SELECT 1'))
         return jsonify({
             'status': 'healthy',
@@ -556,6 +1816,154 @@ def health_check():
             'error': str(e)
         }), 500
 
+@app.route('/pool_status')
+@login_required
+def pool_status():
+    """Database connection pool usage"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'غير مصرح'}), 403
+    return jsonify({'success': True, 'pools': pool_stats()})
+
+@app.route('/slow_queries')
+@login_required
+def slow_queries_page():
+    """Recent slow SQL statements recorded by this worker"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+    return render_template('slow_queries.html',
+                           queries=list(reversed(slow_queries)),
+                           threshold_ms=SLOW_QUERY_MS,
+                           capacity=slow_queries.maxlen,
+                           worker_pid=os.getpid())
+
+@app.route('/slow_queries/clear', methods=['POST'])
+@login_required
+def clear_slow_queries():
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+    slow_queries.clear()
+    flash('تم مسح سجل الاستعلامات البطيئة', 'success')
+    return redirect(url_for('slow_queries_page'))
+
+@app.route('/profiles')
+@login_required
+def profiles_page():
+    """Saved request profiles, newest first"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            profile_id = name[:-len('.json')]
+            if not PROFILE_ID_PATTERN.match(profile_id):
+                continue
+            try:
+                profile = load_profile(profile_id)
+            except (OSError, ValueError):
+                continue
+            del profile['frames'], profile['stacks']
+            profiles.append(profile)
+    return render_template('profiles.html',
+                           profiles=profiles,
+                           sample_rate=PROFILE_SAMPLE_RATE,
+                           interval_ms=PROFILE_INTERVAL_MS,
+                           keep=PROFILE_KEEP)
+
+@app.route('/profiles/<profile_id>.<fmt>')
+@login_required
+def download_profile(profile_id, fmt):
+    """A saved profile as speedscope JSON or collapsed stacks"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+    if not PROFILE_ID_PATTERN.match(profile_id) or fmt not in ('speedscope', 'folded'):
+        return render_template('error.html', error="Page not found."), 404
+    try:
+        profile = load_profile(profile_id)
+    except OSError:
+        flash('الملف غير موجود', 'error')
+        return redirect(url_for('profiles_page'))
+    if fmt == 'speedscope':
+        body = json.dumps(profile_to_speedscope(profile))
+        filename, mimetype = f'{profile_id}.speedscope.json', 'application/json'
+    else:
+        body = profile_to_folded(profile)
+        filename, mimetype = f'{profile_id}.folded.txt', 'text/plain'
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/profiles/clear', methods=['POST'])
+@login_required
+def clear_profiles():
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+    if os.path.isdir(PROFILE_DIR):
+        for name in os.listdir(PROFILE_DIR):
+            if PROFILE_ID_PATTERN.match(name[:-len('.json')]):
+                os.remove(os.path.join(PROFILE_DIR, name))
+    flash('تم حذف ملفات التحليل', 'success')
+    return redirect(url_for('profiles_page'))
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for all workers (bearer METRICS_TOKEN, or an admin session)"""
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    if metrics_token:
+        if request.headers.get('Authorization') != f'Bearer {metrics_token}':
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/events')
+@login_required
+def inventory_events():
+    """Server-sent inventory changes; resumes after Last-Event-ID (or ?since= on the first connect)"""
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('since', type=int)
+    if EVENTS_MAX_STREAMS <= 0:
+        return Response(status=204)  # the browser stops reconnecting
+    subscriber = inventory_broker.subscribe(EVENTS_MAX_STREAMS)  # before reading the backlog, so nothing falls in between
+    if subscriber is None:
+        return Response(f'retry: {EVENTS_BUSY_RETRY_MS}\n\n', mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    backlog = inventory_events_after(last_id) if last_id is not None else []
+    db.session.remove()  # the stream outlives the request - release the connection now
+
+    def stream():
+        sent_id = last_id or 0
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+            pending = list(backlog)
+            while time.monotonic() < deadline:
+                if pending:
+                    inventory_event = pending.pop(0)
+                else:
+                    try:
+                        inventory_event = subscriber.get(
+                            timeout=max(min(EVENTS_HEARTBEAT_SECONDS, deadline - time.monotonic()), 0.01))
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                    if inventory_event is None:
+                        return
+                if inventory_event['id'] <= sent_id:
+                    continue
+                sent_id = inventory_event['id']
+                yield f"id: {sent_id}\nevent: inventory\ndata: {json.dumps(inventory_event)}\n\n"
+        finally:
+            inventory_broker.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.errorhandler(500)
 def internal_error(error):
     """Handle internal server errors gracefully"""
@@ -600,21 +2008,25 @@ def dashboard():
     if not current_user.is_admin:
         return redirect(url_for('limited_dashboard'))
     
-    phones = Phone.query.filter_by(status="available").all()
-    accessories = Accessory.query.all()
-    
+    # Stream from the settled id; the counts below already include the events after it
+    last_event_id = settled_inventory_event_id()
+    applied_event_ids = inventory_event_ids_after(last_event_id)
+    reports = report_session()
+
     # Calculate financial summaries for current inventory (phones + accessories)
-    total_phones = len(phones)
-    total_accessories = sum(acc.quantity_in_stock for acc in accessories)
-    total_items = total_phones + total_accessories
-    
-    # Phone values (with VAT included)
-    phone_purchase_value = sum(phone.purchase_price_with_vat for phone in phones)
-    phone_selling_value = sum(phone.selling_price_with_vat for phone in phones)
-    
+    total_phones, phone_purchase_value, phone_selling_value = reports.query(
+        func.count(Phone.id),
+        func.coalesce(func.sum(Phone.purchase_price_with_vat), 0.0),
+        func.coalesce(func.sum(Phone.selling_price_with_vat), 0.0)
+    ).filter(Phone.status == 'available').one()
+
     # Accessory values (considering quantity in stock)
-    accessory_purchase_value = sum(acc.purchase_price_with_vat * acc.quantity_in_stock for acc in accessories)
-    accessory_selling_value = sum(acc.selling_price_with_vat * acc.quantity_in_stock for acc in accessories)
+    total_accessories, accessory_purchase_value, accessory_selling_value = reports.query(
+        func.coalesce(func.sum(Accessory.quantity_in_stock), 0),
+        func.coalesce(func.sum(Accessory.purchase_price_with_vat * Accessory.quantity_in_stock), 0.0),
+        func.coalesce(func.sum(Accessory.selling_price_with_vat * Accessory.quantity_in_stock), 0.0)
+    ).one()
+    total_items = total_phones + total_accessories
     
     # Total values for all inventory
     total_purchase_value = phone_purchase_value + accessory_purchase_value
@@ -622,30 +2034,23 @@ def dashboard():
     total_expected_profit = total_selling_value - total_purchase_value
     
     # Recent sales
-    recent_sales = Sale.query.order_by(Sale.date_created.desc()).limit(10).all()
-    
-    # Sales statistics
-    total_sales = Sale.query.count()
-    total_sales_amount = sum(sale.total_amount for sale in Sale.query.all())
+    recent_sales = reports.query(Sale).order_by(Sale.date_created.desc()).limit(10).all()
     
-    # Calculate sales subtotal and VAT
-    total_sales_subtotal = sum(sale.subtotal for sale in Sale.query.all())
-    total_vat_amount = sum(sale.vat_amount for sale in Sale.query.all())
+    # Sales statistics, subtotal and VAT
+    total_sales, total_sales_amount, total_sales_subtotal, total_vat_amount = reports.query(
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.total_amount), 0.0),
+        func.coalesce(func.sum(Sale.subtotal), 0.0),
+        func.coalesce(func.sum(Sale.vat_amount), 0.0)
+    ).one()
     
-    # Calculate actual profit from completed sales
-    total_actual_profit = 0.0
-    all_sales = Sale.query.all()
-    
-    for sale in all_sales:
-        for item in sale.items:
-            # Calculate profit: (selling price - purchase price) × quantity
-            # Both prices are already stored without VAT
-            profit = item.unit_price - item.purchase_price
-            total_actual_profit += profit * item.quantity
+    # Actual profit from completed sales: (selling price - purchase price) × quantity
+    # Both prices are already stored without VAT
+    total_actual_profit = reports.query(
+        func.coalesce(func.sum((SaleItem.unit_price - SaleItem.purchase_price) * SaleItem.quantity), 0.0)
+    ).join(Sale, SaleItem.sale_id == Sale.id).scalar()
     
     return render_template('dashboard.html', 
-                         phones=phones,
-                         accessories=accessories,
                          total_phones=total_phones,
                          total_accessories=total_accessories,
                          total_items=total_items,
@@ -661,31 +2066,45 @@ def dashboard():
                          total_sales_subtotal=total_sales_subtotal,
                          total_vat_amount=total_vat_amount,
                          total_actual_profit=total_actual_profit,
+                         low_stock=render_low_stock_widget(),
+                         last_event_id=last_event_id,
+                         applied_event_ids=applied_event_ids,
                          recent_sales=recent_sales)
 
 @app.route('/limited_dashboard')
 @login_required
 def limited_dashboard():
     """Limited dashboard for non-admin users"""
-    phones = Phone.query.filter_by(status="available").all()
-    accessories = Accessory.query.all()
-    
-    # Basic counts only
-    total_phones = len(phones)
-    total_accessories = sum(acc.quantity_in_stock for acc in accessories)
-    total_items = total_phones + total_accessories
+    def render_counts():
+        # Basic counts only
+        total_phones = Phone.query.filter_by(status="available").count()
+        total_accessories = db.session.query(func.coalesce(func.sum(Accessory.quantity_in_stock), 0)).scalar()
+        return render_template('partials/inventory_counts.html',
+                             total_phones=total_phones,
+                             total_accessories=total_accessories,
+                             total_items=total_phones + total_accessories)
+
+    def render_recent():
+        return render_template('partials/recent_items.html',
+                             phones=Phone.query.filter_by(status="available").limit(5).all(),
+                             accessories=Accessory.query.limit(5).all())
     
+    last_event_id = settled_inventory_event_id()
     return render_template('limited_dashboard.html', 
-                         phones=phones,
-                         accessories=accessories,
-                         total_phones=total_phones,
-                         total_accessories=total_accessories,
-                         total_items=total_items)
+                         last_event_id=last_event_id,
+                         applied_event_ids=inventory_event_ids_after(last_event_id),
+                         inventory_counts=cached_fragment('inventory_counts', (Phone, Accessory), render_counts),
+                         low_stock=render_low_stock_widget(),
+                         recent_items=cached_fragment('recent_items', (Phone, Accessory), render_recent))
 
 # Transactions route removed - replaced by sales system
 
+@LABEL_RENDER_SECONDS.labels('phone_barcode').time()
 def generate_barcode(phone_number, battery_age=None):
     """Generate barcode for phone with sticker design"""
+    import barcode
+    from barcode.writer import ImageWriter
+    from PIL import Image
     try:
         print(f"Generating barcode for phone number: {phone_number}")
         
@@ -731,8 +2150,12 @@ def generate_barcode(phone_number, battery_age=None):
         # Return a default path if barcode generation fails
         return f"static/barcodes/{phone_number}.png"
 
+@LABEL_RENDER_SECONDS.labels('accessory_barcode').time()
 def generate_accessory_barcode(barcode_number):
     """Generate barcode for accessory"""
+    import barcode
+    from barcode.writer import ImageWriter
+    from PIL import Image
     try:
         print(f"Generating barcode for accessory: {barcode_number}")
         
@@ -781,7 +2204,7 @@ def generate_accessory_barcode(barcode_number):
 @app.route('/barcode/<phone_number>')
 @login_required
 def get_barcode(phone_number):
-    phone = Phone.query.filter_by(phone_number=phone_number).first()
+    phone = find_phone(phone_number)
     if phone and phone.barcode_path:
         return send_file(phone.barcode_path, mimetype='image/png')
     return "Barcode not found", 404
@@ -789,7 +2212,7 @@ def get_barcode(phone_number):
 @app.route('/print_barcode/<phone_number>')
 @login_required
 def print_barcode(phone_number):
-    phone = Phone.query.filter_by(phone_number=phone_number).first()
+    phone = find_phone(phone_number)
     if not phone:
         flash('الهاتف غير موجود', 'error')
         return redirect(url_for('dashboard'))
@@ -804,99 +2227,141 @@ def print_accessory_barcode(barcode):
         return redirect(url_for('dashboard'))
     return render_template('print_accessory_barcode.html', accessory=accessory)
 
+@LABEL_RENDER_SECONDS.labels('phone_sticker').time()
+def create_phone_sticker_image(phone):
+    """Render the 40x25mm phone sticker (600 DPI) as a PIL image"""
+    from PIL import Image, ImageDraw
+    # 600 DPI canvas
+    DPI = 600
+    MM_PER_IN = 25.4
+    PX_PER_MM = DPI / MM_PER_IN
+    W_MM, H_MM = 40, 25
+    width_px = int(W_MM * PX_PER_MM)
+    height_px = int(H_MM * PX_PER_MM)
+    TEXT_SHRINK = 0.72  # Make all text ~10% smaller
+
+    sticker_img = Image.new('RGB', (width_px, height_px), color='white')
+    draw = ImageDraw.Draw(sticker_img)
+    
+    # === 1) Company header (smaller, RTL-correct) ===
+    company_text = ar_text_simple("الصقري للاتصالات")
+    margin_px = int(1.0 * PX_PER_MM)
+    max_company_w = int(width_px * 0.90 * TEXT_SHRINK)
+    company_font = fit_font(draw, company_text, max_company_w, start_size=160, min_size=60)
+    cb = draw.textbbox((0, 0), company_text, font=company_font)
+    cx = width_px // 2
+    cy = int(1.4 * PX_PER_MM)
+    # draw bold by using stroke
+    center_text(draw, cx, cy, company_text, company_font, stroke_width=2)
+
+    # === 2) Barcode (bigger) ===
+    # Expect an already-generated image path in phone.barcode_path
+    if phone.barcode_path and os.path.exists(phone.barcode_path):
+        barcode_img = Image.open(phone.barcode_path)
+        target_bar_w = int(width_px * 0.90)
+        target_bar_h = int(14 * PX_PER_MM)  # 14 mm tall
+        barcode_img = barcode_img.resize((target_bar_w, target_bar_h), Image.LANCZOS)
+        bar_x = (width_px - target_bar_w) // 2
+        bar_y = cb[3] + int(1.0 * PX_PER_MM)
+        sticker_img.paste(barcode_img, (bar_x, bar_y))
+    else:
+        # simple fallback pattern
+        target_bar_w = int(width_px * 0.90)
+        target_bar_h = int(14 * PX_PER_MM)
+        bar_x = (width_px - target_bar_w) // 2
+        bar_y = cb[3] + int(1.0 * PX_PER_MM)
+        for i in range(0, target_bar_w, 8):
+            draw.rectangle([bar_x + i, bar_y, bar_x + i + 4, bar_y + target_bar_h], fill='black')
+
+    # === 3) Bottom details (larger) ===
+    # Labels (Arabic, RTL)
+    detail_label  = ar_text_simple("رقم الجهاز")
+    battery_label = ar_text_simple("نسبة البطارية")
+    memory_label  = ar_text_simple("الذاكرة")
+
+    # Values (numbers stay LTR; wrap with LRM)
+    device_val  = LRM + (str(phone.phone_number) if phone.phone_number else "") + LRM
+    battery_val = LRM + (str(phone.age) if (phone.condition == "used" and phone.age) else "100") + LRM
+    memory_val  = LRM + (phone.phone_memory if phone.phone_memory else "512") + LRM
+
+    col_w = width_px // 3
+    c1 = col_w // 2
+    c2 = col_w + col_w // 2
+    c3 = 2 * col_w + col_w // 2
+
+    baseline_y = height_px - int(4.2 * PX_PER_MM)
+
+    # Make labels & values bigger (with TEXT_SHRINK applied)
+    max_col_w = int((col_w - 2 * margin_px) * TEXT_SHRINK)
+    label_font = fit_font(draw, detail_label, max_col_w, start_size=80, min_size=44)
+    value_font = fit_font(draw, device_val,  max_col_w, start_size=96, min_size=56)
+
+    # Column 1
+    center_text(draw, c1, baseline_y - int(2.8 * PX_PER_MM), detail_label, label_font)
+    center_text(draw, c1, baseline_y - int(0.8 * PX_PER_MM), device_val,  value_font)
+
+    # Column 2
+    center_text(draw, c2, baseline_y - int(2.8 * PX_PER_MM), battery_label, label_font)
+    center_text(draw, c2, baseline_y - int(0.8 * PX_PER_MM), battery_val,  value_font)
+
+    # Column 3
+    center_text(draw, c3, baseline_y - int(2.8 * PX_PER_MM), memory_label, label_font)
+    center_text(draw, c3, baseline_y - int(0.8 * PX_PER_MM), memory_val,  value_font)
+
+    return sticker_img
+
+@LABEL_RENDER_SECONDS.labels('shipment_labels').time()
+def render_phone_labels_pdf(phones, pdf_path):
+    """Render one 40x25mm sticker page per phone into a single PDF file"""
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    p = canvas.Canvas(pdf_path, pagesize=(40*mm, 25*mm))
+    for phone in phones:
+        p.drawImage(ImageReader(create_phone_sticker_image(phone)), 0, 0, width=40*mm, height=25*mm)
+        p.showPage()
+    p.save()
+
+# Label rendering runs off the request thread, one batch at a time
+label_executor = ThreadPoolExecutor(max_workers=1)
+
+def shipment_labels_path(first_number, last_number):
+    return f"static/barcodes/shipment_{first_number}_{last_number}.pdf"
+
+def run_label_job(phone_numbers):
+    """Generate barcode images and one combined sticker PDF for a batch of phones"""
+    with app.app_context():
+        try:
+            phones = Phone.query.filter(Phone.phone_number.in_(phone_numbers)).order_by(Phone.phone_number).all()
+            for phone in phones:
+                phone.barcode_path = generate_barcode(phone_number=phone.phone_number)
+            db.session.commit()
+
+            # Write to a temporary file first so a download never sees a partial PDF
+            pdf_path = shipment_labels_path(phone_numbers[0], phone_numbers[-1])
+            render_phone_labels_pdf(phones, pdf_path + '.tmp')
+            os.replace(pdf_path + '.tmp', pdf_path)
+            print(f"Shipment labels saved: {pdf_path}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in label job: {str(e)}")
+
+def queue_label_job(phone_numbers):
+    """Queue barcode and sticker rendering for a batch of phones"""
+    return label_executor.submit(run_label_job, list(phone_numbers))
+
 @app.route('/download_barcode_pdf/<phone_number>')
 @login_required
 def download_barcode_pdf(phone_number):
     """Download barcode as PDF with exact dimensions"""
-    phone = Phone.query.filter_by(phone_number=phone_number).first()
+    from reportlab.pdfgen import canvas
+    phone = find_phone(phone_number)
     if not phone:
         flash('الهاتف غير موجود', 'error')
         return redirect(url_for('dashboard'))
     
     try:
-        # Create complete sticker image first
-        def create_complete_sticker_image():
-            # 600 DPI canvas
-            DPI = 600
-            MM_PER_IN = 25.4
-            PX_PER_MM = DPI / MM_PER_IN
-            W_MM, H_MM = 40, 25
-            width_px = int(W_MM * PX_PER_MM)
-            height_px = int(H_MM * PX_PER_MM)
-            TEXT_SHRINK = 0.72  # Make all text ~10% smaller
-
-            sticker_img = Image.new('RGB', (width_px, height_px), color='white')
-            draw = ImageDraw.Draw(sticker_img)
-            
-            # === 1) Company header (smaller, RTL-correct) ===
-            company_text = ar_text_simple("الصقري للاتصالات")
-            margin_px = int(1.0 * PX_PER_MM)
-            max_company_w = int(width_px * 0.90 * TEXT_SHRINK)
-            company_font = fit_font(draw, company_text, max_company_w, start_size=160, min_size=60)
-            cb = draw.textbbox((0, 0), company_text, font=company_font)
-            cx = width_px // 2
-            cy = int(1.4 * PX_PER_MM)
-            # draw bold by using stroke
-            center_text(draw, cx, cy, company_text, company_font, stroke_width=2)
-
-            # === 2) Barcode (bigger) ===
-            # Expect an already-generated image path in phone.barcode_path (outer scope)
-            if phone.barcode_path and os.path.exists(phone.barcode_path):
-                barcode_img = Image.open(phone.barcode_path)
-                target_bar_w = int(width_px * 0.90)
-                target_bar_h = int(14 * PX_PER_MM)  # 14 mm tall
-                barcode_img = barcode_img.resize((target_bar_w, target_bar_h), Image.LANCZOS)
-                bar_x = (width_px - target_bar_w) // 2
-                bar_y = cb[3] + int(1.0 * PX_PER_MM)
-                sticker_img.paste(barcode_img, (bar_x, bar_y))
-            else:
-                # simple fallback pattern
-                target_bar_w = int(width_px * 0.90)
-                target_bar_h = int(14 * PX_PER_MM)
-                bar_x = (width_px - target_bar_w) // 2
-                bar_y = cb[3] + int(1.0 * PX_PER_MM)
-                for i in range(0, target_bar_w, 8):
-                    draw.rectangle([bar_x + i, bar_y, bar_x + i + 4, bar_y + target_bar_h], fill='black')
-
-            # === 3) Bottom details (larger) ===
-            # Labels (Arabic, RTL)
-            detail_label  = ar_text_simple("رقم الجهاز")
-            battery_label = ar_text_simple("نسبة البطارية")
-            memory_label  = ar_text_simple("الذاكرة")
-
-            # Values (numbers stay LTR; wrap with LRM)
-            device_val  = LRM + (str(phone.phone_number) if phone.phone_number else "") + LRM
-            battery_val = LRM + (str(phone.age) if (phone.condition == "used" and phone.age) else "100") + LRM
-            memory_val  = LRM + (phone.phone_memory if phone.phone_memory else "512") + LRM
-
-            col_w = width_px // 3
-            c1 = col_w // 2
-            c2 = col_w + col_w // 2
-            c3 = 2 * col_w + col_w // 2
-
-            baseline_y = height_px - int(4.2 * PX_PER_MM)
-
-            # Make labels & values bigger (with TEXT_SHRINK applied)
-            max_col_w = int((col_w - 2 * margin_px) * TEXT_SHRINK)
-            label_font = fit_font(draw, detail_label, max_col_w, start_size=80, min_size=44)
-            value_font = fit_font(draw, device_val,  max_col_w, start_size=96, min_size=56)
-
-            # Column 1
-            center_text(draw, c1, baseline_y - int(2.8 * PX_PER_MM), detail_label, label_font)
-            center_text(draw, c1, baseline_y - int(0.8 * PX_PER_MM), device_val,  value_font)
-
-            # Column 2
-            center_text(draw, c2, baseline_y - int(2.8 * PX_PER_MM), battery_label, label_font)
-            center_text(draw, c2, baseline_y - int(0.8 * PX_PER_MM), battery_val,  value_font)
-
-            # Column 3
-            center_text(draw, c3, baseline_y - int(2.8 * PX_PER_MM), memory_label, label_font)
-            center_text(draw, c3, baseline_y - int(0.8 * PX_PER_MM), memory_val,  value_font)
-
-            return sticker_img
-        
         # Create the complete sticker image
-        sticker_img = create_complete_sticker_image()
+        sticker_img = create_phone_sticker_image(phone)
         
         # Save sticker image temporarily with high quality
         sticker_temp_path = f"static/barcodes/sticker_{phone_number}.png"
@@ -932,6 +2397,8 @@ def download_barcode_pdf(phone_number):
 @login_required
 def download_accessory_barcode_pdf(barcode):
     """Download accessory barcode as PDF with exact dimensions"""
+    from PIL import Image, ImageDraw
+    from reportlab.pdfgen import canvas
     accessory = Accessory.query.filter_by(barcode=barcode).first()
     if not accessory:
         flash('الأكسسوار غير موجود', 'error')
@@ -939,121 +2406,7 @@ def download_accessory_barcode_pdf(barcode):
     
     try:
         # Create complete sticker image first
-        def create_complete_sticker_image():
-            # 600 DPI canvas
-            DPI = 600
-            MM_PER_IN = 25.4
-            PX_PER_MM = DPI / MM_PER_IN
-            W_MM, H_MM = 40, 25
-            width_px = int(W_MM * PX_PER_MM)
-            height_px = int(H_MM * PX_PER_MM)
-            TEXT_SHRINK = 0.72  # Make all text ~10% smaller
-
-            sticker_img = Image.new('RGB', (width_px, height_px), color='white')
-            draw = ImageDraw.Draw(sticker_img)
-            
-            # === 1) Company header (smaller, RTL-correct) ===
-            company_text = ar_text_simple("الصقري للاتصالات")
-            margin_px = int(1.0 * PX_PER_MM)
-            max_company_w = int(width_px * 0.90 * TEXT_SHRINK)
-            company_font = fit_font(draw, company_text, max_company_w, start_size=160, min_size=60)
-            cb = draw.textbbox((0, 0), company_text, font=company_font)
-            cx = width_px // 2
-            cy = int(1.4 * PX_PER_MM)
-            # draw bold by using stroke
-            center_text(draw, cx, cy, company_text, company_font, stroke_width=2)
-
-            # === 2) Barcode (bigger) ===
-            # Expect an already-generated image path in phone.barcode_path (outer scope)
-            if phone.barcode_path and os.path.exists(phone.barcode_path):
-                barcode_img = Image.open(phone.barcode_path)
-                target_bar_w = int(width_px * 0.90)
-                target_bar_h = int(14 * PX_PER_MM)  # 14 mm tall
-                barcode_img = barcode_img.resize((target_bar_w, target_bar_h), Image.LANCZOS)
-                bar_x = (width_px - target_bar_w) // 2
-                bar_y = cb[3] + int(1.0 * PX_PER_MM)
-                sticker_img.paste(barcode_img, (bar_x, bar_y))
-            else:
-                # simple fallback pattern
-                target_bar_w = int(width_px * 0.90)
-                target_bar_h = int(14 * PX_PER_MM)
-                bar_x = (width_px - target_bar_w) // 2
-                bar_y = cb[3] + int(1.0 * PX_PER_MM)
-                for i in range(0, target_bar_w, 8):
-                    draw.rectangle([bar_x + i, bar_y, bar_x + i + 4, bar_y + target_bar_h], fill='black')
-
-            # === 3) Bottom details (larger) ===
-            # Labels (Arabic, RTL)
-            detail_label  = ar_text_simple("رقم الجهاز")
-            battery_label = ar_text_simple("نسبة البطارية")
-            memory_label  = ar_text_simple("الذاكرة")
-
-            # Values (numbers stay LTR; wrap with LRM)
-            device_val  = LRM + (str(phone.phone_number) if phone.phone_number else "") + LRM
-            battery_val = LRM + (str(phone.age) if (phone.condition == "used" and phone.age) else "100") + LRM
-            memory_val  = LRM + (phone.phone_memory if phone.phone_memory else "512") + LRM
-
-            col_w = width_px // 3
-            c1 = col_w // 2
-            c2 = col_w + col_w // 2
-            c3 = 2 * col_w + col_w // 2
-
-            baseline_y = height_px - int(4.2 * PX_PER_MM)
-
-            # Make labels & values bigger (with TEXT_SHRINK applied)
-            max_col_w = int((col_w - 2 * margin_px) * TEXT_SHRINK)
-            label_font = fit_font(draw, detail_label, max_col_w, start_size=80, min_size=44)
-            value_font = fit_font(draw, device_val,  max_col_w, start_size=96, min_size=56)
-
-            # Column 1
-            center_text(draw, c1, baseline_y - int(2.8 * PX_PER_MM), detail_label, label_font)
-            center_text(draw, c1, baseline_y - int(0.8 * PX_PER_MM), device_val,  value_font)
-
-            # Column 2
-            center_text(draw, c2, baseline_y - int(2.8 * PX_PER_MM), battery_label, label_font)
-            center_text(draw, c2, baseline_y - int(0.8 * PX_PER_MM), battery_val,  value_font)
-
-            # Column 3
-            center_text(draw, c3, baseline_y - int(2.8 * PX_PER_MM), memory_label, label_font)
-            center_text(draw, c3, baseline_y - int(0.8 * PX_PER_MM), memory_val,  value_font)
-            
-            return sticker_img
-        
-        # Create the complete sticker image
-        sticker_img = create_complete_sticker_image()
-        
-        # Save sticker image temporarily with high quality
-        sticker_temp_path = f"static/barcodes/sticker_{phone_number}.png"
-        sticker_img.save(sticker_temp_path, 'PNG', optimize=False, quality=100)
-        
-        # Create PDF with the sticker image - 40.0mm x 25.0mm
-        buffer = BytesIO()
-        p = canvas.Canvas(buffer, pagesize=(40*mm, 25*mm))
-        
-        # Add the complete sticker image to PDF
-        p.drawImage(sticker_temp_path, 0, 0, width=40*mm, height=25*mm)
-        
-        p.showPage()
-        p.save()
-        
-        # Clean up temp file
-        if os.path.exists(sticker_temp_path):
-            os.remove(sticker_temp_path)
-        
-        buffer.seek(0)
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=f'barcode_{phone_number}.pdf',
-            mimetype='application/pdf'
-        )
-        
-    except Exception as e:
-        flash(f'خطأ في إنشاء PDF: {str(e)}', 'error')
-        return redirect(url_for('print_barcode', phone_number=phone_number))
-
-    try:
-        # Create complete sticker image first
+        @LABEL_RENDER_SECONDS.labels('accessory_sticker').time()
         def create_complete_sticker_image():
             # 600 DPI canvas
             DPI = 600
@@ -1200,9 +2553,11 @@ def download_saved_accessory_pdf(barcode):
         mimetype='application/pdf'
     )
 
-def generate_unique_phone_number():
+def allocate_phone_numbers(count):
+    """Reserve a contiguous block of phone numbers after the highest existing one"""
     # Get the highest existing phone number
-    highest_phone = db.session.query(func.max(Phone.phone_number)).scalar()
+    highest_phone = max((db.session.query(func.max(model.phone_number)).scalar() for model in (Phone, PhoneHistory)),
+                        key=lambda number: number or '')
     
     if highest_phone is None:
         # If no phones exist, start from 000001
@@ -1216,11 +2571,14 @@ def generate_unique_phone_number():
             next_number = 1
     
     # Check if we've reached the limit
-    if next_number > 100000:
+    if next_number + count - 1 > 100000:
         raise ValueError("Maximum number of phones (100000) reached")
     
-    # Format the number with leading zeros to make it 6 digits
-    phone_number = f"{next_number:06d}"
+    # Format the numbers with leading zeros to make them 6 digits
+    return [f"{number:06d}" for number in range(next_number, next_number + count)]
+
+def generate_unique_phone_number():
+    phone_number = allocate_phone_numbers(1)[0]
     print(f"Generated phone number: {phone_number}")
     return phone_number
 
@@ -1262,8 +2620,7 @@ def add_new_phone():
             buyer_name = request.form.get('buyer_name')
             
             # Check if serial number already exists
-            existing_phone = Phone.query.filter_by(serial_number=serial_number).first()
-            if existing_phone:
+            if serial_numbers_in_use([serial_number]):
                 flash('الرقم التسلسلي موجود بالفعل في النظام', 'error')
                 return redirect(url_for('add_new_phone'))
             
@@ -1333,12 +2690,7 @@ def add_new_phone():
             return redirect(url_for('add_new_phone'))
     
     # Get brands and models data for the dropdown
-    brands = {}
-    phone_types = PhoneType.query.all()
-    for phone_type in phone_types:
-        if phone_type.brand not in brands:
-            brands[phone_type.brand] = []
-        brands[phone_type.brand].append(phone_type.model)
+    brands = phone_catalog()
     
     return render_template('add_new_phone.html', brands=brands)
 
@@ -1372,8 +2724,7 @@ def add_used_phone():
             phone_memory = request.form.get('phone_memory')
             buyer_name = request.form.get('buyer_name')
             
-            existing_phone = Phone.query.filter_by(serial_number=serial_number).first()
-            if existing_phone:
+            if serial_numbers_in_use([serial_number]):
                 flash('الرقم التسلسلي موجود بالفعل في النظام', 'error')
                 return redirect(url_for('add_used_phone'))
             
@@ -1443,15 +2794,160 @@ def add_used_phone():
             return redirect(url_for('add_used_phone'))
     
     # Get brands and models data for the dropdown
-    brands = {}
-    phone_types = PhoneType.query.all()
-    for phone_type in phone_types:
-        if phone_type.brand not in brands:
-            brands[phone_type.brand] = []
-        brands[phone_type.brand].append(phone_type.model)
+    brands = phone_catalog()
     
     return render_template('add_used_phone.html', brands=brands)
 
+def parse_serial_numbers(raw):
+    """Split scanned serial numbers (one per line or comma separated)"""
+    if isinstance(raw, str):
+        raw = raw.replace(',', '\n').splitlines()
+    return [str(serial).strip() for serial in (raw or []) if str(serial).strip()]
+
+@app.route('/receive_shipment', methods=['GET', 'POST'])
+@login_required
+def receive_shipment():
+    """Receive a shipment of identical new phones in one step"""
+    if request.method == 'POST':
+        data = request.get_json() if request.is_json else request.form
+
+        def fail(message, status=400, **extra):
+            if request.is_json:
+                return jsonify({'success': False, 'message': message, **extra}), status
+            flash(message, 'error')
+            return redirect(url_for('receive_shipment'))
+
+        try:
+            brand = (data.get('brand') or '').strip()
+            model = (data.get('model') or '').strip()
+            purchase_price_with_vat = float(data.get('purchase_price'))  # Input already includes VAT
+            selling_price_with_vat = float(data.get('selling_price'))    # Input already includes VAT
+            warranty = int(data.get('warranty') or 0)
+            serial_numbers = parse_serial_numbers(data.get('serial_numbers'))
+        except (TypeError, ValueError):
+            return fail('خطأ في إدخال البيانات. يرجى التحقق من القيم المدخلة')
+
+        if not brand or not model or not serial_numbers:
+            return fail('يرجى إدخال الشركة المصنعة والموديل والأرقام التسلسلية')
+
+        # Serial numbers repeated inside the shipment itself
+        seen = set()
+        repeated = sorted({serial for serial in serial_numbers if serial in seen or seen.add(serial)})
+        if repeated:
+            return fail(f'أرقام تسلسلية مكررة في الشحنة: {", ".join(repeated)}', duplicates=repeated)
+
+        # Serial numbers already in the system - one query for the whole shipment
+        existing = sorted(serial_numbers_in_use(serial_numbers))
+        if existing:
+            return fail(f'الأرقام التسلسلية التالية موجودة بالفعل في النظام: {", ".join(existing)}', duplicates=existing)
+
+        # Calculate base prices without VAT
+        purchase_price = calculate_price_without_vat(purchase_price_with_vat)
+        selling_price = calculate_price_without_vat(selling_price_with_vat)
+        purchase_vat = purchase_price_with_vat - purchase_price
+
+        customer_name = data.get('customer_name')
+        try:
+            phone_numbers = allocate_phone_numbers(len(serial_numbers))
+            phones = [
+                Phone(
+                    brand=brand,
+                    model=model,
+                    condition='new',
+                    purchase_price=purchase_price,
+                    selling_price=selling_price,
+                    purchase_price_with_vat=purchase_price_with_vat,
+                    selling_price_with_vat=selling_price_with_vat,
+                    serial_number=serial_number,
+                    phone_number=phone_number,
+                    description=data.get('description'),
+                    warranty=warranty,
+                    customer_name=customer_name,
+                    customer_phone=data.get('customer_phone'),
+                    customer_id=data.get('customer_id'),
+                    phone_color=data.get('phone_color'),
+                    phone_memory=data.get('phone_memory'),
+                    buyer_name=data.get('buyer_name')
+                )
+                for serial_number, phone_number in zip(serial_numbers, phone_numbers)
+            ]
+            db.session.add_all(phones)
+            db.session.flush()  # Get the phone IDs
+
+            # Record the buy transactions in the same unit of work
+            db.session.add_all([
+                Transaction(
+                    phone_id=phone.id,
+                    transaction_type='buy',
+                    serial_number=phone.serial_number,
+                    price=purchase_price,
+                    price_with_vat=purchase_price_with_vat,
+                    vat_amount=purchase_vat,
+                    user_id=current_user.id,
+                    customer_name=customer_name,
+                    customer_phone=None,
+                    notes='استلام شحنة هواتف جديدة'
+                )
+                for phone in phones
+            ])
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            return fail(str(e))
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in receive_shipment: {str(e)}")
+            return fail(f'حدث خطأ: {str(e)}', 500)
+
+        queue_label_job(phone_numbers)
+
+        first_number, last_number = phone_numbers[0], phone_numbers[-1]
+        if request.is_json:
+            return jsonify({
+                'success': True,
+                'count': len(phones),
+                'phone_numbers': phone_numbers,
+                'labels_url': url_for('download_shipment_labels', first_number=first_number, last_number=last_number)
+            })
+        flash(f'تم استلام {len(phones)} هاتف بنجاح', 'success')
+        return redirect(url_for('receive_shipment', first=first_number, last=last_number))
+
+    # Phones of the shipment that was just received
+    first_number = request.args.get('first', '')
+    last_number = request.args.get('last', '')
+    received = []
+    if first_number and last_number:
+        received = Phone.query.filter(Phone.phone_number.between(first_number, last_number)) \
+            .order_by(Phone.phone_number).all()
+
+    # Get brands and models data for the dropdown
+    brands = phone_catalog()
+
+    return render_template('receive_shipment.html',
+                         brands=brands,
+                         received=received,
+                         first_number=first_number,
+                         last_number=last_number)
+
+@app.route('/download_shipment_labels/<first_number>/<last_number>')
+@login_required
+def download_shipment_labels(first_number, last_number):
+    """Download the combined sticker PDF of a received shipment"""
+    if not (first_number.isdigit() and last_number.isdigit()):
+        return "Labels not found", 404
+
+    pdf_path = shipment_labels_path(first_number, last_number)
+    if not os.path.exists(pdf_path):
+        flash('ملصقات الشحنة قيد التجهيز، يرجى المحاولة بعد لحظات', 'info')
+        return redirect(url_for('receive_shipment', first=first_number, last=last_number))
+
+    return send_file(
+        pdf_path,
+        as_attachment=True,
+        download_name=f'shipment_{first_number}_{last_number}.pdf',
+        mimetype='application/pdf'
+    )
+
 @app.route('/dashboard/delete/<int:phone_id>', methods=['POST'])
 @login_required
 def delete_phone(phone_id):
@@ -1477,47 +2973,28 @@ def logout():
 @login_required
 def create_sale_page():
     """Show create sale page"""
+    # Read first, and only up to the settled id: changes already in the catalog
+    # arrive again over /events, which is harmless as they are applied by id
+    last_event_id = settled_inventory_event_id()
     phones = Phone.query.filter_by(status="available").all()
     accessories = Accessory.query.all()
     
     # Get accessory categories for dropdown
-    accessory_categories = AccessoryCategory.query.all()
+    accessory_categories = accessory_category_catalog()
     
     # Get phone brands for dropdown
-    phone_brands = db.session.query(PhoneType.brand).distinct().all()
-    phone_brands = [brand[0] for brand in phone_brands]
+    phone_brands = list(phone_catalog())
     
-    # Convert Phone objects to dictionaries for JSON serialization
-    phones_data = []
-    for phone in phones:
-        phones_data.append({
-            'id': phone.id,
-            'brand': phone.brand,
-            'model': phone.model,
-            'serial_number': phone.serial_number,
-            'phone_number': phone.phone_number,
-            'selling_price': phone.selling_price_with_vat,  # Use price with VAT
-            'description': phone.description or ''
-        })
-    
-    # Convert Accessory objects to dictionaries
-    accessories_data = []
-    for accessory in accessories:
-        accessories_data.append({
-            'id': accessory.id,
-            'name': accessory.name,
-            'category': accessory.category,
-            'description': accessory.description or '',
-            'barcode': accessory.barcode or '',
-            'selling_price': accessory.selling_price_with_vat,  # Use price with VAT
-            'quantity_in_stock': accessory.quantity_in_stock
-        })
+    # Convert Phone and Accessory objects to dictionaries for JSON serialization
+    phones_data = [phone_sale_data(phone) for phone in phones]
+    accessories_data = [accessory_sale_data(accessory) for accessory in accessories]
     
     return render_template('create_sale.html', 
                          phones=phones_data, 
                          accessories=accessories_data,
                          accessory_categories=accessory_categories,
-                         phone_brands=phone_brands)
+                         phone_brands=phone_brands,
+                         last_event_id=last_event_id)
 
 @app.route('/create_sale', methods=['POST'])
 @login_required
@@ -1548,6 +3025,7 @@ def create_sale():
         sale.total_amount = total_amount
         
         db.session.add(sale)
+        stock_reason('sell', sale.sale_number)
         db.session.flush()  # Get the sale ID
         
         # Add sale items
@@ -1613,27 +3091,231 @@ def view_sale(sale_id):
     sale = Sale.query.get_or_404(sale_id)
     return render_template('view_sale.html', sale=sale)
 
+# Server-side invoice PDFs (80mm receipt roll)
+INVOICE_RENDER_VERSION = 2  # Bump when the layout changes so cached PDFs are re-rendered
+INVOICE_WIDTH = 80 * mm
+INVOICE_MARGIN = 4 * mm
+INVOICE_FONT_NAME = 'InvoiceFont'
+INVOICE_CACHE_DIR = os.path.join(app.instance_path, 'invoices')
+_invoice_font = None
+
+def invoice_font():
+    """Register an Arabic-capable TTF with reportlab (once per worker); None if the host has none"""
+    global _invoice_font
+    if _invoice_font is None:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        _invoice_font = ''
+        # The shaped letters ar_text draws - a Latin-only font would print them as boxes
+        needed = {ord(ch) for ch in ar_text('الصقري للإتصالات فاتورة ضريبية') if not ch.isspace()}
+        bundled_font = os.path.join(app.root_path, 'static', 'fonts', 'Amiri-Regular.ttf')
+        for path in [bundled_font] + FONT_CANDIDATES:
+            if path.lower().endswith('.ttf') and os.path.exists(path):
+                try:
+                    font = TTFont(INVOICE_FONT_NAME, path)
+                except Exception:
+                    continue
+                if needed <= set(font.face.charToGlyph):
+                    pdfmetrics.registerFont(font)
+                    _invoice_font = INVOICE_FONT_NAME
+                    break
+        if not _invoice_font:
+            print(f"No Arabic-capable TTF found (tried {bundled_font} and FONT_CANDIDATES) - invoice PDFs are disabled")
+    return _invoice_font or None
+
+def invoice_data(sale):
+    """Everything printed on a sale's invoice, in a canonical form that can be hashed"""
+    show_customer = bool(sale.customer_name and sale.customer_name != 'عميل نقدي' or sale.customer_phone)
+    return {
+        'version': INVOICE_RENDER_VERSION,
+        'sale_number': sale.sale_number,
+        'date': sale.date_created.strftime('%d/%m/%Y'),
+        'company_phone': sale.company_phone or '0505663222',
+        'company_vat_number': sale.company_vat_number or '310105614500003',
+        'company_address': sale.company_address or 'القصيم بريده الصفراء',
+        'customer_name': sale.customer_name if show_customer and sale.customer_name != 'عميل نقدي' else '',
+        'customer_phone': (sale.customer_phone or '') if show_customer else '',
+        'show_customer': show_customer,
+        'items': [[item.quantity, item.product_name, round(item.unit_price, 2)] for item in sale.items],
+        'subtotal': round(sale.subtotal, 2),
+        'vat_amount': round(sale.vat_amount, 2),
+        'total_amount': round(sale.total_amount, 2),
+    }
+
+def invoice_digest(invoices):
+    """Content address of a list of invoices - identical content gives an identical PDF"""
+    payload = json.dumps(invoices, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def build_invoice_rows(invoice):
+    """Lay an invoice out as rows of (kind, size, values) from top to bottom"""
+    rows = [
+        ('center', 13, 'الصقري للإتصالات'),
+        ('center', 9, 'AL SAQRI TELECOM'),
+        ('center', 9, f"الجوال: {invoice['company_phone']}"),
+        ('center', 9, f"الرقم الضريبي: {invoice['company_vat_number']}"),
+        ('center', 9, 'السجل التجاري: 1131281064'),
+        ('center', 9, f"العنوان: {invoice['company_address']}"),
+        ('rule', 4, None),
+        ('center', 12, 'فاتورة ضريبية مبسطة'),
+        ('center', 9, f"فاتورة: {invoice['sale_number']}"),
+        ('center', 9, f"تاريخ الفاتورة: {invoice['date']}"),
+    ]
+    if invoice['show_customer']:
+        rows.append(('rule', 4, None))
+        rows.append(('center', 10, 'معلومات العميل'))
+        if invoice['customer_name']:
+            rows.append(('right', 9, f"اسم العميل: {invoice['customer_name']}"))
+        if invoice['customer_phone']:
+            rows.append(('right', 9, f"رقم الجوال: {invoice['customer_phone']}"))
+
+    rows.append(('rule', 4, None))
+    rows.append(('columns', 8, ('الكمية', 'المنتج', 'غير شامل الضريبة', 'شامل الضريبة')))
+    for quantity, name, unit_price in invoice['items']:
+        rows.append(('columns', 8, (str(quantity), name, f"{unit_price / (1 + VAT_RATE):.2f}", f"{unit_price:.2f}")))
+
+    rows.append(('rule', 4, None))
+    rows.append(('pair', 9, ('الاجمالي غير شامل الضريبة:', f"{invoice['subtotal']:.2f} ريال")))
+    rows.append(('pair', 9, (f'ضريبة القيمة المضافة {VAT_RATE * 100:.0f}%:', f"{invoice['vat_amount']:.2f} ريال")))
+    rows.append(('pair', 11, ('الاجمالي شامل الضريبة:', f"{invoice['total_amount']:.2f} ريال")))
+    rows.append(('rule', 4, None))
+    rows.extend([
+        ('center', 10, 'سياسة الاستبدال والاسترجاع'),
+        ('center', 8, '1) الاجهزة الجديدة ضمانها عند الوكيل'),
+        ('center', 8, '2) والاجهزة المستخدمة تستبدل ولا تسترجع'),
+        ('center', 8, 'في حال وجود عطل داخلي يشمل ضمان'),
+        ('center', 8, 'المستخدم في حال وجود كامل الملحقات'),
+        ('center', 9, 'شكرا لزيارتكم الصقري للإتصالات'),
+    ])
+    return rows
+
+def draw_invoice_page(c, invoice):
+    """Draw one invoice as a single receipt-roll page sized to its content"""
+    font = invoice_font()
+    rows = build_invoice_rows(invoice)
+    content_width = INVOICE_WIDTH - 2 * INVOICE_MARGIN
+    right = INVOICE_WIDTH - INVOICE_MARGIN
+    # Column right edges for the item table (RTL: quantity is the rightmost column)
+    column_edges = [right, right - 9 * mm, right - 38 * mm, right - 55 * mm]
+    column_widths = [9 * mm, 29 * mm, 17 * mm, content_width - 55 * mm]
+
+    height = 2 * INVOICE_MARGIN + sum(size * 1.6 for _, size, _ in rows)
+    c.setPageSize((INVOICE_WIDTH, height))
+    y = height - INVOICE_MARGIN
+
+    for kind, size, value in rows:
+        y -= size * 1.6
+        c.setFont(font, size)
+        if kind == 'rule':
+            c.setDash(2, 2)
+            c.line(INVOICE_MARGIN, y + size, right, y + size)
+            c.setDash()
+        elif kind == 'center':
+            c.drawCentredString(INVOICE_WIDTH / 2, y, ar_text(value))
+        elif kind == 'right':
+            c.drawRightString(right, y, ar_text(value))
+        elif kind == 'pair':
+            label, amount = value
+            c.drawRightString(right, y, ar_text(label))
+            c.drawString(INVOICE_MARGIN, y, ar_text(amount))
+        elif kind == 'columns':
+            for cell, edge, width in zip(value, column_edges, column_widths):
+                cell = ar_text(cell)
+                while len(cell) > 1 and c.stringWidth(cell, font, size) > width - 1 * mm:
+                    cell = cell[1:] if contains_arabic(cell) else cell[:-1]
+                c.drawRightString(edge, y, cell)
+    c.showPage()
+
+def cached_invoice_pdf(invoices):
+    """Path and digest of the PDF for these invoices, rendered once and cached by content"""
+    digest = invoice_digest(invoices)
+    pdf_path = os.path.join(INVOICE_CACHE_DIR, f"{digest}.pdf")
+    if not os.path.exists(pdf_path):
+        os.makedirs(INVOICE_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so a concurrent request never serves a partial PDF
+        temp_path = f"{pdf_path}.{os.getpid()}.tmp"
+        from reportlab.pdfgen import canvas
+        with LABEL_RENDER_SECONDS.labels('invoice').time():
+            c = canvas.Canvas(temp_path)
+            c.setTitle(', '.join(invoice['sale_number'] for invoice in invoices))
+            for invoice in invoices:
+                draw_invoice_page(c, invoice)
+            c.save()
+        os.replace(temp_path, pdf_path)
+    return pdf_path, digest
+
+def send_invoice_pdf(invoices, download_name):
+    """Serve invoices as a cached PDF with a strong ETag"""
+    if invoice_font() is None:
+        # Never render, cache or ETag a PDF whose Arabic would print as boxes
+        print(f"Refusing to render {download_name}: no Arabic-capable font")
+        return Response('تعذر إنشاء الفاتورة: لا يوجد خط عربي على الخادم', status=503,
+                        mimetype='text/plain')
+    digest = invoice_digest(invoices)
+    if request.if_none_match.contains(digest):
+        # The browser already has exactly this content - skip rendering and reading the file
+        response = Response(status=304)
+        response.set_etag(digest)
+        return response
+
+    pdf_path, digest = cached_invoice_pdf(invoices)
+    response = send_file(pdf_path, mimetype='application/pdf', download_name=download_name,
+                         etag=digest, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # Revalidate with the ETag before reuse
+    return response
+
+@app.route('/sale/<int:sale_id>/invoice.pdf')
+@login_required
+def sale_invoice_pdf(sale_id):
+    """Printable invoice of a sale, rendered on the server"""
+    sale = Sale.query.get_or_404(sale_id)
+    return send_invoice_pdf([invoice_data(sale)], f'invoice_{sale.sale_number}.pdf')
+
+@app.route('/sales/invoices/<day>.pdf')
+@login_required
+def day_invoices_pdf(day):
+    """All invoices of one day in a single PDF"""
+    try:
+        day_start = datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        flash('التاريخ غير صحيح', 'error')
+        return redirect(url_for('list_sales'))
+
+    sales = Sale.query.options(db.selectinload(Sale.items)).filter(
+        Sale.date_created >= day_start,
+        Sale.date_created < day_start + timedelta(days=1)
+    ).order_by(Sale.date_created).all()
+    if not sales:
+        flash('لا توجد مبيعات في هذا اليوم', 'error')
+        return redirect(url_for('list_sales', filter_type='day', filter_date=day))
+
+    return send_invoice_pdf([invoice_data(sale) for sale in sales], f'invoices_{day}.pdf')
+
 @app.route('/accessories')
 @login_required
 def list_accessories():
     """List all accessories"""
-    accessories = Accessory.query.order_by(Accessory.date_added.desc()).all()
-    
-    # Calculate totals considering quantity
-    total_purchase_value = sum(acc.purchase_price_with_vat * acc.quantity_in_stock for acc in accessories)
-    total_selling_value = sum(acc.selling_price_with_vat * acc.quantity_in_stock for acc in accessories)
-    total_quantity = sum(acc.quantity_in_stock for acc in accessories)
-    
-    # Get categories for display
-    categories = AccessoryCategory.query.all()
-    category_map = {cat.name: cat.arabic_name for cat in categories}
+    def render_table():
+        accessories = Accessory.query.order_by(Accessory.date_added.desc()).all()
+        
+        # Calculate totals considering quantity
+        total_purchase_value = sum(acc.purchase_price_with_vat * acc.quantity_in_stock for acc in accessories)
+        total_selling_value = sum(acc.selling_price_with_vat * acc.quantity_in_stock for acc in accessories)
+        total_quantity = sum(acc.quantity_in_stock for acc in accessories)
+        
+        # Get categories for display
+        category_map = dict(accessory_category_catalog())
+        
+        return render_template('partials/accessories_table.html', 
+                             accessories=accessories,
+                             total_purchase_value=total_purchase_value,
+                             total_selling_value=total_selling_value,
+                             total_quantity=total_quantity,
+                             category_map=category_map)
     
-    return render_template('list_accessories.html', 
-                         accessories=accessories,
-                         total_purchase_value=total_purchase_value,
-                         total_selling_value=total_selling_value,
-                         total_quantity=total_quantity,
-                         category_map=category_map)
+    return render_template('list_accessories.html',
+                         accessories_table=cached_fragment('accessories_table', (Accessory, AccessoryCategory), render_table))
 
 @app.route('/add_accessory', methods=['GET', 'POST'])
 @login_required
@@ -1648,6 +3330,7 @@ def add_accessory():
             purchase_price_with_vat = float(request.form.get('purchase_price'))  # Input already includes VAT
             selling_price_with_vat = float(request.form.get('selling_price'))    # Input already includes VAT
             quantity = int(request.form.get('quantity', 0))
+            min_quantity = int(request.form.get('min_quantity') or DEFAULT_MIN_QUANTITY)
             supplier = request.form.get('supplier')
             notes = request.form.get('notes')
             
@@ -1685,6 +3368,7 @@ def add_accessory():
                 purchase_price_with_vat=purchase_price_with_vat,
                 selling_price_with_vat=selling_price_with_vat,
                 quantity_in_stock=quantity,
+                min_quantity=min_quantity,
                 supplier=supplier,
                 notes=notes
             )
@@ -1694,7 +3378,10 @@ def add_accessory():
             
             # Generate and save PDF barcode automatically
             try:
+                from PIL import Image, ImageDraw
+                from reportlab.pdfgen import canvas
                 # Create complete sticker image first
+                @LABEL_RENDER_SECONDS.labels('accessory_sticker').time()
                 def create_complete_sticker_image():
                     # 600 DPI canvas
                     DPI = 600
@@ -1836,7 +3523,7 @@ def add_accessory():
             return redirect(url_for('add_accessory'))
     
     # Get categories for the dropdown
-    categories = AccessoryCategory.query.all()
+    categories = accessory_category_catalog()
     return render_template('add_accessory.html', categories=categories)
 
 @app.route('/edit_accessory/<int:accessory_id>', methods=['GET', 'POST'])
@@ -1853,6 +3540,7 @@ def edit_accessory(accessory_id):
             purchase_price_with_vat = float(request.form.get('purchase_price'))  # Input already includes VAT
             selling_price_with_vat = float(request.form.get('selling_price'))    # Input already includes VAT
             accessory.quantity_in_stock = int(request.form.get('quantity', 0))
+            accessory.min_quantity = int(request.form.get('min_quantity') or DEFAULT_MIN_QUANTITY)
             accessory.supplier = request.form.get('supplier')
             accessory.notes = request.form.get('notes')
             
@@ -1876,7 +3564,7 @@ def edit_accessory(accessory_id):
             flash(f'حدث خطأ: {str(e)}', 'error')
     
     # Get categories for the dropdown
-    categories = AccessoryCategory.query.all()
+    categories = accessory_category_catalog()
     return render_template('edit_accessory.html', accessory=accessory, categories=categories)
 
 @app.route('/delete_accessory/<int:accessory_id>', methods=['DELETE'])
@@ -1892,6 +3580,91 @@ def delete_accessory(accessory_id):
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+# Serial suffix search. Staff look phones up by the last digits of the serial or
+# IMEI, which a LIKE '%1234' can only answer by scanning the table. Each phone
+# also stores its serial reversed (kept by set_serial_reversed), so a suffix is a
+# prefix of serial_reversed. The head of a serial (an IMEI's TAC) is a prefix of
+# serial_number itself, and phone numbers are matched with and without their zero
+# padding. A prefix is an index range on SQLite, which compares strings by code
+# point; on Postgres the database collation (en_US, ar_SA...) does not order
+# strings that way, so it is a LIKE 'prefix%' served by text_pattern_ops indexes.
+# Terms of SERIAL_SUFFIX_MIN_DIGITS to SERIAL_SUFFIX_MAX_DIGITS digits - what staff
+# type - use only the indexed lookups and fall back to the substring scan when
+# they find nothing; longer digit terms run both in one query, so a mid-serial
+# match is never dropped.
+SERIAL_SUFFIX_MIN_DIGITS = 4
+SERIAL_SUFFIX_MAX_DIGITS = 6
+PHONE_NUMBER_DIGITS = 6  # allocate_phone_numbers pads to this width
+
+def prefix_match(column, prefix):
+    """column starts with prefix, in a form the column's index can serve"""
+    if db.engine.dialect.name == 'postgresql':
+        return column.startswith(prefix, autoescape=True)
+    return db.and_(column >= prefix, column < prefix + '\uffff')
+
+def pattern_index(name, column):
+    """Postgres index for LIKE 'prefix%' whatever the database collation (elsewhere the plain index serves)"""
+    return db.Index(name, column, postgresql_ops={column.name: 'text_pattern_ops'},
+                    info={'dialect': 'postgresql'}).ddl_if(dialect='postgresql')
+
+for serial_model in (Phone, PhoneHistory):
+    table_name = serial_model.__tablename__
+    pattern_index(f'ix_{table_name}_serial_number_pattern', serial_model.__table__.c.serial_number)
+    pattern_index(f'ix_{table_name}_serial_reversed_pattern', serial_model.__table__.c.serial_reversed)
+
+@event.listens_for(Phone, 'before_insert')
+@event.listens_for(Phone, 'before_update')
+@event.listens_for(PhoneHistory, 'before_insert')
+@event.listens_for(PhoneHistory, 'before_update')
+def set_serial_reversed(mapper, connection, target):
+    target.serial_reversed = target.serial_number[::-1] if target.serial_number else None
+
+def backfill_serial_reversed(batch_size=1000):
+    """Fill serial_reversed of phones written before the column existed or by bulk inserts; returns the count"""
+    filled = 0
+    for model in (Phone, PhoneHistory):
+        while True:
+            rows = db.session.query(model.id, model.serial_number) \
+                .filter(model.serial_reversed.is_(None)).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            db.session.execute(update(model), [{'id': row_id, 'serial_reversed': serial[::-1]} for row_id, serial in rows])
+            db.session.commit()
+            filled += len(rows)
+    return filled
+
+def serial_suffix_match(model, suffix):
+    """Phones whose serial ends with `suffix`"""
+    return prefix_match(model.serial_reversed, suffix[::-1])
+
+def serial_prefix_match(model, prefix):
+    """Phones whose serial starts with `prefix`"""
+    return prefix_match(model.serial_number, prefix)
+
+def phone_digits_filter(model, digits):
+    """Indexed matches for a run of digits: head or tail of a serial/IMEI, phone number or customer number"""
+    return db.or_(
+        serial_suffix_match(model, digits),
+        serial_prefix_match(model, digits),
+        model.phone_number.in_({digits, digits.zfill(PHONE_NUMBER_DIGITS)}),
+        model.customer_id_key == digits,
+        model.customer_phone_key == normalize_phone_number(digits)
+    )
+
+def phone_text_filter(model, term):
+    """Substring match over the phone fields shown on the search page"""
+    return db.or_(
+        model.phone_number.contains(term),
+        model.serial_number.contains(term),
+        model.brand.contains(term),
+        model.model.contains(term),
+        model.phone_color.contains(term),
+        model.phone_memory.contains(term),
+        model.description.contains(term),
+        model.customer_name.contains(term),
+        model.customer_id.contains(term)
+    )
+
 @app.route('/search')
 @login_required
 def search():
@@ -1906,28 +3679,28 @@ def search():
     if search_term:
         # Search in phones
         if search_type in ['all', 'phones']:
-            phone_query = Phone.query
-            
-            # Add condition filter if specified
-            if condition:
-                phone_query = phone_query.filter_by(condition=condition)
-            
-            # Search in multiple phone fields
-            phone_query = phone_query.filter(
-                db.or_(
-                    Phone.phone_number.contains(search_term),
-                    Phone.serial_number.contains(search_term),
-                    Phone.brand.contains(search_term),
-                    Phone.model.contains(search_term),
-                    Phone.phone_color.contains(search_term),
-                    Phone.phone_memory.contains(search_term),
-                    Phone.description.contains(search_term),
-                    Phone.customer_name.contains(search_term),
-                    Phone.customer_id.contains(search_term)
-                )
-            )
-            
-            phones = phone_query.all()
+            digits = search_term.translate(ARABIC_DIGITS)
+            phone_filters = [lambda model: phone_text_filter(model, search_term)]
+            if re.fullmatch(r'[0-9]+', digits):
+                if SERIAL_SUFFIX_MIN_DIGITS <= len(digits) <= SERIAL_SUFFIX_MAX_DIGITS:
+                    # Indexed lookups first, the substring scan only if they find nothing
+                    phone_filters.insert(0, lambda model: phone_digits_filter(model, digits))
+                elif len(digits) > SERIAL_SUFFIX_MAX_DIGITS:
+                    # Whole serials and customer numbers - both lookups at once
+                    phone_filters = [lambda model: db.or_(phone_digits_filter(model, digits),
+                                                          phone_text_filter(model, search_term))]
+            for phone_filter in phone_filters:
+                # Current stock first, then the sold-phone archive
+                for model in (Phone, PhoneHistory):
+                    phone_query = model.query
+                    
+                    # Add condition filter if specified
+                    if condition:
+                        phone_query = phone_query.filter_by(condition=condition)
+                    
+                    phones.extend(phone_query.filter(phone_filter(model)).all())
+                if phones:
+                    break
         
         # Search in accessories
         if search_type in ['all', 'accessories']:
@@ -1950,6 +3723,266 @@ def search():
                          search_type=search_type,
                          condition=condition)
 
+# Customer lookup. Phones bought from customers (phone, phone_history) and sales to
+# them carry normalized copies of the customer fields - mobile numbers as
+# 05XXXXXXXX, national IDs as bare digits, names with the Arabic letter variants
+# and diacritics folded - kept by set_customer_keys() and indexed. A regular
+# customer's whole history is then one UNION ALL over the three tables, matched
+# exactly on the number or ID, or by name prefix.
+CUSTOMER_PAGE_SIZE = 50
+CASH_CUSTOMER_NAME = 'عميل نقدي'
+ARABIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '0123456789' * 2)
+ARABIC_LETTER_VARIANTS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ة': 'ه'})
+ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u0640]')  # diacritics and tatweel
+
+def normalize_text(value):
+    """Search key of free text: Arabic letter variants and diacritics folded, case folded, spaces collapsed"""
+    if not value:
+        return ''
+    value = ARABIC_MARKS.sub('', value.translate(ARABIC_DIGITS).translate(ARABIC_LETTER_VARIANTS))
+    return ' '.join(value.casefold().split())
+
+def normalize_phone_number(value):
+    """Saudi mobile number as 05XXXXXXXX, whether written +966, 00966, with spaces or Arabic digits"""
+    digits = re.sub(r'[^0-9]', '', (value or '').translate(ARABIC_DIGITS))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    if digits.startswith('966'):
+        digits = '0' + digits[3:]
+    elif len(digits) == 9 and digits.startswith('5'):
+        digits = '0' + digits
+    return digits
+
+def normalize_national_id(value):
+    return re.sub(r'[^0-9A-Za-z]', '', (value or '').translate(ARABIC_DIGITS)).upper()
+
+def customer_keys(customer_name, customer_phone, customer_id=None):
+    """Lookup keys of a customer record.
+
+    A key is None only when its field is missing (so backfill_customer_keys knows it
+    was never computed) and '' when there is nothing to look up: a field that
+    normalizes to nothing, or the anonymous cash customer's name."""
+    def key(value, normalize):
+        return None if value is None else normalize(value)
+    return {
+        'customer_phone_key': key(customer_phone, normalize_phone_number),
+        'customer_id_key': key(customer_id, normalize_national_id),
+        'customer_name_key': key(customer_name, lambda name: normalize_text(name) if name != CASH_CUSTOMER_NAME else ''),
+    }
+
+CUSTOMER_KEYED_MODELS = (Phone, PhoneHistory, Sale)
+
+for customer_model in CUSTOMER_KEYED_MODELS:
+    pattern_index(f'ix_{customer_model.__tablename__}_customer_name_key_pattern',
+                  customer_model.__table__.c.customer_name_key)
+
+@event.listens_for(Phone, 'before_insert')
+@event.listens_for(Phone, 'before_update')
+@event.listens_for(PhoneHistory, 'before_insert')
+@event.listens_for(PhoneHistory, 'before_update')
+@event.listens_for(Sale, 'before_insert')
+@event.listens_for(Sale, 'before_update')
+def set_customer_keys(mapper, connection, target):
+    keys = customer_keys(target.customer_name, target.customer_phone, getattr(target, 'customer_id', None))
+    for name, value in keys.items():
+        if name in mapper.columns:
+            setattr(target, name, value)
+
+def backfill_customer_keys(batch_size=1000):
+    """Fill the lookup keys of rows written before the keys existed or by bulk inserts; returns the count"""
+    filled = 0
+    for model in CUSTOMER_KEYED_MODELS:
+        has_id = 'customer_id' in model.__table__.c
+        sources = [model.customer_name, model.customer_phone] + ([model.customer_id] if has_id else [])
+        def unkeyed(source, key, *nothing_to_key):
+            return db.and_(key.is_(None), source.isnot(None), func.trim(source).notin_(('',) + nothing_to_key))
+        missing = db.or_(
+            unkeyed(model.customer_name, model.customer_name_key, CASH_CUSTOMER_NAME),
+            unkeyed(model.customer_phone, model.customer_phone_key),
+            *([unkeyed(model.customer_id, model.customer_id_key)] if has_id else []))
+        last_id = 0
+        while True:
+            rows = db.session.query(model.id, *sources).filter(model.id > last_id, missing) \
+                .order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                keys = customer_keys(*row[1:])
+                if not has_id:
+                    keys.pop('customer_id_key')
+                updates.append(dict(keys, id=row[0]))
+            db.session.execute(update(model), updates)
+            db.session.commit()
+            filled += len(rows)
+            last_id = rows[-1][0]
+    return filled
+
+def customer_history(term, page=1, per_page=CUSTOMER_PAGE_SIZE):
+    """Phones bought from and sales made to the customer matching `term`, newest first.
+
+    A term made of digits is matched exactly against the normalized phone numbers
+    and national IDs, anything else as the prefix of the normalized names.
+    Returns (rows, has_next) from one paged query.
+    """
+    phone_key, id_key, name_key = normalize_phone_number(term), normalize_national_id(term), normalize_text(term)
+    by_number = bool(phone_key) and not re.search(r'[^0-9\s+\-()]', term.translate(ARABIC_DIGITS))
+    if not by_number and not name_key:
+        return [], False
+
+    def matches(model):
+        if by_number:
+            conditions = [model.customer_phone_key == phone_key]
+            if 'customer_id_key' in model.__table__.c:
+                conditions.append(model.customer_id_key == id_key)
+            return db.or_(*conditions)
+        return prefix_match(model.customer_name_key, name_key)
+
+    intake = [
+        select(literal('intake').label('kind'), model.id.label('record_id'), model.date_added.label('date'),
+               model.customer_name, model.customer_phone, model.customer_id,
+               (model.brand + ' ' + model.model).label('item'),
+               model.purchase_price_with_vat.label('amount'), model.phone_number.label('reference'))
+        .where(matches(model))
+        for model in (Phone, PhoneHistory)
+    ]
+    sales = select(literal('sale').label('kind'), Sale.id.label('record_id'), Sale.date_created.label('date'),
+                   Sale.customer_name, Sale.customer_phone, db.cast(db.null(), db.String(50)).label('customer_id'),
+                   db.cast(db.null(), db.String(200)).label('item'),
+                   Sale.total_amount.label('amount'), Sale.sale_number.label('reference')).where(matches(Sale))
+    history = union_all(*intake, sales).subquery('customer_history')
+    rows = db.session.execute(
+        select(history).order_by(history.c.date.desc(), history.c.record_id.desc())
+        .limit(per_page + 1).offset((page - 1) * per_page)).all()
+    return rows[:per_page], len(rows) > per_page
+
+@app.route('/customers')
+@login_required
+def customer_lookup():
+    """Buy and sell history of a customer by mobile number, national ID or name"""
+    term = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    history, has_next = customer_history(term, page) if term else ([], False)
+    return render_template('customers.html', term=term, history=history, page=page, has_next=has_next)
+
+# Typeahead. Brands, models, accessory names and categories are held per worker in
+# sorted arrays of normalize_text() keys and searched with bisect, so a lookup is
+# O(log n + k) with no SQL beyond the table versions. Every word of a label is a
+# key too ("pro max" finds "iPhone 15 Pro Max"), ranked after the label-start
+# matches. Only accessories in stock are listed, since the sale page cannot add
+# the others. Each source is rebuilt on its own when its version changes, in every
+# worker. Accessories use the accessory_names stamp: it changes when an accessory
+# is added, renamed, recategorized, deleted, sold out or restocked from zero, but
+# not with other stock updates. A whole rebuild was chosen over patching the
+# sorted arrays in place, because the other workers would still have to find out
+# which rows changed. It takes about 150 ms per 10,000 accessories and runs on
+# those rare changes only, never on an ordinary sale.
+TYPEAHEAD_LIMIT = 10
+
+@event.listens_for(Accessory, 'after_insert')
+@event.listens_for(Accessory, 'after_delete')
+def mark_accessory_names_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_tables', set()).add('accessory_names')
+
+@event.listens_for(Accessory, 'after_update')
+def mark_accessory_renamed(mapper, connection, target):
+    attrs = inspect(target).attrs
+    was_in_stock = previous_value(target, 'quantity_in_stock') > 0
+    if (attrs.name.history.has_changes() or attrs.category.history.has_changes()
+            or was_in_stock != (target.quantity_in_stock > 0)):
+        mark_accessory_names_changed(mapper, connection, target)
+
+class PrefixIndex:
+    """Items searchable by the prefix of their label or of any later word of it"""
+
+    def __init__(self, items, labels=lambda item: [item['label']]):
+        starts, words = [], []
+        for position, item in enumerate(items):
+            for label in labels(item):
+                key = normalize_text(label)
+                if not key:
+                    continue
+                starts.append((key, position))
+                parts = key.split(' ')
+                words.extend((' '.join(parts[i:]), position) for i in range(1, len(parts)))
+        self.items = items
+        self.starts = sorted(starts)
+        self.words = sorted(words)
+
+    def search(self, prefix, limit):
+        """Up to `limit` items, label-start matches first, each group in key order"""
+        found = []
+        seen = set()
+        for keys in (self.starts, self.words):
+            index = bisect.bisect_left(keys, (prefix,))
+            while index < len(keys) and keys[index][0].startswith(prefix) and len(found) < limit:
+                position = keys[index][1]
+                if position not in seen:
+                    seen.add(position)
+                    found.append(self.items[position])
+                index += 1
+        return found
+
+def phone_type_items():
+    brands = phone_catalog()
+    return [{'type': 'brand', 'brand': brand, 'label': brand} for brand in brands] + [
+        {'type': 'model', 'brand': brand, 'model': model, 'label': f'{brand} {model}'}
+        for brand, models in brands.items() for model in models]
+
+def accessory_items():
+    return [{'type': 'accessory', 'id': accessory_id, 'category': category, 'label': name}
+            for accessory_id, name, category in
+            db.session.query(Accessory.id, Accessory.name, Accessory.category)
+            .filter(Accessory.quantity_in_stock > 0).order_by(Accessory.id)]
+
+def category_items():
+    return [{'type': 'category', 'name': category.name, 'label': category.arabic_name}
+            for category in accessory_category_catalog()]
+
+TYPEAHEAD_SOURCES = {
+    # source: (version stamp, items, labels to index)
+    'phone_types': ('phone_type', phone_type_items, lambda item: [item['label']] + ([item['model']] if 'model' in item else [])),
+    'accessories': ('accessory_names', accessory_items, lambda item: [item['label']]),
+    'categories': ('accessory_category', category_items, lambda item: [item['label'], item['name']]),
+}
+_typeahead_indexes = {}
+
+def typeahead_index(source):
+    """PrefixIndex of one source for the current version of its stamp"""
+    stamp, items, labels = TYPEAHEAD_SOURCES[source]
+    version = table_versions().get(stamp, 0)
+    cached = _typeahead_indexes.get(source)
+    if cached is None or cached[0] != version:
+        cached = (version, PrefixIndex(items(), labels))
+        _typeahead_indexes[source] = cached
+    return cached[1]
+
+def typeahead(prefix, sources=tuple(TYPEAHEAD_SOURCES), limit=TYPEAHEAD_LIMIT):
+    """Top `limit` matches for what has been typed so far, source by source"""
+    key = normalize_text(prefix)
+    if not key:
+        return []
+    matches = []
+    for source in sources:
+        matches.extend(typeahead_index(source).search(key, limit - len(matches)))
+        if len(matches) >= limit:
+            break
+    return matches
+
+@app.route('/get_typeahead_ajax')
+@login_required
+def get_typeahead_ajax():
+    """Brands, models, accessories and categories starting with q (type=phone|accessory to narrow)"""
+    sources = {'phone': ('phone_types',), 'accessory': ('accessories', 'categories')}.get(
+        request.args.get('type', ''), tuple(TYPEAHEAD_SOURCES))
+    limit = min(max(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), 1), 50)
+    try:
+        return jsonify({'success': True, 'items': typeahead(request.args.get('q', ''), sources, limit)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'حدث خطأ: {str(e)}'})
+
 
 
 @app.route('/sales')
@@ -1965,8 +3998,9 @@ def list_sales():
     filter_month_month = request.args.get('filter_month_month', '')
     filter_year = request.args.get('filter_year', '')
     
+    reports = report_session()
     # Base query
-    query = Sale.query
+    query = reports.query(Sale)
     
     # Apply filters
     if filter_type == 'day' and filter_date:
@@ -2003,8 +4037,17 @@ def list_sales():
         except ValueError:
             pass
     
-    # Get filtered sales
-    sales = query.order_by(Sale.date_created.desc()).all()
+    # Get filtered sales, with the item count of each in the same query
+    item_count = (
+        select(func.count(SaleItem.id))
+        .where(SaleItem.sale_id == Sale.id)
+        .correlate(Sale)
+        .scalar_subquery()
+    )
+    sales = []
+    for sale, count in query.add_columns(item_count.label('item_count')).order_by(Sale.date_created.desc()):
+        sale.item_count = count
+        sales.append(sale)
     
     # Calculate summary statistics for filtered results
     total_sales_count = len(sales)
@@ -2031,6 +4074,542 @@ def list_sales():
                          current_year=current_year,
                          current_month=current_month)
 
+# VAT returns (إقرارات ضريبة القيمة المضافة)
+VAT_EXCLUDED_SALE_STATUSES = ['ملغي', 'مرفوض']
+VAT_FIGURE_FIELDS = ('sales_count', 'sales_subtotal', 'output_vat',
+                     'purchases_count', 'purchases_subtotal', 'input_vat')
+
+# Frozen figures of closed periods, kept per worker. A closed period never
+# changes, so once loaded it is never recomputed or re-read from the database.
+_closed_vat_returns = {}
+
+def parse_vat_period(period_key):
+    """Return (start, end) for a period key such as '2024-03' or '2024-Q1' (end is exclusive)"""
+    if '-Q' in period_key:
+        year, quarter = period_key.split('-Q')
+        year, quarter = int(year), int(quarter)
+        if not 1 <= quarter <= 4:
+            raise ValueError(f"Invalid VAT period: {period_key}")
+        start_month, months = (quarter - 1) * 3 + 1, 3
+    else:
+        year, month = period_key.split('-')
+        year, start_month, months = int(year), int(month), 1
+        if not 1 <= start_month <= 12:
+            raise ValueError(f"Invalid VAT period: {period_key}")
+    end_month = start_month + months
+    start = datetime(year, start_month, 1)
+    end = datetime(year + (end_month - 1) // 12, (end_month - 1) % 12 + 1, 1)
+    return start, end
+
+def vat_period_keys(year, period_type):
+    """All month or quarter keys of a year"""
+    if period_type == 'quarter':
+        return [f"{year}-Q{quarter}" for quarter in range(1, 5)]
+    return [f"{year}-{month:02d}" for month in range(1, 13)]
+
+def vat_sales_filter(start, end):
+    """Sales that carry output VAT for the period [start, end)"""
+    return [
+        Sale.date_created >= start,
+        Sale.date_created < end,
+        db.or_(Sale.status.is_(None), Sale.status.notin_(VAT_EXCLUDED_SALE_STATUSES)),
+    ]
+
+def vat_purchases_filter(start, end):
+    """Buy transactions that carry input VAT for the period [start, end)"""
+    return [
+        Transaction.transaction_type == 'buy',
+        Transaction.date_created >= start,
+        Transaction.date_created < end,
+    ]
+
+def compute_monthly_vat(start, end):
+    """Output and input VAT per calendar month in [start, end).
+
+    Runs one grouped SQL aggregation per source table: sales for output VAT
+    and buy transactions for input VAT.
+    """
+    monthly = {}
+
+    def month_row(year, month):
+        return monthly.setdefault(f"{int(year)}-{int(month):02d}", dict.fromkeys(VAT_FIGURE_FIELDS, 0))
+
+    sale_year = func.extract('year', Sale.date_created)
+    sale_month = func.extract('month', Sale.date_created)
+    sales = db.session.query(
+        sale_year, sale_month,
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.subtotal), 0.0),
+        func.coalesce(func.sum(Sale.vat_amount), 0.0)
+    ).filter(*vat_sales_filter(start, end)).group_by(sale_year, sale_month).all()
+    for year, month, count, subtotal, vat in sales:
+        row = month_row(year, month)
+        row['sales_count'], row['sales_subtotal'], row['output_vat'] = count, float(subtotal), float(vat)
+
+    tx_year = func.extract('year', Transaction.date_created)
+    tx_month = func.extract('month', Transaction.date_created)
+    purchases = db.session.query(
+        tx_year, tx_month,
+        func.count(Transaction.id),
+        func.coalesce(func.sum(Transaction.price), 0.0),
+        func.coalesce(func.sum(Transaction.vat_amount), 0.0)
+    ).filter(*vat_purchases_filter(start, end)).group_by(tx_year, tx_month).all()
+    for year, month, count, subtotal, vat in purchases:
+        row = month_row(year, month)
+        row['purchases_count'], row['purchases_subtotal'], row['input_vat'] = count, float(subtotal), float(vat)
+
+    return monthly
+
+def summarize_vat_period(period_key, monthly):
+    """Roll the monthly figures up into one period and add the net VAT payable"""
+    start, end = parse_vat_period(period_key)
+    figures = dict.fromkeys(VAT_FIGURE_FIELDS, 0)
+    for month_key, row in monthly.items():
+        if start <= datetime.strptime(month_key, '%Y-%m') < end:
+            for field in VAT_FIGURE_FIELDS:
+                figures[field] += row[field]
+    figures['net_vat'] = figures['output_vat'] - figures['input_vat']
+    return figures
+
+def load_closed_vat_returns(period_keys):
+    """Frozen figures of the closed periods among period_keys"""
+    missing = [key for key in period_keys if key not in _closed_vat_returns]
+    if missing:
+        for vat_return in VatReturn.query.filter(VatReturn.period_key.in_(missing)).all():
+            figures = {field: getattr(vat_return, field) for field in VAT_FIGURE_FIELDS}
+            figures['net_vat'] = vat_return.net_vat
+            figures['date_closed'] = vat_return.date_closed
+            _closed_vat_returns[vat_return.period_key] = figures
+    return {key: _closed_vat_returns[key] for key in period_keys if key in _closed_vat_returns}
+
+def get_vat_returns(year, period_type='month'):
+    """VAT figures for every month or quarter of a year.
+
+    Closed periods come from their frozen VatReturn rows; open periods are
+    aggregated live in a single pass over the span they cover.
+    """
+    keys = vat_period_keys(year, period_type)
+    closed = load_closed_vat_returns(keys)
+    open_keys = [key for key in keys if key not in closed]
+
+    monthly = {}
+    if open_keys:
+        monthly = compute_monthly_vat(parse_vat_period(open_keys[0])[0], parse_vat_period(open_keys[-1])[1])
+
+    now = datetime.utcnow()
+    returns = []
+    for key in keys:
+        start, end = parse_vat_period(key)
+        if key in closed:
+            figures = dict(closed[key], is_closed=True)
+        else:
+            figures = dict(summarize_vat_period(key, monthly), is_closed=False, date_closed=None)
+        figures.update(period_key=key, period_start=start, period_end=end,
+                       can_close=not figures['is_closed'] and end <= now)
+        returns.append(figures)
+    return returns
+
+def close_vat_period(period_key, user_id):
+    """Freeze the figures of a finished period so they are never recomputed"""
+    start, end = parse_vat_period(period_key)
+    if end > datetime.utcnow():
+        raise ValueError('لا يمكن إغلاق فترة لم تنتهِ بعد')
+    if VatReturn.query.filter_by(period_key=period_key).first():
+        raise ValueError('هذه الفترة مغلقة بالفعل')
+
+    figures = summarize_vat_period(period_key, compute_monthly_vat(start, end))
+    vat_return = VatReturn(
+        period_key=period_key,
+        period_start=start,
+        period_end=end,
+        closed_by=user_id,
+        **figures
+    )
+    db.session.add(vat_return)
+    db.session.commit()
+    return vat_return
+
+@app.route('/vat_returns')
+@login_required
+def vat_returns():
+    """VAT returns per month or quarter"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+
+    current_year = datetime.now().year
+    year = request.args.get('year', current_year, type=int)
+    period_type = request.args.get('period_type', 'month')
+    if period_type not in ('month', 'quarter'):
+        period_type = 'month'
+
+    returns = get_vat_returns(year, period_type)
+    totals = {field: sum(r[field] for r in returns) for field in ('output_vat', 'input_vat', 'net_vat')}
+
+    return render_template('vat_returns.html',
+                         returns=returns,
+                         totals=totals,
+                         year=year,
+                         period_type=period_type,
+                         current_year=current_year)
+
+@app.route('/vat_returns/close', methods=['POST'])
+@login_required
+def close_vat_return():
+    """Close a VAT period and freeze its figures"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+
+    period_key = request.form.get('period_key', '')
+    try:
+        close_vat_period(period_key, current_user.id)
+        flash(f'تم إغلاق الفترة {period_key} وتجميد أرقامها', 'success')
+    except ValueError as e:
+        flash(str(e), 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'حدث خطأ أثناء إغلاق الفترة: {str(e)}', 'error')
+
+    return redirect(url_for('vat_returns',
+                            year=request.form.get('year', ''),
+                            period_type=request.form.get('period_type', 'month')))
+
+@app.route('/vat_returns/<period_key>/documents')
+@login_required
+def vat_return_documents(period_key):
+    """Stream the sales and purchases behind a VAT period as CSV"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+
+    try:
+        start, end = parse_vat_period(period_key)
+    except ValueError:
+        flash('الفترة الضريبية غير صحيحة', 'error')
+        return redirect(url_for('vat_returns'))
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')  # BOM so Excel opens the Arabic text correctly
+        writer.writerow(['النوع', 'رقم المستند', 'التاريخ', 'العميل', 'المبلغ قبل الضريبة', 'الضريبة', 'الإجمالي'])
+
+        sales = db.session.query(
+            Sale.sale_number, Sale.date_created, Sale.customer_name,
+            Sale.subtotal, Sale.vat_amount, Sale.total_amount
+        ).filter(*vat_sales_filter(start, end)).order_by(Sale.date_created).yield_per(500)
+        for number, date_created, customer, subtotal, vat, total in sales:
+            writer.writerow(['مبيعات', number, date_created.strftime('%Y-%m-%d %H:%M'), customer or '',
+                             f"{subtotal:.2f}", f"{vat:.2f}", f"{total:.2f}"])
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        purchases = db.session.query(
+            Transaction.serial_number, Transaction.date_created, Transaction.customer_name,
+            Transaction.price, Transaction.vat_amount, Transaction.price_with_vat
+        ).filter(*vat_purchases_filter(start, end)).order_by(Transaction.date_created).yield_per(500)
+        for serial, date_created, customer, price, vat, total in purchases:
+            writer.writerow(['مشتريات', serial, date_created.strftime('%Y-%m-%d %H:%M'), customer or '',
+                             f"{price:.2f}", f"{vat:.2f}", f"{total:.2f}"])
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=vat_{period_key}_documents.csv'}
+    )
+
+# Profit cube. Units, revenue and cost of the sold items per year, month, product
+# type and brand/model (phones) or category (accessories), so the analytics page
+# slices a few hundred cells instead of scanning every SaleItem. Sale items are
+# append-only: refresh_profit_cube() folds the rows past its watermark into the
+# cube with one grouped INSERT ... ON CONFLICT DO UPDATE, and
+# `flask --app app rebuild-profit-cube` recomputes whole months with the same
+# statement (back-fills, corrected purchase prices). Rows are folded once their
+# sale is PROFIT_CUBE_SETTLE_SECONDS old, so a sale still committing under a
+# lower id is not stepped over by the watermark.
+PROFIT_CUBE_SETTLE_SECONDS = int(os.environ.get('PROFIT_CUBE_SETTLE_SECONDS', 60))
+PROFIT_CUBE_DIMENSIONS = ('year', 'month', 'product_type', 'brand', 'model', 'category')
+PROFIT_CUBE_MEASURES = ('units', 'revenue', 'cost')
+
+def profit_cube_source(after_id, up_to_id, since=None):
+    """Cube cells of the SaleItem rows after_id < id <= up_to_id (of sales from `since` on), grouped in SQL"""
+    phones = union_all(
+        select(Phone.serial_number, Phone.brand, Phone.model),
+        select(PhoneHistory.serial_number, PhoneHistory.brand, PhoneHistory.model)).subquery('phones')
+    categories = select(Accessory.name, func.min(Accessory.category).label('category')) \
+        .group_by(Accessory.name).subquery('categories')
+    is_phone = SaleItem.product_type == 'phone'
+    dimensions = [
+        db.cast(func.extract('year', Sale.date_created), db.Integer).label('year'),
+        db.cast(func.extract('month', Sale.date_created), db.Integer).label('month'),
+        SaleItem.product_type,
+        db.case((is_phone, func.coalesce(phones.c.brand, '')), else_='').label('brand'),
+        db.case((is_phone, func.coalesce(phones.c.model, '')), else_='').label('model'),
+        db.case((is_phone, ''), else_=func.coalesce(categories.c.category, '')).label('category'),
+    ]
+    query = select(
+        *dimensions,
+        func.sum(SaleItem.quantity).label('units'),
+        func.sum(calculate_price_without_vat(SaleItem.unit_price) * SaleItem.quantity).label('revenue'),  # unit prices include VAT
+        func.sum(SaleItem.purchase_price * SaleItem.quantity).label('cost'),
+    ).select_from(SaleItem).join(Sale, SaleItem.sale_id == Sale.id) \
+        .outerjoin(phones, db.and_(is_phone, phones.c.serial_number == SaleItem.serial_number)) \
+        .outerjoin(categories, db.and_(~is_phone, categories.c.name == SaleItem.product_name)) \
+        .where(SaleItem.id > after_id, SaleItem.id <= up_to_id,
+               db.or_(Sale.status.is_(None), Sale.status.notin_(VAT_EXCLUDED_SALE_STATUSES)))
+    if since:
+        query = query.where(Sale.date_created >= since)
+    return query.group_by(*dimensions)
+
+def merge_into_profit_cube(source):
+    """Add the grouped rows of `source` to their cube cells, creating the missing cells"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    cube = ProfitCube.__table__
+    statement = upsert(cube).from_select(PROFIT_CUBE_DIMENSIONS + PROFIT_CUBE_MEASURES, source)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=list(PROFIT_CUBE_DIMENSIONS),
+        set_={name: cube.c[name] + statement.excluded[name] for name in PROFIT_CUBE_MEASURES}))
+
+def refresh_profit_cube():
+    """Fold the settled SaleItem rows past the watermark into the cube; returns the watermark"""
+    watermark = db.session.get(AggregateWatermark, 'profit_cube')
+    last_id = watermark.last_id if watermark else 0
+    cutoff = datetime.utcnow() - timedelta(seconds=PROFIT_CUBE_SETTLE_SECONDS)
+    up_to_id = db.session.query(func.max(SaleItem.id)).join(Sale, SaleItem.sale_id == Sale.id) \
+        .filter(SaleItem.id > last_id, Sale.date_created < cutoff).scalar()
+    if not up_to_id:
+        return last_id
+    try:
+        if watermark is None:
+            db.session.add(AggregateWatermark(name='profit_cube', last_id=up_to_id))
+            db.session.flush()
+        else:
+            # Compare-and-set - of two workers refreshing at once, the second folds nothing
+            moved = db.session.execute(
+                update(AggregateWatermark.__table__)
+                .where(AggregateWatermark.name == 'profit_cube', AggregateWatermark.last_id == last_id)
+                .values(last_id=up_to_id, date_updated=datetime.utcnow())).rowcount
+            if not moved:
+                db.session.rollback()
+                return last_id
+        merge_into_profit_cube(profit_cube_source(last_id, up_to_id))
+        db.session.commit()
+    except IntegrityError:  # another worker created the watermark first
+        db.session.rollback()
+        return last_id
+    except Exception:
+        db.session.rollback()
+        raise
+    return up_to_id
+
+def rebuild_profit_cube(since=None):
+    """Recompute the cube cells from SaleItem - all of them, or those of the months from `since` on"""
+    refresh_profit_cube()
+    cube = ProfitCube.__table__
+    try:
+        # Holding the watermark row keeps refreshes from folding rows in while the cells are rebuilt
+        db.session.execute(update(AggregateWatermark.__table__).where(AggregateWatermark.name == 'profit_cube')
+                           .values(date_updated=datetime.utcnow()))
+        up_to_id = db.session.query(AggregateWatermark.last_id).filter_by(name='profit_cube').scalar() or 0
+        stale = cube.delete()
+        if since:
+            since = datetime(since.year, since.month, 1)
+            stale = stale.where(cube.c.year * 100 + cube.c.month >= since.year * 100 + since.month)
+        db.session.execute(stale)
+        merge_into_profit_cube(profit_cube_source(0, up_to_id, since=since))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return up_to_id
+
+def query_profit_cube(group_by=('product_type',), start=None, end=None, **filters):
+    """Cube measures summed per `group_by` over the months in [start, end), restricted to the
+    dimension values in `filters` (e.g. product_type='phone'); adds margin and margin_percent"""
+    for name in tuple(group_by) + tuple(filters):
+        if name not in PROFIT_CUBE_DIMENSIONS:
+            raise ValueError(f"Unknown profit cube dimension: {name}")
+    dimensions = [getattr(ProfitCube, name) for name in group_by]
+    period = ProfitCube.year * 100 + ProfitCube.month
+    query = db.session.query(
+        *dimensions,
+        func.sum(ProfitCube.units).label('units'),
+        func.sum(ProfitCube.revenue).label('revenue'),
+        func.sum(ProfitCube.cost).label('cost'))
+    if start:
+        query = query.filter(period >= start.year * 100 + start.month)
+    if end:
+        query = query.filter(period < end.year * 100 + end.month)
+    for name, value in filters.items():
+        query = query.filter(getattr(ProfitCube, name) == value)
+    rows = []
+    for row in query.group_by(*dimensions).order_by(*dimensions).all():
+        cell = dict(row._mapping)
+        cell['margin'] = cell['revenue'] - cell['cost']
+        cell['margin_percent'] = cell['margin'] / cell['revenue'] * 100 if cell['revenue'] else 0.0
+        rows.append(cell)
+    return rows
+
+@app.cli.command('rebuild-profit-cube')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m', '%Y-%m-%d']),
+              help='Only recompute the months from this one on (default: everything).')
+def rebuild_profit_cube_command(since):
+    """Recompute the profit cube from the sale items - after back-filled or corrected sales."""
+    up_to_id = rebuild_profit_cube(since)
+    print(f"Profit cube rebuilt{f' from {since:%Y-%m}' if since else ''} up to sale item {up_to_id}")
+
+PROFIT_GROUPINGS = {
+    'product_type': ('product_type',),
+    'brand': ('brand',),
+    'model': ('brand', 'model'),
+    'category': ('category',),
+}
+
+@app.route('/analytics')
+@login_required
+def profit_analytics():
+    """Revenue, cost and margin per month and per product group, from the profit cube"""
+    if not current_user.is_admin:
+        return redirect(url_for('limited_dashboard'))
+
+    current_year = datetime.now().year
+    year = request.args.get('year', current_year, type=int)
+    grouping = request.args.get('group', 'product_type')
+    if grouping not in PROFIT_GROUPINGS:
+        grouping = 'product_type'
+    product_type = request.args.get('product_type', '')
+    filters = {'product_type': product_type} if product_type in ('phone', 'accessory') else {}
+
+    refresh_profit_cube()
+    start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    by_month = {row['month']: row for row in query_profit_cube(('month',), start, end, **filters)}
+    empty = {'units': 0, 'revenue': 0.0, 'cost': 0.0, 'margin': 0.0, 'margin_percent': 0.0}
+    months = [dict(by_month.get(month, empty), month=month) for month in range(1, 13)]
+    groups = sorted(query_profit_cube(PROFIT_GROUPINGS[grouping], start, end, **filters),
+                    key=lambda row: row['margin'], reverse=True)
+    totals = {name: sum(row[name] for row in months) for name in ('units', 'revenue', 'cost', 'margin')}
+    totals['margin_percent'] = totals['margin'] / totals['revenue'] * 100 if totals['revenue'] else 0.0
+
+    return render_template('analytics.html',
+                         months=months,
+                         groups=groups,
+                         totals=totals,
+                         year=year,
+                         grouping=grouping,
+                         product_type=product_type,
+                         current_year=current_year)
+
+# Sales time series for the trend charts. The bucket is the finest of hour, day,
+# week and month that keeps the range within SERIES_MAX_POINTS points, and the
+# buckets are summed in SQL (date_trunc on Postgres, strftime on SQLite), so a
+# five-year chart is about 260 weekly rows. A computed series is kept in the fragment
+# cache until the next sale.
+SERIES_MAX_POINTS = int(os.environ.get('SERIES_MAX_POINTS', 400))
+SERIES_BUCKETS = (
+    ('hour', timedelta(hours=1)),
+    ('day', timedelta(days=1)),
+    ('week', timedelta(weeks=1)),
+    ('month', timedelta(days=31)),
+)
+
+def pick_series_bucket(start, end, max_points=SERIES_MAX_POINTS):
+    """Finest bucket with at most max_points buckets in [start, end), or None if even months are too many"""
+    for bucket, width in SERIES_BUCKETS:
+        if (end - start) / width <= max_points:
+            return bucket
+    return None
+
+def bucket_start(column, bucket):
+    """SQL expression truncating a datetime column to the start of its bucket (weeks start on Monday)"""
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc(bucket, column)
+    if bucket == 'week':
+        return func.date(column, 'weekday 0', '-6 days')
+    return func.strftime({'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d', 'month': '%Y-%m-01'}[bucket], column)
+
+def floor_to_bucket(moment, bucket):
+    """Python counterpart of bucket_start()"""
+    if bucket == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+def next_bucket(moment, bucket):
+    if bucket == 'month':
+        return (moment.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return moment + dict(SERIES_BUCKETS)[bucket]
+
+def sales_series(start, end, bucket):
+    """Sales count, revenue and profit (before VAT) per bucket in [start, end), empty buckets included"""
+    sale_bucket = bucket_start(Sale.date_created, bucket)
+    sales = db.session.query(
+        sale_bucket,
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.subtotal), 0.0)
+    ).filter(*vat_sales_filter(start, end)).group_by(sale_bucket).all()
+    profits = db.session.query(
+        sale_bucket,
+        func.coalesce(func.sum(
+            (calculate_price_without_vat(SaleItem.unit_price) - SaleItem.purchase_price) * SaleItem.quantity), 0.0)
+    ).join(Sale, SaleItem.sale_id == Sale.id).filter(*vat_sales_filter(start, end)).group_by(sale_bucket).all()
+
+    def as_datetime(key):  # SQLite returns the bucket as text
+        return key if isinstance(key, datetime) else datetime.fromisoformat(key)
+
+    points = {}
+    moment = floor_to_bucket(start, bucket)
+    while moment < end:
+        points[moment] = {'t': moment.isoformat(), 'sales': 0, 'revenue': 0.0, 'profit': 0.0}
+        moment = next_bucket(moment, bucket)
+    for key, count, revenue in sales:
+        point = points.get(as_datetime(key))
+        if point:
+            point['sales'], point['revenue'] = count, round(float(revenue), 2)
+    for key, profit in profits:
+        point = points.get(as_datetime(key))
+        if point:
+            point['profit'] = round(float(profit), 2)
+    return list(points.values())
+
+@app.route('/get_sales_series_ajax')
+@login_required
+def get_sales_series_ajax():
+    """Sales, revenue and profit per bucket from start to end (YYYY-MM-DD, both included) for charts"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'غير مصرح'}), 403
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) \
+            if request.args.get('end') else floor_to_bucket(datetime.utcnow(), 'day') + timedelta(days=1)
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') \
+            if request.args.get('start') else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'صيغة التاريخ غير صحيحة (YYYY-MM-DD)'}), 400
+    max_points = min(request.args.get('points', SERIES_MAX_POINTS, type=int) or SERIES_MAX_POINTS, SERIES_MAX_POINTS)
+    if start >= end:
+        return jsonify({'success': False, 'message': 'تاريخ البداية يجب أن يسبق تاريخ النهاية'}), 400
+    bucket = pick_series_bucket(start, end, max_points)
+    if bucket is None:
+        return jsonify({'success': False, 'message': 'الفترة طويلة جداً لعدد النقاط المطلوب'}), 400
+
+    def render():
+        return json.dumps({'success': True, 'bucket': bucket, 'start': start.isoformat(), 'end': end.isoformat(),
+                           'points': sales_series(start, end, bucket)})
+    body = cached_fragment('sales_series', (Sale,), render, start, end, bucket)
+    return Response(str(body), mimetype='application/json')
+
 # Invoices route removed - replaced by sales system
 
 
@@ -2038,16 +4617,19 @@ def list_sales():
 @app.route('/inventory_summary')
 @login_required
 def inventory_summary():
+    reports = report_session()
+    # Only phones in stock - sold ones are on the sales pages
+    in_stock = reports.query(Phone).filter_by(status='available')
     # Get total phones count
-    total_phones = Phone.query.count()
+    total_phones = in_stock.count()
     
     # Get new and used phones counts
-    new_phones_count = Phone.query.filter_by(condition='new').count()
-    used_phones_count = Phone.query.filter_by(condition='used').count()
+    new_phones_count = in_stock.filter_by(condition='new').count()
+    used_phones_count = in_stock.filter_by(condition='used').count()
     
     # Get values for new and used phones
-    new_phones = Phone.query.filter_by(condition='new').all()
-    used_phones = Phone.query.filter_by(condition='used').all()
+    new_phones = in_stock.filter_by(condition='new').all()
+    used_phones = in_stock.filter_by(condition='used').all()
     
     # Calculate purchase and selling values
     new_phones_purchase_value = sum(phone.purchase_price for phone in new_phones)
@@ -2064,32 +4646,32 @@ def inventory_summary():
     total_profit = total_selling_value - total_purchase_value
     
     # Get phone type summary (new vs used)
-    phone_type_summary = db.session.query(
+    phone_type_summary = reports.query(
         Phone.condition,
         func.count(Phone.id).label('total_phones'),
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).group_by(Phone.condition).all()
+    ).filter_by(status='available').group_by(Phone.condition).all()
     
     # Get brand and model summary within each phone type
-    new_phones_brand_summary = db.session.query(
+    new_phones_brand_summary = reports.query(
         Phone.brand,
         Phone.model,
         func.count(Phone.id).label('total_phones'),
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).filter_by(condition='new').group_by(Phone.brand, Phone.model).all()
+    ).filter_by(status='available', condition='new').group_by(Phone.brand, Phone.model).all()
     
-    used_phones_brand_summary = db.session.query(
+    used_phones_brand_summary = reports.query(
         Phone.brand,
         Phone.model,
         func.count(Phone.id).label('total_phones'),
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).filter_by(condition='used').group_by(Phone.brand, Phone.model).all()
+    ).filter_by(status='available', condition='used').group_by(Phone.brand, Phone.model).all()
     
     return render_template('inventory_summary.html',
                          total_phones=total_phones,
@@ -2154,7 +4736,8 @@ def delete_phone_type_ajax():
             return jsonify({'success': False, 'message': 'الموديل غير موجود'})
         
         # Check if any phones are using this type
-        phones_using_type = Phone.query.filter_by(brand=brand, model=model).count()
+        phones_using_type = sum(phone_model.query.filter_by(brand=brand, model=model).count()
+                                for phone_model in (Phone, PhoneHistory))
         if phones_using_type > 0:
             return jsonify({'success': False, 'message': f'لا يمكن حذف هذا الموديل لأنه مستخدم في {phones_using_type} هاتف'})
         
@@ -2172,14 +4755,17 @@ def delete_phone_type_ajax():
 def get_phone_types_ajax():
     """Get phone types for AJAX"""
     try:
-        phone_types = PhoneType.query.all()
-        brands = {}
-        for phone_type in phone_types:
-            if phone_type.brand not in brands:
-                brands[phone_type.brand] = []
-            brands[phone_type.brand].append(phone_type.model)
-        
-        return jsonify({'success': True, 'brands': brands})
+        return catalog_response('phone_types', PhoneType, lambda: {'success': True, 'brands': phone_catalog()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'حدث خطأ: {str(e)}'})
+
+@app.route('/get_low_stock_ajax')
+@login_required
+def get_low_stock_ajax():
+    """Accessories at or below their minimum quantity for AJAX"""
+    try:
+        items = [low_stock_item(accessory) for accessory in low_stock_accessories()]
+        return jsonify({'success': True, 'count': len(items), 'items': items})
     except Exception as e:
         return jsonify({'success': False, 'message': f'حدث خطأ: {str(e)}'})
 
@@ -2250,9 +4836,8 @@ def delete_accessory_category_ajax():
 def get_accessory_categories_ajax():
     """Get accessory categories for AJAX"""
     try:
-        categories = AccessoryCategory.query.all()
-        category_list = [category.arabic_name for category in categories]
-        return jsonify({'success': True, 'categories': category_list})
+        return catalog_response('accessory_categories', AccessoryCategory, lambda: {
+            'success': True, 'categories': [category.arabic_name for category in accessory_category_catalog()]})
     except Exception as e:
         return jsonify({'success': False, 'message': f'حدث خطأ: {str(e)}'})
 
@@ -2265,15 +4850,17 @@ def sold_phones():
     if not current_user.is_admin:
         return redirect(url_for('limited_dashboard'))
     
-    # Get all sold phones with their sale information
-    sold_phones = Phone.query.filter_by(status="sold").order_by(Phone.sold_date.desc()).all()
+    def render_table():
+        # Get all sold phones with their sale information, archived ones included
+        return render_template('partials/sold_phones_table.html', sold_phones=sold_phone_rows())
     
-    return render_template('sold_phones.html', sold_phones=sold_phones)
+    return render_template('sold_phones.html',
+                         sold_phones_table=cached_fragment('sold_phones_table', (Phone, PhoneHistory), render_table))
 
 # sell_phone route removed - replaced by comprehensive sales system
 
 if __name__ == '__main__':
-    with app.app_context():
+    with app.app_context(), database_init_lock():
         # Initialize database with proper error handling
         initialize_database()
     
@@ -0,0 +1,300 @@
+"""Compare gunicorn configurations on a mixed POS / report workload.
+
+    python bench_gunicorn.py
+    python bench_gunicorn.py --duration 30 --clients 16 --config 1x1 --config 3x1 --config 2x4
+
+Each configuration (WORKERSxTHREADS) is started with gunicorn.conf.py against the
+same throw-away SQLite database, then hit by client threads for a fixed time:
+cashier traffic (search, catalog AJAX, create_sale), report pages (dashboard,
+sales, inventory summary) and sticker PDFs. Prints throughput and latency
+percentiles per configuration and per request group.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (name, group, weight)
+WORKLOAD = [
+    ('search', 'pos', 30),
+    ('phone_types', 'pos', 15),
+    ('create_sale', 'pos', 20),
+    ('dashboard', 'report', 10),
+    ('sales', 'report', 8),
+    ('inventory_summary', 'report', 7),
+    ('barcode_pdf', 'label', 10),
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_database(database_url, phones, accessories, sales):
+    """Create the schema and a small shop's worth of stock and sales"""
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, REPO_DIR)
+    import app as shop
+
+    with shop.app.app_context():
+        shop.db.create_all()
+        shop.initialize_database()
+
+        numbers = shop.allocate_phone_numbers(phones)
+        shop.db.session.add_all([
+            shop.Phone(
+                brand='Apple', model=f'iPhone {12 + i % 4}', condition='new',
+                purchase_price=2600, selling_price=3000,
+                purchase_price_with_vat=2990, selling_price_with_vat=3450,
+                serial_number=f'BENCH{i:08d}', phone_number=number,
+                warranty=12, status='available',
+            )
+            for i, number in enumerate(numbers)
+        ])
+        shop.db.session.add_all([
+            shop.Accessory(
+                name=f'شاحن {i}', category='charger', barcode=f'ACC-BENCH-{i:05d}',
+                purchase_price=20, selling_price=40,
+                purchase_price_with_vat=23, selling_price_with_vat=46,
+                quantity_in_stock=1000000,
+            )
+            for i in range(accessories)
+        ])
+        for i in range(sales):
+            sale = shop.Sale(
+                sale_number=f'INV-BENCH-{i:06d}', customer_name=f'عميل {i}',
+                subtotal=100, vat_amount=15, total_amount=115,
+            )
+            sale.items.append(shop.SaleItem(
+                product_type='accessory', product_name='شاحن', unit_price=100,
+                purchase_price=20, quantity=1, total_price=115,
+            ))
+            shop.db.session.add(sale)
+        shop.db.session.commit()
+
+        accessory_ids = [a.id for a in shop.Accessory.query.all()]
+    return numbers, accessory_ids
+
+
+class Client:
+    """One logged-in cashier with its own cookie jar"""
+
+    def __init__(self, base_url, phone_numbers, accessory_ids, rng):
+        self.base_url = base_url
+        self.phone_numbers = phone_numbers
+        self.accessory_ids = accessory_ids
+        self.rng = rng
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.request('/login', data={'username': 'admin', 'password': 'admin123'})
+
+    def request(self, path, data=None, json_body=None):
+        headers = {}
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+        with self.opener.open(req, timeout=120) as response:
+            payload = response.read()
+            return response.status, response.geturl(), response.headers.get('Content-Type', ''), payload
+
+    def run(self, name):
+        """Issue one request of the given kind; returns True when it succeeded"""
+        if name == 'search':
+            term = self.rng.choice(self.phone_numbers)[-3:]
+            status, url, _, _ = self.request(f'/search?search_term={term}')
+        elif name == 'phone_types':
+            status, url, _, _ = self.request('/get_phone_types_ajax')
+        elif name == 'create_sale':
+            accessory_id = self.rng.choice(self.accessory_ids)
+            status, url, _, payload = self.request('/create_sale', json_body={
+                'customer_name': 'عميل نقدي', 'customer_phone': '', 'customer_email': '',
+                'customer_address': '', 'payment_method': 'نقدي', 'notes': '',
+                'items': [{'type': 'accessory', 'id': accessory_id, 'name': 'شاحن', 'description': '',
+                           'unitPrice': 46, 'quantity': 1, 'totalPrice': 46}],
+            })
+            return status == 200 and json.loads(payload).get('success', False)
+        elif name == 'dashboard':
+            status, url, _, _ = self.request('/dashboard')
+        elif name == 'sales':
+            status, url, _, _ = self.request('/sales')
+        elif name == 'inventory_summary':
+            status, url, _, _ = self.request('/inventory_summary')
+        elif name == 'barcode_pdf':
+            number = self.rng.choice(self.phone_numbers)
+            status, url, content_type, _ = self.request(f'/download_barcode_pdf/{number}')
+            return status == 200 and content_type.startswith('application/pdf')
+        else:
+            raise ValueError(name)
+        return status == 200 and '/login' not in url
+
+
+def run_clients(base_url, clients, duration, phone_numbers, accessory_ids, seed):
+    names = [name for name, _, _ in WORKLOAD]
+    weights = [weight for _, _, weight in WORKLOAD]
+    groups = {name: group for name, group, _ in WORKLOAD}
+    results = []  # (group, seconds, ok)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        client = Client(base_url, phone_numbers, accessory_ids, rng)
+        local = []
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                ok = client.run(name)
+            except Exception:
+                ok = False
+            local.append((groups[name], time.perf_counter() - started, ok))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            with urllib.request.urlopen(base_url + '/health', timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def bench_config(spec, args, database_url, workdir, phone_numbers, accessory_ids):
+    workers, threads = (int(part) for part in spec.lower().split('x'))
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    env = dict(os.environ,
+               DATABASE_URL=database_url,
+               PORT=str(port),
+               WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(threads),
+               GUNICORN_ACCESSLOG='')
+    env.pop('GUNICORN_WORKER_CLASS', None)
+    log_path = os.path.join(workdir, f'gunicorn_{spec}.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_DIR, 'gunicorn.conf.py'),
+             '--chdir', workdir, '--pythonpath', REPO_DIR, 'app:app'],
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_until_ready(base_url, process)
+            run_clients(base_url, args.clients, args.warmup, phone_numbers, accessory_ids, args.seed)
+            started = time.monotonic()
+            results = run_clients(base_url, args.clients, args.duration, phone_numbers, accessory_ids, args.seed)
+            elapsed = time.monotonic() - started
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    return summarize(spec, workers, threads, results, elapsed)
+
+
+def summarize(spec, workers, threads, results, elapsed):
+    def latencies(group=None):
+        return [seconds for g, seconds, ok in results if ok and (group is None or g == group)]
+
+    errors = sum(1 for _, _, ok in results if not ok)
+    return {
+        'config': spec,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'workers': workers,
+        'threads': threads,
+        'requests': len(results),
+        'errors': errors,
+        'rps': (len(results) - errors) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies(), 50) * 1000,
+        'p99_ms': percentile(latencies(), 99) * 1000,
+        'p99_pos_ms': percentile(latencies('pos'), 99) * 1000,
+        'p99_report_ms': percentile(latencies('report'), 99) * 1000,
+        'p99_label_ms': percentile(latencies('label'), 99) * 1000,
+    }
+
+
+def print_table(rows):
+    columns = [('config', 'config'), ('worker_class', 'class'), ('requests', 'reqs'), ('errors', 'errors'),
+               ('rps', 'req/s'), ('p50_ms', 'p50 ms'), ('p99_ms', 'p99 ms'), ('p99_pos_ms', 'p99 pos'),
+               ('p99_report_ms', 'p99 report'), ('p99_label_ms', 'p99 label')]
+    print()
+    print('  '.join(f'{title:>10}' for _, title in columns))
+    for row in rows:
+        cells = []
+        for key, _ in columns:
+            value = row[key]
+            cells.append(f'{value:>10.1f}' if isinstance(value, float) else f'{value:>10}')
+        print('  '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', action='append', dest='configs',
+                        help='WORKERSxTHREADS to benchmark (repeatable), default: 1x1 2x1 2x4 4x4')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per configuration')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds per configuration')
+    parser.add_argument('--phones', type=int, default=300)
+    parser.add_argument('--accessories', type=int, default=50)
+    parser.add_argument('--sales', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    configs = args.configs or ['1x1', '2x1', '2x4', '4x4']
+
+    workdir = tempfile.mkdtemp(prefix='bench_gunicorn_')
+    os.makedirs(os.path.join(workdir, 'static', 'barcodes'))
+    database_url = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    try:
+        print(f'Seeding {database_url} ...')
+        phone_numbers, accessory_ids = seed_database(database_url, args.phones, args.accessories, args.sales)
+        rows = []
+        for spec in configs:
+            print(f'Benchmarking {spec} ({args.clients} clients, {args.duration:.0f}s) ...')
+            rows.append(bench_config(spec, args, database_url, workdir, phone_numbers, accessory_ids))
+        print_table(rows)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(rows, f, indent=2)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Generate a synthetic shop dataset for scale testing.
+
+    python generate_dataset.py --preset 10k
+    python generate_dataset.py --preset 100k --database-url postgresql://... --seed 3
+    python generate_dataset.py --phones 25000 --accessories 800 --accessory-sales 20000
+
+Adds phone types, phones (new/used, available/sold), accessories, sales with
+their items, and buy/sell transactions with Arabic names to the configured
+database (DATABASE_URL or --database-url). Output is deterministic for a given
+seed and --end-date. Rows are written with chunked executemany INSERTs and
+explicit ids, so the 100k preset (~500k rows) loads in a few minutes on SQLite.
+Existing rows are left alone; new rows are appended after them.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PRESETS = {
+    '1k': {'phones': 1000, 'accessories': 150, 'accessory_sales': 600, 'days': 90},
+    '10k': {'phones': 10000, 'accessories': 600, 'accessory_sales': 6000, 'days': 365},
+    # Stays under the 100000 phone-number limit so new phones can still be added
+    '100k': {'phones': 95000, 'accessories': 2500, 'accessory_sales': 60000, 'days': 730},
+}
+
+# brand -> (weight, [(model, selling price with VAT)])
+CATALOG = {
+    'ابل': (40, [('iPhone 15 Pro Max', 5299), ('iPhone 15 Pro', 4599), ('iPhone 15', 3699),
+                 ('iPhone 14 Pro', 3999), ('iPhone 14', 2999), ('iPhone 13', 2399), ('iPhone 12', 1799)]),
+    'سامسونج': (30, [('Galaxy S24 Ultra', 4999), ('Galaxy S24', 3299), ('Galaxy Z Flip5', 3999),
+                      ('Galaxy A55', 1699), ('Galaxy A35', 1299), ('Galaxy A15', 699)]),
+    'هونر': (10, [('Honor Magic 6 Pro', 3999), ('Honor 90', 1799), ('Honor X9a', 1199), ('Honor X8', 899)]),
+    'شاومي': (12, [('Xiaomi 14', 3299), ('Redmi Note 13 Pro', 1299), ('Redmi 13C', 549)]),
+    'هواوي': (8, [('Huawei Mate 60 Pro', 4599), ('Huawei Nova 12', 1899), ('Huawei Nova 11i', 999)]),
+}
+
+FIRST_NAMES = ['محمد', 'عبدالله', 'فهد', 'خالد', 'سعد', 'عبدالرحمن', 'فيصل', 'سلطان', 'تركي', 'ناصر',
+               'نورة', 'سارة', 'منيرة', 'هيفاء', 'ريم', 'لطيفة', 'عبدالعزيز', 'ماجد', 'بندر', 'يوسف']
+FAMILY_NAMES = ['الصقري', 'العتيبي', 'الحربي', 'القحطاني', 'الشمري', 'الدوسري', 'المطيري', 'السبيعي',
+                'الرشيدي', 'الغامدي', 'الزهراني', 'العنزي', 'التميمي', 'البقمي']
+COLORS = ['أسود', 'أبيض', 'أزرق', 'ذهبي', 'فضي', 'رمادي', 'بنفسجي', 'أخضر']
+MEMORIES = ['64GB', '128GB', '128GB', '256GB', '256GB', '512GB', '1TB']
+USED_CONDITIONS = ['ممتاز', 'جيد جداً', 'جيد', 'مقبول']
+PAYMENT_METHODS = ['نقدي', 'نقدي', 'بطاقة', 'بطاقة', 'تحويل بنكي']
+
+# (category, arabic name, purchase price range with VAT)
+ACCESSORY_KINDS = [
+    ('charger', 'شاحن', (25, 120)), ('cable', 'كابل', (10, 60)), ('case', 'غلاف', (15, 90)),
+    ('screen_protector', 'حماية الشاشة', (8, 45)), ('headphones', 'سماعات', (40, 700)),
+    ('power_bank', 'شاحن محمول', (60, 250)), ('car_charger', 'شاحن السيارة', (25, 90)),
+    ('wireless_charger', 'شاحن لاسلكي', (60, 200)), ('holder', 'حامل', (20, 80)),
+    ('memory_card', 'بطاقة ذاكرة', (25, 150)),
+]
+ACCESSORY_BRANDS = ['Anker', 'Baseus', 'UGREEN', 'Samsung', 'Apple', 'Belkin', 'Xiaomi', 'Aukey']
+
+
+def customer_name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(FAMILY_NAMES)}'
+
+
+def mobile_number(rng):
+    return f'05{rng.randint(0, 99999999):08d}'
+
+
+def random_time(rng, start, end):
+    return start + timedelta(seconds=rng.randint(0, max(int((end - start).total_seconds()), 1)))
+
+
+class Generator:
+    """Appends synthetic rows to the shop database (call inside an app context)"""
+
+    def __init__(self, shop, seed, end, days, chunk_size=5000, log=print):
+        self.shop = shop
+        self.db = shop.db
+        self.rng = random.Random(seed)
+        self.end = end
+        self.start = end - timedelta(days=days)
+        self.chunk_size = chunk_size
+        self.log = log
+        self.counts = {}
+        self.user_id = shop.User.query.filter_by(is_admin=True).first().id
+        self.next_ids = {model.__tablename__: self.max_id(model) + 1
+                         for model in (shop.Phone, shop.Accessory, shop.Sale, shop.SaleItem, shop.Transaction)}
+
+    def max_id(self, model):
+        from sqlalchemy import func
+        return self.db.session.query(func.max(model.id)).scalar() or 0
+
+    def take_id(self, model):
+        table = model.__tablename__
+        self.next_ids[table] += 1
+        return self.next_ids[table] - 1
+
+    def insert(self, model, rows):
+        """executemany INSERT in chunks, committed per chunk"""
+        from sqlalchemy import insert
+        for offset in range(0, len(rows), self.chunk_size):
+            self.db.session.execute(insert(model), rows[offset:offset + self.chunk_size])
+            self.db.session.commit()
+        self.counts[model.__tablename__] = self.counts.get(model.__tablename__, 0) + len(rows)
+
+    def new_sale(self, sold_at):
+        sale_id = self.take_id(self.shop.Sale)
+        return {
+            'id': sale_id,
+            'sale_number': f"INV-{sold_at:%Y%m%d%H%M%S}-{sale_id:06d}",
+            'date_created': sold_at,
+            'customer_name': customer_name(self.rng) if self.rng.random() < 0.6 else 'عميل نقدي',
+            'customer_phone': mobile_number(self.rng) if self.rng.random() < 0.5 else None,
+            'payment_method': self.rng.choice(PAYMENT_METHODS),
+            'status': 'ملغي' if self.rng.random() < 0.02 else 'مكتمل',
+            'subtotal': 0.0, 'vat_amount': 0.0, 'total_amount': 0.0,
+        }
+
+    def add_item(self, sale, items, product_type, name, unit_price_with_vat, purchase_price, quantity=1, serial=None):
+        total = round(unit_price_with_vat * quantity, 2)
+        items.append({
+            'id': self.take_id(self.shop.SaleItem),
+            'sale_id': sale['id'],
+            'product_type': product_type,
+            'product_name': name,
+            'product_description': '',
+            'serial_number': serial,
+            'unit_price': unit_price_with_vat,
+            'purchase_price': purchase_price,
+            'quantity': quantity,
+            'total_price': total,
+        })
+        sale['total_amount'] = round(sale['total_amount'] + total, 2)
+        sale['subtotal'] = round(sale['total_amount'] / (1 + self.shop.VAT_RATE), 2)
+        sale['vat_amount'] = round(sale['total_amount'] - sale['subtotal'], 2)
+
+    def phone_types(self):
+        existing = {(t.brand, t.model) for t in self.shop.PhoneType.query.all()}
+        rows = [{'brand': brand, 'model': model, 'category': 'smartphone', 'is_active': True}
+                for brand, (_, models) in CATALOG.items() for model, _ in models
+                if (brand, model) not in existing]
+        if rows:
+            self.insert(self.shop.PhoneType, rows)
+
+    def accessories(self, count, stock=None):
+        rows = []
+        self.accessory_pool = []
+        for _ in range(count):
+            accessory_id = self.take_id(self.shop.Accessory)
+            category, arabic_name, (low, high) = self.rng.choice(ACCESSORY_KINDS)
+            purchase_with_vat = round(self.rng.uniform(low, high), 2)
+            selling_with_vat = round(purchase_with_vat * self.rng.uniform(1.3, 2.0), 2)
+            name = f'{arabic_name} {self.rng.choice(ACCESSORY_BRANDS)} {self.rng.randint(1, 99)}'
+            rows.append({
+                'id': accessory_id,
+                'name': name,
+                'category': category,
+                'description': f'{arabic_name} أصلي',
+                'barcode': f'ACC{accessory_id:010d}',
+                'purchase_price': round(purchase_with_vat / 1.15, 2),
+                'selling_price': round(selling_with_vat / 1.15, 2),
+                'purchase_price_with_vat': purchase_with_vat,
+                'selling_price_with_vat': selling_with_vat,
+                'quantity_in_stock': self.rng.choice([0, 2, 4] + [self.rng.randint(5, 80)] * 7) if stock is None else stock,
+                'min_quantity': 5,
+                'supplier': self.rng.choice(['مؤسسة الجوال', 'شركة الاتصالات المتقدمة', 'مستودع الرياض']),
+                'date_added': random_time(self.rng, self.start, self.end),
+            })
+        self.insert(self.shop.Accessory, rows)
+        self.accessory_pool = [(r['id'], r['name'], r['selling_price_with_vat'], r['purchase_price']) for r in rows]
+        if not self.accessory_pool:
+            self.accessory_pool = [(a.id, a.name, a.selling_price_with_vat, a.purchase_price)
+                                   for a in self.shop.Accessory.query.all()]
+
+    def add_accessories_to(self, sale, items, how_many):
+        for _ in range(how_many if self.accessory_pool else 0):
+            accessory_id, name, price, purchase = self.rng.choice(self.accessory_pool)
+            self.add_item(sale, items, 'accessory', name, price, purchase, quantity=self.rng.choice([1, 1, 1, 2]))
+
+    def phones(self, count, sold_ratio=0.6):
+        brands = list(CATALOG)
+        weights = [CATALOG[b][0] for b in brands]
+        numbers = self.shop.allocate_phone_numbers(count)
+        for offset in range(0, count, self.chunk_size):
+            phones, sales, items, transactions = [], [], [], []
+            for phone_number in numbers[offset:offset + self.chunk_size]:
+                phone_id = self.take_id(self.shop.Phone)
+                brand = self.rng.choices(brands, weights)[0]
+                model, list_price = self.rng.choice(CATALOG[brand][1])
+                used = self.rng.random() < 0.3
+                selling_with_vat = round(list_price * (self.rng.uniform(0.45, 0.8) if used else 1.0), 2)
+                purchase_with_vat = round(selling_with_vat * self.rng.uniform(0.75, 0.9), 2)
+                added = random_time(self.rng, self.start, self.end)
+                phone = {
+                    'id': phone_id,
+                    'brand': brand,
+                    'model': model,
+                    'condition': 'used' if used else 'new',
+                    'purchase_price': round(purchase_with_vat / 1.15, 2),
+                    'selling_price': round(selling_with_vat / 1.15, 2),
+                    'purchase_price_with_vat': purchase_with_vat,
+                    'selling_price_with_vat': selling_with_vat,
+                    'serial_number': f'35{phone_id:07d}{self.rng.randint(0, 999999):06d}',
+                    'phone_number': phone_number,
+                    'description': '',
+                    'date_added': added,
+                    'warranty': 0 if used else self.rng.choice([12, 24]),
+                    'phone_condition': self.rng.choice(USED_CONDITIONS) if used else None,
+                    'age': self.rng.randint(3, 36) if used else None,
+                    'customer_name': customer_name(self.rng) if used else None,
+                    'customer_phone': mobile_number(self.rng) if used else None,
+                    'customer_id': f'1{self.rng.randint(0, 999999999):09d}' if used else None,
+                    'phone_color': self.rng.choice(COLORS),
+                    'phone_memory': self.rng.choice(MEMORIES),
+                    'buyer_name': None,
+                    'status': 'available',
+                    'sold_date': None,
+                    'sale_id': None,
+                }
+                phones.append(phone)
+                transactions.append({
+                    'id': self.take_id(self.shop.Transaction),
+                    'phone_id': phone_id,
+                    'transaction_type': 'buy',
+                    'serial_number': phone['serial_number'],
+                    'price': phone['purchase_price'],
+                    'price_with_vat': purchase_with_vat,
+                    'vat_amount': round(purchase_with_vat - phone['purchase_price'], 2),
+                    'user_id': self.user_id,
+                    'date_created': added,
+                    'customer_name': phone['customer_name'],
+                    'customer_phone': None,
+                    'notes': 'شراء هاتف مستعمل' if used else 'شراء هاتف جديد',
+                })
+
+                if self.rng.random() < sold_ratio:
+                    sold_at = random_time(self.rng, added, self.end)
+                    sale = self.new_sale(sold_at)
+                    self.add_item(sale, items, 'phone', f'{brand} {model}', selling_with_vat,
+                                  phone['purchase_price'], serial=phone['serial_number'])
+                    self.add_accessories_to(sale, items, self.rng.choice([0, 0, 1, 2]))
+                    sales.append(sale)
+                    phone.update(status='sold', sold_date=sold_at, sale_id=sale['id'], buyer_name=sale['customer_name'])
+                    transactions.append({
+                        'id': self.take_id(self.shop.Transaction),
+                        'phone_id': phone_id,
+                        'transaction_type': 'sell',
+                        'serial_number': phone['serial_number'],
+                        'price': phone['selling_price'],
+                        'price_with_vat': selling_with_vat,
+                        'vat_amount': round(selling_with_vat - phone['selling_price'], 2),
+                        'user_id': self.user_id,
+                        'date_created': sold_at,
+                        'customer_name': sale['customer_name'],
+                        'customer_phone': sale['customer_phone'],
+                        'notes': f"بيع - {sale['sale_number']}",
+                    })
+
+            # Parents first so the foreign keys hold on Postgres
+            self.insert(self.shop.Sale, sales)
+            self.insert(self.shop.Phone, phones)
+            self.insert(self.shop.SaleItem, items)
+            self.insert(self.shop.Transaction, transactions)
+            self.log(f'  phones {min(offset + self.chunk_size, count)}/{count}')
+
+    def accessory_sales(self, count):
+        for offset in range(0, count, self.chunk_size):
+            sales, items = [], []
+            for _ in range(min(self.chunk_size, count - offset)):
+                sale = self.new_sale(random_time(self.rng, self.start, self.end))
+                self.add_accessories_to(sale, items, self.rng.choice([1, 1, 2, 3]))
+                sales.append(sale)
+            self.insert(self.shop.Sale, sales)
+            self.insert(self.shop.SaleItem, items)
+
+
+def generate(shop, phones, accessories, accessory_sales, days, seed=1, end=None, chunk_size=5000, log=print,
+             accessory_stock=None):
+    """Append a synthetic dataset to the shop database; returns rows inserted per table.
+
+    accessory_stock gives every accessory that many units instead of a realistic
+    0-80, for load tests that must not run out."""
+    generator = Generator(shop, seed, end or datetime.now().replace(microsecond=0), days, chunk_size, log)
+    generator.phone_types()
+    generator.accessories(accessories, accessory_stock)
+    generator.phones(phones)
+    generator.accessory_sales(accessory_sales)
+    # Bulk inserts skip the ORM events - invalidate the fragment caches of running workers
+    shop.touch_tables(shop.db.session.connection(), set(generator.counts) | {'accessory_names'})
+    shop.db.session.commit()
+    shop.backfill_customer_keys()  # likewise the customer lookup keys and reversed serials
+    shop.backfill_serial_reversed()
+    return generator.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='1k')
+    parser.add_argument('--phones', type=int, help='override the preset phone count')
+    parser.add_argument('--accessories', type=int, help='override the preset accessory count')
+    parser.add_argument('--accessory-sales', type=int, help='override the preset accessory-only sales count')
+    parser.add_argument('--days', type=int, help='override the preset history length')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--end-date', help='last day of the generated history (YYYY-MM-DD, default: now)')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL / the app default')
+    args = parser.parse_args()
+
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, REPO_DIR)
+    import app as shop
+
+    options = dict(PRESETS[args.preset])
+    for key in ('phones', 'accessories', 'accessory_sales', 'days'):
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+    end = datetime.strptime(args.end_date, '%Y-%m-%d') + timedelta(days=1) if args.end_date else None
+
+    with shop.app.app_context():
+        with shop.database_init_lock():
+            shop.initialize_database()
+        started = time.perf_counter()
+        counts = generate(shop, seed=args.seed, end=end, chunk_size=args.chunk_size, **options)
+        elapsed = time.perf_counter() - started
+
+    total = sum(counts.values())
+    for table, rows in counts.items():
+        print(f'{table:<14}{rows:>10}')
+    print(f"{'total':<14}{total:>10} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Gunicorn configuration - used by Procfile / render.yaml as `gunicorn -c gunicorn.conf.py app:app`
+#
+# Every value can be overridden from the environment, so the same file works on
+# the free Render plan (1 CPU, 512MB) and on a bigger box:
+#   WEB_CONCURRENCY          number of worker processes
+#   GUNICORN_THREADS         threads per worker (>1 switches to the gthread worker)
+#   GUNICORN_WORKER_CLASS    force a worker class (sync, gthread)
+#   GUNICORN_TIMEOUT         seconds before a silent worker is killed
+#   GUNICORN_MAX_REQUESTS    recycle a worker after this many requests (0 = never)
+#   GUNICORN_PRELOAD         load the app once in the master before forking (1/0)
+#   PROMETHEUS_MULTIPROC_DIR where workers write /metrics samples (defaults to a temp dir)
+#   EVENTS_MAX_STREAMS       live inventory streams per worker (default: threads - 2, none on sync)
+#   EVENTS_STREAM_SECONDS    seconds before a stream ends and the browser reconnects
+import multiprocessing
+import os
+import tempfile
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+cpu_count = multiprocessing.cpu_count()
+
+# Must exist before app.py imports prometheus_client (preload happens after this
+# file is read). Emptied on every start so samples of old workers are not summed in.
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'alsaqri-prometheus'))
+os.makedirs(metrics_dir, exist_ok=True)
+for name in os.listdir(metrics_dir):
+    if name.endswith('.db'):
+        os.remove(os.path.join(metrics_dir, name))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Label and invoice routes render 600-DPI images with PIL/reportlab, which holds
+# the GIL for most of the render. Processes are what let a render run next to a
+# POS request; threads only keep the short AJAX/page requests moving while one
+# thread of the same worker is rendering. Each worker costs ~60-80MB resident
+# (PIL + reportlab), so the CPU based default is capped to stay inside small plans.
+# Threads are cheap by comparison and the live inventory streams park on them
+# (see below), hence 8.
+workers = env_int('WEB_CONCURRENCY', max(2, min(cpu_count * 2 + 1, 4)))
+threads = env_int('GUNICORN_THREADS', 8)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or ('gthread' if threads > 1 else 'sync')
+
+# Import app.py (and its imaging libraries) once in the master; workers share
+# those pages copy-on-write and boot faster after a max_requests recycle.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# PIL keeps freed image buffers in the worker's heap, so a worker that printed
+# a few hundred stickers never shrinks again. Recycling caps that creep; the
+# jitter stops all workers from restarting at the same moment.
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', max(max_requests // 10, 1) if max_requests else 0)
+
+# A shipment label sheet or a day of invoices takes several seconds on one CPU;
+# the default 30s kills the worker in the middle of a large batch.
+timeout = env_int('GUNICORN_TIMEOUT', 120)
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+
+# Every open /events stream (live stock on the sale page and dashboards) holds one
+# thread for EVENTS_STREAM_SECONDS. gthread workers let in threads - 2 streams, so
+# two threads always stay free for requests; further terminals retry later. A sync
+# worker would be blocked by a single stream and killed at the timeout, so it serves
+# none and terminals work without live updates. Streams end well before the timeout
+# either way; browsers reconnect and resume from the last event.
+os.environ.setdefault('EVENTS_MAX_STREAMS', str(max(threads - 2, 0) if worker_class == 'gthread' else 0))
+os.environ.setdefault('EVENTS_STREAM_SECONDS', str(max(min(300, timeout - 30), 10)))
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
+
+
+def post_fork(server, worker):
+    """Do not share the master's pooled database connections with the worker."""
+    if not preload_app:
+        return
+    from app import app, db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges (pool connections) of a worker that exited or was recycled."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
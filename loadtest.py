@@ -0,0 +1,357 @@
+"""Load test simulating a busy shop day.
+
+    python loadtest.py                                   # temp SQLite DB + local gunicorn, 1..16 cashiers
+    python loadtest.py --preset 100k --stages 2,4,8,16,32 --stage-duration 60
+    python loadtest.py --database-url postgresql://... --url http://127.0.0.1:8000 --no-seed
+
+Each virtual cashier logs in and then loops over shop scenarios: scanning items
+and ringing up mixed phone/accessory carts (create_sale), searching stock,
+opening the dashboard, printing sticker PDFs and registering new phones.
+Concurrency is raised stage by stage; every stage reports throughput and
+p50/p95/p99 plus the error rate per route, and the summary names the largest
+number of cashiers whose overall p99 stayed inside --p99-budget.
+
+The database is seeded with a generate_dataset.py preset (unless --no-seed) and
+read through app.py's models, so the harness knows which phone/accessory ids
+it can sell. Without --url a local gunicorn is started with gunicorn.conf.py
+against the same database.
+"""
+import argparse
+import collections
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import generate_dataset
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROUTES = ['login', 'search', 'create_sale', 'dashboard', 'download_barcode_pdf', 'add_new_phone']
+# Seeded accessories get this many units each, so a long run never sells one out
+# and the create_sale error rate measures the server, not the seed data
+ACCESSORY_STOCK = 1_000_000
+
+# (scenario, weight) - one scenario is one cashier action, possibly several requests
+SCENARIOS = [
+    ('sale', 35),
+    ('search', 25),
+    ('dashboard', 15),
+    ('barcode_pdf', 15),
+    ('add_new_phone', 10),
+]
+
+SEARCH_TERMS = ['iPhone', 'Galaxy', 'ابل', 'سامسونج', 'شاحن', 'غلاف', '128GB', 'Pro']
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def load_shop(database_url, preset, seed):
+    """Seed the database with a dataset preset (when given) and return the sellable catalog"""
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, REPO_DIR)
+    import app as shop
+
+    with shop.app.app_context():
+        with shop.database_init_lock():
+            shop.initialize_database()
+        if preset:
+            counts = generate_dataset.generate(shop, seed=seed, log=lambda message: None,
+                                               accessory_stock=ACCESSORY_STOCK, **generate_dataset.PRESETS[preset])
+            print(f'Seeded {sum(counts.values())} rows ({preset} preset)')
+
+        phones = [(p.id, p.phone_number, f'{p.brand} {p.model}', p.selling_price_with_vat)
+                  for p in shop.Phone.query.filter_by(status='available').all()]
+        accessories = [(a.id, a.barcode, a.name, a.selling_price_with_vat)
+                       for a in shop.Accessory.query.filter(shop.Accessory.quantity_in_stock > 0).all()]
+        brands = {}
+        for phone_type in shop.PhoneType.query.all():
+            brands.setdefault(phone_type.brand, []).append(phone_type.model)
+    return phones, accessories, brands
+
+
+class Shop:
+    """Catalog shared by all cashiers; a phone can only be sold once"""
+
+    def __init__(self, phones, accessories, brands):
+        self.lock = threading.Lock()
+        self.available_phones = collections.deque(phones)
+        self.phone_numbers = [phone[1] for phone in phones]
+        self.accessories = accessories
+        self.brands = [(brand, model) for brand, models in brands.items() for model in models]
+
+    def take_phone(self):
+        with self.lock:
+            return self.available_phones.popleft() if self.available_phones else None
+
+    def add_phone_number(self, number):
+        with self.lock:
+            self.phone_numbers.append(number)
+
+
+class Cashier:
+    """One virtual cashier with its own session cookie"""
+
+    def __init__(self, base_url, shop, rng, record, username, password):
+        self.base_url = base_url
+        self.shop = shop
+        self.rng = rng
+        self.record = record
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.call('login', '/login', form={'username': username, 'password': password},
+                  check=lambda status, url, ctype, body: '/login' not in url)
+
+    def call(self, route, path, form=None, json_body=None, check=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form).encode()
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        status, url, content_type, payload = 0, '', '', b''
+        try:
+            req = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+            with self.opener.open(req, timeout=120) as response:
+                status, url = response.status, response.geturl()
+                content_type = response.headers.get('Content-Type', '')
+                payload = response.read()
+            ok = status == 200 and '/login' not in url
+            if ok and check is not None:
+                ok = check(status, url, content_type, payload)
+        except urllib.error.HTTPError as e:
+            status, ok = e.code, False
+        except Exception:
+            ok = False
+        self.record(route, time.perf_counter() - started, ok, status)
+        return ok, url, payload
+
+    def sale(self):
+        """Scan one to three items at the counter and ring them up"""
+        cart = []
+        phone = self.shop.take_phone() if self.rng.random() < 0.5 else None
+        if phone:
+            phone_id, phone_number, name, price = phone
+            self.call('search', f'/search?search_term={phone_number}')
+            cart.append({'type': 'phone', 'id': phone_id, 'name': name, 'description': '',
+                         'unitPrice': price, 'quantity': 1, 'totalPrice': price})
+        for _ in range(self.rng.randint(0 if cart else 1, 2)):
+            accessory_id, barcode, name, price = self.rng.choice(self.shop.accessories)
+            self.call('search', f'/search?search_term={urllib.parse.quote(barcode)}')
+            quantity = self.rng.randint(1, 2)
+            cart.append({'type': 'accessory', 'id': accessory_id, 'name': name, 'description': '',
+                         'unitPrice': price, 'quantity': quantity, 'totalPrice': price * quantity})
+        self.call('create_sale', '/create_sale', json_body={
+            'customer_name': 'عميل نقدي', 'customer_phone': '', 'customer_email': '',
+            'customer_address': '', 'payment_method': self.rng.choice(['نقدي', 'بطاقة']), 'notes': '',
+            'items': cart,
+        }, check=lambda status, url, ctype, body: json.loads(body).get('success', False))
+
+    def search(self):
+        term = self.rng.choice(SEARCH_TERMS)
+        self.call('search', f'/search?search_term={urllib.parse.quote(term)}')
+
+    def dashboard(self):
+        self.call('dashboard', '/dashboard')
+
+    def barcode_pdf(self):
+        number = self.rng.choice(self.shop.phone_numbers)
+        self.call('download_barcode_pdf', f'/download_barcode_pdf/{number}',
+                  check=lambda status, url, ctype, body: ctype.startswith('application/pdf'))
+
+    def add_new_phone(self):
+        brand, model = self.rng.choice(self.shop.brands)
+        serial = f'LT{self.rng.getrandbits(48):012X}'
+        ok, url, _ = self.call('add_new_phone', '/add_new_phone', form={
+            'brand': brand, 'model': model, 'purchase_price': '2300', 'selling_price': '2899',
+            'serial_number': serial, 'warranty': '12', 'description': '', 'customer_name': '',
+            'customer_phone': '', 'customer_id': '', 'phone_color': 'أسود', 'phone_memory': '128GB',
+            'buyer_name': '',
+        }, check=lambda status, url, ctype, body: '/print_barcode/' in url)
+        if ok:
+            self.shop.add_phone_number(url.rstrip('/').rsplit('/', 1)[-1])
+
+
+def run_stage(base_url, shop, concurrency, duration, args):
+    """Run `concurrency` cashiers for `duration` seconds; returns (results, elapsed)"""
+    results = []  # (route, seconds, ok, status)
+    lock = threading.Lock()
+    names = [name for name, _ in SCENARIOS]
+    weights = [weight for _, weight in SCENARIOS]
+    started = time.monotonic()
+    deadline = started + duration
+
+    def cashier(index):
+        rng = random.Random(args.seed * 1000 + concurrency * 100 + index)
+        local = []
+        user = Cashier(base_url, shop, rng, lambda *row: local.append(row), args.username, args.password)
+        while time.monotonic() < deadline:
+            getattr(user, rng.choices(names, weights)[0])()
+            if args.think_time:
+                time.sleep(rng.uniform(0, 2 * args.think_time))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=cashier, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.monotonic() - started
+
+
+def summarize_stage(concurrency, results, elapsed):
+    by_route = collections.defaultdict(list)
+    for row in results:
+        by_route[row[0]].append(row)
+
+    routes = {}
+    for route in ROUTES:
+        rows = by_route.get(route, [])
+        if not rows:
+            continue
+        latencies = [seconds for _, seconds, ok, _ in rows if ok]
+        errors = sum(1 for _, _, ok, _ in rows if not ok)
+        routes[route] = {
+            'requests': len(rows),
+            'errors': errors,
+            'error_rate': errors / len(rows),
+            'rps': len(rows) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    all_latencies = [seconds for route, seconds, ok, _ in results if ok and route != 'login']
+    errors = sum(1 for _, _, ok, _ in results if not ok)
+    return {
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'rps': len(results) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(all_latencies, 50) * 1000,
+        'p95_ms': percentile(all_latencies, 95) * 1000,
+        'p99_ms': percentile(all_latencies, 99) * 1000,
+        'routes': routes,
+    }
+
+
+def print_stage(stage):
+    print(f"\n== {stage['concurrency']} cashiers: {stage['rps']:.1f} req/s, "
+          f"p99 {stage['p99_ms']:.0f}ms, errors {stage['error_rate']:.1%}")
+    print(f"{'route':<22}{'reqs':>7}{'req/s':>8}{'err%':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, r in stage['routes'].items():
+        print(f"{route:<22}{r['requests']:>7}{r['rps']:>8.1f}{r['error_rate'] * 100:>7.1f}"
+              f"{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}{r['p99_ms']:>9.0f}")
+
+
+def print_summary(stages, budget_ms):
+    print(f"\n{'cashiers':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'err%':>7}")
+    for stage in stages:
+        print(f"{stage['concurrency']:>9}{stage['rps']:>9.1f}{stage['p50_ms']:>9.0f}"
+              f"{stage['p95_ms']:>9.0f}{stage['p99_ms']:>9.0f}{stage['error_rate'] * 100:>7.1f}")
+    within = [s['concurrency'] for s in stages if s['p99_ms'] <= budget_ms and s['error_rate'] < 0.01]
+    if within:
+        print(f"\nLargest stage within p99 {budget_ms:.0f}ms and <1% errors: {max(within)} cashiers")
+    else:
+        print(f"\nNo stage stayed within p99 {budget_ms:.0f}ms and <1% errors")
+
+
+def wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            with urllib.request.urlopen(base_url + '/health', timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='database to seed and read the catalog from (default: temp SQLite)')
+    parser.add_argument('--url', help='base URL of a running instance (default: start gunicorn locally)')
+    parser.add_argument('--preset', choices=sorted(generate_dataset.PRESETS), default='1k',
+                        help='generate_dataset.py preset to seed with')
+    parser.add_argument('--no-seed', action='store_true', help='use the existing stock instead of adding test stock')
+    parser.add_argument('--stages', default='1,2,4,8,16', help='comma separated cashier counts')
+    parser.add_argument('--stage-duration', type=float, default=30, help='seconds per stage')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean pause between cashier actions (s)')
+    parser.add_argument('--p99-budget', type=float, default=1000, help='p99 target in ms')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    os.makedirs(os.path.join(workdir, 'static', 'barcodes'))
+    database_url = args.database_url or 'sqlite:///' + os.path.join(workdir, 'loadtest.db')
+    process = None
+    try:
+        print(f'Preparing {database_url} ...')
+        phones, accessories, brands = load_shop(database_url, None if args.no_seed else args.preset, args.seed)
+        if not accessories:
+            raise SystemExit('No accessories in stock - run without --no-seed or add stock first')
+        shop = Shop(phones, accessories, brands)
+
+        base_url = args.url
+        if not base_url:
+            port = free_port()
+            base_url = f'http://127.0.0.1:{port}'
+            env = dict(os.environ, DATABASE_URL=database_url, PORT=str(port), GUNICORN_ACCESSLOG='')
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_DIR, 'gunicorn.conf.py'),
+                 '--chdir', workdir, '--pythonpath', REPO_DIR, 'app:app'],
+                env=env, stdout=open(os.path.join(workdir, 'gunicorn.log'), 'w'), stderr=subprocess.STDOUT)
+            wait_until_ready(base_url, process)
+        print(f'Target {base_url}: {len(phones)} phones, {len(accessories)} accessories')
+
+        stages = []
+        for concurrency in (int(c) for c in args.stages.split(',')):
+            results, elapsed = run_stage(base_url, shop, concurrency, args.stage_duration, args)
+            stage = summarize_stage(concurrency, results, elapsed)
+            print_stage(stage)
+            stages.append(stage)
+        print_summary(stages, args.p99_budget)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'database_url': database_url, 'stages': stages}, f, indent=2, ensure_ascii=False)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Per-route SQL query budget and latency regression check.
+
+    python query_budget.py                                   # check budgets and scaling
+    python query_budget.py --baseline query_budget_baseline.json
+    python query_budget.py --sizes 200,2000,10000 --write-baseline query_budget_baseline.json
+
+Drives every page and API route through the Flask test client against a
+throw-away SQLite database that is grown with generate_dataset.py to each size
+(phones; accessories and sales scale along). For every route it counts the SQL
+statements of the first (cold cache) and the repeated requests, keeps the
+highest count and the median wall time, then fails (exit status 1) when:
+
+  * a route answers with another status than expected (200 or EXPECTED_STATUS),
+  * a route runs more statements than its budget (DEFAULT_BUDGET or BUDGETS),
+  * the statement count grows with the dataset (an N+1 pattern),
+  * with --baseline, a route runs more statements than in the baseline.
+
+Wall times are compared against the baseline too but only reported, since
+they depend on the machine. tests/test_query_budget.py runs the same check
+under pytest, one test per route.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BUDGET = 12
+BUDGETS = {
+    'create_sale': 20,  # one SELECT + UPDATE per cart line, plus the table version bumps and stock movements
+}
+# Status of the cases that do not answer 200
+EXPECTED_STATUS = {
+    'index': 302,  # logged-in users are sent on to their dashboard
+}
+# Extra statements allowed between the smallest and the largest dataset
+SCALING_TOLERANCE = 1
+TIME_REGRESSION_FACTOR = 2.0
+
+# Routes not driven here, with the reason
+SKIPPED = {
+    'static': 'static files',
+    'favicon': 'static file',
+    'logout': 'ends the session',
+    'get_barcode': 'serves a pre-rendered image file',
+    'download_saved_accessory_pdf': 'serves a pre-rendered PDF file',
+    'download_shipment_labels': 'serves a background-rendered PDF file',
+    'download_profile': 'serves a saved profile file',
+    'inventory_events': 'long-lived event stream',
+}
+
+
+def build_cases(sample):
+    """(name, method, url, payload) for one request per route"""
+    return [
+        ('index', 'GET', '/', None),
+        ('health_check', 'GET', '/health', None),
+        ('pool_status', 'GET', '/pool_status', None),
+        ('slow_queries_page', 'GET', '/slow_queries', None),
+        ('profiles_page', 'GET', '/profiles', None),
+        ('metrics', 'GET', '/metrics', None),
+        ('login', 'GET', '/login', None),
+        ('dashboard', 'GET', '/dashboard', None),
+        ('limited_dashboard', 'GET', '/limited_dashboard', None),
+        ('print_barcode', 'GET', f"/print_barcode/{sample['phone_number']}", None),
+        ('print_accessory_barcode', 'GET', f"/print_accessory_barcode/{sample['accessory_barcode']}", None),
+        ('download_barcode_pdf', 'GET', f"/download_barcode_pdf/{sample['phone_number']}", None),
+        ('download_accessory_barcode_pdf', 'GET', f"/download_accessory_barcode_pdf/{sample['accessory_barcode']}", None),
+        ('add_new_phone', 'GET', '/add_new_phone', None),
+        ('add_used_phone', 'GET', '/add_used_phone', None),
+        ('receive_shipment', 'GET', '/receive_shipment', None),
+        ('create_sale_page', 'GET', '/create_sale', None),
+        ('create_sale', 'POST', '/create_sale', {
+            'customer_name': 'عميل نقدي', 'customer_phone': '', 'customer_email': '', 'customer_address': '',
+            'payment_method': 'نقدي', 'notes': '',
+            'items': [
+                {'type': 'phone', 'id': sample['sellable_phone_id'], 'name': 'هاتف', 'description': '',
+                 'unitPrice': 1000, 'quantity': 1, 'totalPrice': 1000},
+                {'type': 'accessory', 'id': sample['accessory_id'], 'name': 'أكسسوار', 'description': '',
+                 'unitPrice': 50, 'quantity': 1, 'totalPrice': 50},
+            ],
+        }),
+        ('view_sale', 'GET', f"/sale/{sample['sale_id']}", None),
+        ('sale_invoice_pdf', 'GET', f"/sale/{sample['sale_id']}/invoice.pdf", None),
+        ('day_invoices_pdf', 'GET', f"/sales/invoices/{sample['day']}.pdf", None),
+        ('list_accessories', 'GET', '/accessories', None),
+        ('add_accessory', 'GET', '/add_accessory', None),
+        ('edit_accessory', 'GET', f"/edit_accessory/{sample['accessory_id']}", None),
+        ('search', 'GET', f"/search?search_term={sample['search_term']}", None),
+        ('search_serial_suffix', 'GET', f"/search?search_term={sample['serial_suffix']}", None),
+        ('customer_lookup', 'GET', '/customers?q=محمد', None),
+        ('list_sales', 'GET', '/sales', None),
+        ('list_sales_day', 'GET', f"/sales?filter_type=day&filter_date={sample['day']}", None),
+        ('vat_returns', 'GET', f"/vat_returns?year={sample['day'][:4]}", None),
+        ('vat_return_documents', 'GET', f"/vat_returns/{sample['day'][:7]}/documents", None),
+        ('profit_analytics', 'GET', f"/analytics?year={sample['day'][:4]}&group=model", None),
+        ('get_sales_series_ajax', 'GET', f"/get_sales_series_ajax?start=2021-07-01&end={sample['day']}", None),
+        ('inventory_summary', 'GET', '/inventory_summary', None),
+        ('get_phone_types_ajax', 'GET', '/get_phone_types_ajax', None),
+        ('get_accessory_categories_ajax', 'GET', '/get_accessory_categories_ajax', None),
+        ('get_low_stock_ajax', 'GET', '/get_low_stock_ajax', None),
+        ('get_typeahead_ajax', 'GET', '/get_typeahead_ajax?q=Galaxy', None),
+        ('sold_phones', 'GET', '/sold_phones', None),
+    ]
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def pick_sample(shop):
+    """Representative ids for the URL parameters of the current dataset"""
+    Phone, Accessory, Sale = shop.Phone, shop.Accessory, shop.Sale
+    available = Phone.query.filter_by(status='available').order_by(Phone.id)
+    latest_sale = Sale.query.order_by(Sale.date_created.desc()).first()
+    accessory = Accessory.query.order_by(Accessory.id).first()
+    return {
+        'phone_number': available.first().phone_number,
+        'serial_suffix': available.first().serial_number[-6:],
+        'sellable_phone_id': available.offset(1).first().id,  # sold by the create_sale case
+        'accessory_barcode': accessory.barcode,
+        'accessory_id': accessory.id,
+        'sale_id': latest_sale.id,
+        'day': latest_sale.date_created.strftime('%Y-%m-%d'),
+        'search_term': 'Galaxy',
+    }
+
+
+def measure(client, counter, case, repeat):
+    """Most statements of any of `repeat` requests - the first one runs with cold caches - and their median wall time"""
+    _, method, url, payload = case
+    timings = []
+    queries = 0
+    for _ in range(repeat if method == 'GET' else 1):
+        counter.count = 0
+        started = time.perf_counter()
+        if method == 'GET':
+            response = client.get(url)
+        else:
+            response = client.post(url, json=payload)
+        response.get_data()  # drain streamed responses so their queries are counted
+        timings.append(time.perf_counter() - started)
+        queries = max(queries, counter.count)
+    return {
+        'status': response.status_code,
+        'queries': queries,
+        'ms': round(statistics.median(timings) * 1000, 1),
+    }
+
+
+def run(sizes, repeat, seed):
+    """Measure every case at every dataset size; returns (results, uncovered endpoints)"""
+    workdir = tempfile.mkdtemp(prefix='query_budget_')
+    os.makedirs(os.path.join(workdir, 'static', 'barcodes'))
+    os.chdir(workdir)  # barcode and sticker files are written relative to the working directory
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'budget.db')
+    os.environ.pop('REPORTS_DATABASE_URL', None)
+    os.environ.pop('SLOW_QUERY_MS', None)
+    sys.path.insert(0, REPO_DIR)
+    import app as shop
+    import generate_dataset
+    # Read the user table version once, not at whichever request a timer lands on
+    shop.USER_CACHE_CHECK_SECONDS = float('inf')
+    if shop.invoice_font() is None:
+        # Without an Arabic font the invoice routes refuse to render (see send_invoice_pdf)
+        EXPECTED_STATUS.update(sale_invoice_pdf=503, day_invoices_pdf=503)
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    counter = StatementCounter()
+    event.listen(Engine, 'before_cursor_execute', counter)
+    with shop.app.app_context():
+        shop.initialize_database()
+
+    results = {}
+    covered = set()
+    adapter = shop.app.url_map.bind('localhost')
+    phones_so_far = 0
+    for size in sizes:
+        added = size - phones_so_far
+        with shop.app.app_context():
+            generate_dataset.generate(
+                shop, phones=added, accessories=max(added // 10, 1), accessory_sales=added * 3 // 4,
+                days=120, seed=seed + size, end=datetime(2026, 6, 30), log=lambda message: None)
+            sample = pick_sample(shop)
+        phones_so_far = size
+
+        client = shop.app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        results[str(size)] = {}
+        for case in build_cases(sample):
+            results[str(size)][case[0]] = measure(client, counter, case, repeat)
+            covered.add(adapter.match(case[2].split('?')[0], method=case[1])[0])
+        print(f'  measured {len(results[str(size)])} routes at {size} phones')
+
+    endpoints = {rule.endpoint for rule in shop.app.url_map.iter_rules() if 'GET' in rule.methods}
+    return results, sorted(endpoints - covered - set(SKIPPED))
+
+
+def route_failures(results, name, baseline=None):
+    """What is wrong with one route across the dataset sizes, as a list of notes"""
+    sizes = list(results)
+    smallest, largest = results[sizes[0]][name], results[sizes[-1]][name]
+    budget = BUDGETS.get(name, DEFAULT_BUDGET)
+    expected_status = EXPECTED_STATUS.get(name, 200)
+    notes = []
+    for size in sizes:
+        if results[size][name]['status'] != expected_status:
+            notes.append(f"HTTP {results[size][name]['status']} at {size} (expected {expected_status})")
+    worst = max(results[size][name]['queries'] for size in sizes)
+    if worst > budget:
+        notes.append(f'over budget ({worst} > {budget})')
+    growth = largest['queries'] - smallest['queries']
+    if growth > SCALING_TOLERANCE:
+        notes.append(f'queries grow with rows (+{growth})')
+    if baseline:
+        for size in sizes:
+            before = baseline.get(size, {}).get(name)
+            if before and results[size][name]['queries'] > before['queries']:
+                notes.append(f"queries {before['queries']} -> {results[size][name]['queries']} at {size}")
+    return notes
+
+
+def route_report(sizes, repeat, seed, baseline=None):
+    """run() and route_failures() of every case; returns ({case: failures}, uncovered endpoints)"""
+    results, uncovered = run(sizes, repeat, seed)
+    return {name: route_failures(results, name, baseline) for name in results[str(sizes[-1])]}, uncovered
+
+
+def check(results, baseline):
+    """Print the report; returns the list of failures"""
+    sizes = list(results)
+    largest = results[sizes[-1]]
+    failures = []
+    header = ''.join(f'{f"q@{size}":>9}{f"ms@{size}":>10}' for size in sizes)
+    print(f"\n{'route':<32}{'status':>7}{header}{'budget':>8}  notes")
+    for name in largest:
+        budget = BUDGETS.get(name, DEFAULT_BUDGET)
+        notes = route_failures(results, name, baseline)
+        failures.extend(f'{name}: {note}' for note in notes)
+
+        if baseline:
+            for size in sizes:
+                before = baseline.get(size, {}).get(name)
+                if before and results[size][name]['ms'] > before['ms'] * TIME_REGRESSION_FACTOR + 20:
+                    notes.append(f"slower {before['ms']:.0f} -> {results[size][name]['ms']:.0f}ms at {size} (not failing)")
+        cells = ''.join(f"{results[size][name]['queries']:>9}{results[size][name]['ms']:>10.1f}" for size in sizes)
+        print(f"{name:<32}{largest[name]['status']:>7}{cells}{budget:>8}  {'; '.join(notes)}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='200,2000', help='comma separated phone counts, ascending')
+    parser.add_argument('--repeat', type=int, default=3, help='requests per GET route for the median time')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', help='JSON baseline to compare against')
+    parser.add_argument('--write-baseline', help='write the results to this JSON file')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    baseline = None
+    if args.baseline:
+        with open(os.path.abspath(args.baseline)) as f:
+            baseline = json.load(f)['results']
+    write_path = os.path.abspath(args.write_baseline) if args.write_baseline else None
+
+    results, uncovered = run(sizes, args.repeat, args.seed)
+    failures = check(results, baseline)
+    if uncovered:
+        failures.append(f"routes without a case (add to build_cases or SKIPPED): {', '.join(uncovered)}")
+
+    if write_path:
+        with open(write_path, 'w') as f:
+            json.dump({'sizes': sizes, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nBaseline written to {write_path}')
+
+    if failures:
+        print('\nFAILED')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
+    print('\nAll routes within budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Live inventory events: what the pages hand /events as their starting point.
+
+    python -m pytest tests/test_inventory_events.py
+"""
+import json
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='module')
+def shop(tmp_path_factory):
+    """The app module over a database with the default users"""
+    if 'app' not in sys.modules:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + str(tmp_path_factory.mktemp('events') / 'events.db')
+        os.environ.pop('REPORTS_DATABASE_URL', None)
+    import app as shop
+
+    with shop.app.app_context():
+        shop.initialize_database()
+    return shop
+
+
+@pytest.fixture
+def client(shop, monkeypatch):
+    monkeypatch.setattr(shop, 'EVENTS_MAX_STREAMS', 2)
+    monkeypatch.setattr(shop, 'EVENTS_STREAM_SECONDS', 0.3)
+    client = shop.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
+
+
+def add_event(shop, event_id):
+    """Commit an inventory_event row with an explicit id, created now"""
+    with shop.app.app_context():
+        shop.db.session.add(shop.InventoryEvent(
+            id=event_id, created_at=datetime.utcnow(), kind='stock_changed',
+            payload=json.dumps({'units_delta': 0})))
+        shop.db.session.commit()
+
+
+def settle_events(shop):
+    """Age every event past EVENTS_SETTLE_SECONDS"""
+    with shop.app.app_context():
+        shop.InventoryEvent.query.update(
+            {'created_at': datetime.utcnow() - timedelta(seconds=shop.EVENTS_SETTLE_SECONDS + 1)})
+        shop.db.session.commit()
+
+
+def newest_event_id(shop):
+    with shop.app.app_context():
+        return shop.db.session.query(shop.db.func.max(shop.InventoryEvent.id)).scalar() or 0
+
+
+def page_since(client, path):
+    page = client.get(path).get_data(as_text=True)
+    return int(re.search(r'/events\?since=(\d+)', page).group(1)), page
+
+
+def streamed_ids(client, since):
+    body = client.get('/events', query_string={'since': since}).get_data(as_text=True)
+    return [int(event_id) for event_id in re.findall(r'^id: (\d+)$', body, re.M)]
+
+
+@pytest.mark.parametrize('path', ['/create_sale', '/dashboard'])
+def test_lower_id_committed_after_render_is_delivered(shop, client, path):
+    settle_events(shop)
+    base = newest_event_id(shop)
+    add_event(shop, base + 2)
+    since, _ = page_since(client, path)
+    assert since <= base  # not past the unsettled event
+
+    # A transaction that took the lower id commits after the page was rendered
+    add_event(shop, base + 1)
+    settle_events(shop)
+    assert streamed_ids(client, since)[-2:] == [base + 1, base + 2]
+
+
+def test_dashboard_skips_the_events_its_counts_include(shop, client):
+    settle_events(shop)
+    base = newest_event_id(shop)
+    add_event(shop, base + 1)
+    since, page = page_since(client, '/dashboard')
+    applied = json.loads(re.search(r'new Set\((\[.*?\])\)', page).group(1))
+    assert since <= base and applied == [base + 1]
@@ -0,0 +1,49 @@
+"""Per-route SQL query budgets, one test per route (see query_budget.py).
+
+    python -m pytest tests/test_query_budget.py
+
+Grows a throw-away SQLite database to each size of query_budget_baseline.json,
+drives every route through the test client and fails a route that answers with
+an unexpected status, runs over its statement budget, runs more statements on
+the larger dataset, or runs more statements than in the baseline.
+"""
+import json
+import multiprocessing
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import query_budget  # noqa: E402
+
+BASELINE_PATH = os.path.join(query_budget.REPO_DIR, 'query_budget_baseline.json')
+with open(BASELINE_PATH) as f:
+    BASELINE = json.load(f)
+
+CASE_NAMES = [case[0] for case in query_budget.build_cases(defaultdict(str))]
+
+
+@pytest.fixture(scope='module')
+def measured():
+    """({case: failures}, uncovered endpoints) of one run over the baseline sizes
+
+    In a fresh interpreter: the app binds its database on import, and other test
+    modules may already have imported it over their own data.
+    """
+    spawn = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+        return pool.submit(query_budget.route_report, BASELINE['sizes'], 2, 1, BASELINE['results']).result()
+
+
+@pytest.mark.parametrize('name', CASE_NAMES)
+def test_route_within_budget(measured, name):
+    failures, _ = measured
+    assert failures[name] == []
+
+
+def test_every_route_has_a_case(measured):
+    _, uncovered = measured
+    assert uncovered == [], 'add these routes to build_cases or SKIPPED'
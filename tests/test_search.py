@@ -0,0 +1,70 @@
+"""Serial and phone-number lookups through /search.
+
+    python -m pytest tests/test_search.py
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SERIALS = {
+    'tail': '359881030014725',    # ends with 4725
+    'head': '861234050099118',    # starts with 86123405
+    'middle': '350004725990311',  # 0004725 in the middle
+    'whole': '354700990004725',   # ends with 0004725
+}
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    """Logged-in admin client over a database holding the SERIALS phones"""
+    if 'app' not in sys.modules:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + str(tmp_path_factory.mktemp('search') / 'search.db')
+        os.environ.pop('REPORTS_DATABASE_URL', None)
+    import app as shop
+
+    with shop.app.app_context():
+        shop.initialize_database()
+        shop.Phone.query.filter(shop.Phone.serial_number.in_(SERIALS.values())).delete()
+        for number, (name, serial) in enumerate(SERIALS.items(), start=8701):
+            shop.db.session.add(shop.Phone(
+                brand='Samsung', model=f'Search {name}', condition='used', serial_number=serial,
+                phone_number=str(number).zfill(shop.PHONE_NUMBER_DIGITS), purchase_price=100,
+                selling_price=150, purchase_price_with_vat=115, selling_price_with_vat=172.5))
+        shop.db.session.commit()
+    client = shop.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
+
+
+def found(client, term):
+    """Which of the SERIALS phones the /search page lists for term"""
+    page = client.get('/search', query_string={'search_term': term}).get_data(as_text=True)
+    return {name for name in SERIALS if f'Search {name}<' in page}
+
+
+def test_serial_suffix(client):
+    assert found(client, '4725') == {'tail', 'whole'}
+
+
+def test_serial_suffix_in_arabic_digits(client):
+    assert found(client, '٤٧٢٥') == {'tail', 'whole'}
+
+
+def test_serial_prefix(client):
+    assert found(client, '86123405') == {'head'}
+
+
+def test_phone_number_without_padding(client):
+    assert found(client, '8701') == {'tail'}
+
+
+def test_mid_serial_digits_fall_back_to_substring_scan(client):
+    assert found(client, '8810') == {'tail'}
+
+
+def test_long_term_keeps_mid_serial_matches(client):
+    # The suffix of one serial and the middle of another: both must be found
+    assert found(client, '0004725') == {'middle', 'whole'}